@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import logging
+
+logging.getLogger().setLevel(logging.DEBUG)
+from lib import batch_helper
+import argparse
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "Source",
+        nargs="?",
+        help="Directory of firmware, or a file listing one firmware path per line. "
+        "Leave out to carry on with the firmware already in the database",
+    )
+    parser.add_argument(
+        "--database", default="results.db", help="SQLite database of the batch"
+    )
+    parser.add_argument(
+        "--output",
+        default="batch_output",
+        help="Directory getting a folder with the runner script and log per firmware",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=batch_helper.default_workers,
+        help="Firmware emulated at once",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=batch_helper.job_timeout,
+        help="Seconds one firmware may take, 0 for no limit",
+    )
+    parser.add_argument(
+        "--retry-failed", action="store_true", help="Run the failed firmware again"
+    )
+    parser.add_argument(
+        "--status", action="store_true", help="Print the jobs by status and exit"
+    )
+    parser.add_argument(
+        "--with-image",
+        action="store_true",
+        help="Export the image and kernel along with the runner script",
+    )
+    parser.add_argument(
+        "--rootless",
+        action="store_true",
+        help="Build the images without loop devices, mounts or sudo",
+    )
+    parser.add_argument(
+        "--overlay",
+        action="store_true",
+        help="Boot on a qcow2 overlay so runs never write to the base image",
+    )
+    parser.add_argument(
+        "--netns",
+        action="store_true",
+        help="Run the guests and their taps in network namespaces of their own",
+    )
+    parser.add_argument(
+        "--profile",
+        help="QEMU settings over the selected ones, such as memory=128,smp=2,mttcg=1",
+    )
+
+    args = parser.parse_args()
+
+    if args.status:
+        store = batch_helper.ResultStore(args.database)
+        counts = store.counts()
+        store.close()
+    else:
+        counts = batch_helper.run_batch(
+            args.database,
+            args.output,
+            source=args.Source,
+            workers=args.jobs,
+            timeout=args.timeout or None,
+            retry_failed=args.retry_failed,
+            rootless=args.rootless,
+            overlay=args.overlay,
+            netns=args.netns,
+            profile=args.profile,
+            script_only=not args.with_image,
+        )
+
+    for status, count in sorted(counts.items()):
+        print("{}: {}".format(status, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,16 @@
 # /usr/bin/env python
 from riposte import Riposte
 import logging
+import json
+import os
 
 logging.getLogger().setLevel(logging.DEBUG)
-logging.getLogger("cle").setLevel("WARNING")
-import tempfile
-import atexit
 from lib import extract_helper
 from lib import image_helper
+from lib import index_helper
 from lib import arch_helper
 from lib import qemu_runner
+from lib import instance_helper
 
 BANNER = """
 ______ _                                      
@@ -31,33 +32,73 @@ ______ _
 
 emu = Riposte(prompt="emu:~$ ", banner=BANNER)
 
-tmp_dir = None
+instance = None
+work_dir = None
 fw_tar = None
 image = None
 arch = None
 runner = None
 mount_path = None
 device = None
+session = None
 
 
 def have_image():
     return image is not None
 
 
+# Queues the edit on the open session, or applies it right away. Returns
+# whether it was applied.
+def run_edit(edit):
+
+    if session is not None:
+        edit(session)
+        emu.info("Queued, {} edits pending".format(len(session)))
+        return False
+
+    # Saved from the image as it was
+    runner.drop_snapshots()
+
+    with image_helper.edit_session(work_dir, image, mount_path) as new_session:
+        edit(new_session)
+
+    return True
+
+
 @emu.command("make_image")
 def get_image(fw_path):
 
-    global tmp_dir
+    global instance
+    global work_dir
     global fw_tar
     global image
     global arch
     global runner
+    global session
+
+    if mount_path is not None:
+        emu.error("Unmount {} first".format(mount_path))
+        return
+
+    if instance is not None:
+        # Its work directory goes with it
+        work_dir_path = os.path.realpath(instance.work_dir) + os.sep
+        if os.path.realpath(fw_path).startswith(work_dir_path):
+            emu.error("{} is in the work directory, export it first".format(fw_path))
+            return
 
-    tmp_dir = tempfile.TemporaryDirectory()
-    atexit.register(tmp_dir.cleanup)
+        instance.release()
+        instance = None
+        runner = None
+        image = None
+        session = None
+
+    # Released with the next image, or when the REPL exits
+    instance = instance_helper.allocate()
+    work_dir = instance.work_dir
 
     try:
-        fw_tar = extract_helper.extract_image(fw_path, tmp_dir.name)
+        fw_tar = extract_helper.extract_image(fw_path, work_dir)
     except:
         emu.error("Could not extract image")
         return
@@ -70,7 +111,7 @@ def get_image(fw_path):
 
     try:
         if not "image.raw" in fw_path:
-            image = image_helper.make_image(fw_tar, arch.qemu_name, tmp_dir.name)
+            image = image_helper.make_image(fw_tar, arch.qemu_name, work_dir)
         else:
             image = fw_path
     except Exception as e:
@@ -79,7 +120,12 @@ def get_image(fw_path):
         return
 
     runner = qemu_runner.QemuImage(
-        arch.qemu_name, arch.memory_endness, image, tmp_dir.name, False
+        arch.qemu_name,
+        arch.memory_endness,
+        image,
+        work_dir,
+        False,
+        instance=instance,
     )
 
     emu.success("Image created!")
@@ -105,9 +151,8 @@ def force_network():
         emu.error("No image set")
         return
 
-    image_helper.force_networking(tmp_dir.name, image)
-
-    emu.success("Files changed, ready to setup network")
+    if run_edit(lambda s: s.force_networking()):
+        emu.success("Files changed, ready to setup network")
 
 
 @emu.command("run")
@@ -130,8 +175,8 @@ def add_file_to_image(local_file, remote_file):
         return
 
     try:
-        image_helper.add_file(tmp_dir.name, image, local_file, remote_file)
-        emu.success("Added file")
+        if run_edit(lambda s: s.add_file(local_file, remote_file)):
+            emu.success("Added file")
     except:  # Could not add file
         emu.error("Could not add file")
 
@@ -144,8 +189,8 @@ def del_file_from_image(file_path):
         return
 
     try:
-        image_helper.del_file(tmp_dir.name, image, file_path)
-        emu.success("Removed file")
+        if run_edit(lambda s: s.del_file(file_path)):
+            emu.success("Removed file")
     except:  # File not found
         emu.error("Could not remove file")
 
@@ -158,8 +203,8 @@ def remove_root_passwd():
         return
 
     try:
-        image_helper.remove_root_passwd(tmp_dir.name, image)
-        emu.success("Removed root passwd")
+        if run_edit(lambda s: s.remove_root_passwd()):
+            emu.success("Removed root passwd")
     except:
         emu.error("Could not remove root passwd")
 
@@ -172,20 +217,114 @@ def force_tty_login():
         return
 
     try:
-        image_helper.replace_tty_login(tmp_dir.name, image)
-        emu.success("Successfully replaced tty login with /bin/sh")
+        if run_edit(lambda s: s.replace_tty_login()):
+            emu.success("Successfully replaced tty login with /bin/sh")
     except:
         emu.error("Could not replace TTY login")
 
 
+@emu.command("snapshot")
+def take_snapshot(ready="network"):
+
+    if not runner:
+        emu.error("No runner set")
+        return
+
+    runner.snapshot = ready
+
+    try:
+        if runner.start_net:
+            runner.start_network()
+        runner.take_snapshot()
+        emu.success("Snapshot taken, runs now restore it")
+    except Exception as e:
+        print(e)
+        emu.error("Guest did not reach {}".format(ready))
+    finally:
+        if runner.start_net:
+            runner.stop_network()
+
+
+@emu.command("begin")
+def begin_session():
+
+    global session
+
+    if not have_image():
+        emu.error("No image set")
+        return
+
+    if session is not None:
+        emu.error("Session already open with {} edits pending".format(len(session)))
+        return
+
+    session = image_helper.ImageEditSession(work_dir, image)
+
+    emu.success("Edits are queued until commit")
+
+
+@emu.command("commit")
+def commit_session():
+
+    global session
+
+    if session is None:
+        emu.error("No session open")
+        return
+
+    edit_count = len(session)
+
+    try:
+        runner.drop_snapshots()
+        session.mount_path = mount_path
+        session.commit()
+        emu.success("Applied {} edits".format(edit_count))
+    except Exception as e:
+        print(e)
+        emu.error("Could not apply edits")
+
+    session = None
+
+
+@emu.command("discard")
+def discard_session():
+
+    global session
+
+    if session is None:
+        emu.error("No session open")
+        return
+
+    session = None
+
+    emu.success("Discarded queued edits")
+
+
 @emu.command("export")
-def export_image(location):
+def export_image(location, image_format=None):
 
     if not runner:
         emu.error("No runner set")
         return
 
-    runner.export(location)
+    runner.export(location, image_format=image_format)
+
+
+@emu.command("find")
+def find_file(file_name):
+
+    if not have_image():
+        emu.error("No image set")
+        return
+
+    index = index_helper.load_index(image)
+
+    if index is None:
+        emu.error("Image has no file index")
+        return
+
+    for entry in index.find(lambda x: x == file_name, file_type=None):
+        emu.info("/{} {} {}".format(entry.path, entry.type, entry.magic or ""))
 
 
 @emu.command("info")
@@ -201,6 +340,10 @@ def image_info():
     emu.success("Image IP ADDR : {}".format(runner.ips))
     emu.success("Image Kernel  : {}".format(runner.kernel))
 
+    timeline = runner.get_boot_timeline()
+    if timeline:
+        emu.success("Boot Timeline : {}".format(json.dumps(timeline, indent=2)))
+
 
 @emu.command("mount")
 def mount_image():
@@ -216,9 +359,9 @@ def mount_image():
     try:
         device = image_helper.get_mounted_device(image)
 
-        mount_path = image_helper.make_mount_path(tmp_dir.name, device)
+        mount_path = image_helper.make_mount_path(work_dir, device)
 
-        image_helper.fix_permissions(tmp_dir.name)
+        image_helper.fix_permissions(work_dir)
     except:  # subprocess.CalledProcessError
         emu.error("Unmounting too quickly. Try again in a moment")
 
@@ -236,6 +379,8 @@ def unmount_image():
         emu.error("Nothing mounted. Nothing to do")
 
     image_helper.cleanup_image_and_device(image, device)
+    # Anything could have changed while it was mounted
+    runner.drop_snapshots()
 
     mount_path = None
 
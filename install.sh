@@ -8,7 +8,9 @@ sudo python3 setup.py install
 
 sudo -H pip3 install git+https://github.com/ahupp/python-magic
 sudo -H pip3 install git+https://github.com/sviehb/jefferson
+# Network setup runs as root, so root needs it too
+sudo -H pip3 install pyroute2
 
-pip3 install cle python-magic riposte
+pip3 install python-magic riposte
 
 sudo apt-get install qemu-system-arm qemu-system-mips qemu-system-x86 qemu-utils kpartx uml-utilities bridge-utils
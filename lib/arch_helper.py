@@ -1,52 +1,143 @@
-import tempfile
+import collections
+import struct
 import tarfile
 import os
-import cle
 import logging
-
-root_fs = "root_fs"
+from lib import rootfs_helper
+
+# Architecture of a firmware, named the same way qemu_runner expects it
+Arch = collections.namedtuple("Arch", ["name", "qemu_name", "memory_endness", "bits"])
+
+# Only the ELF identification and the fixed part of the header are read
+elf_header_size = 64
+elf_magic = b"\x7fELF"
+
+# ELF e_type values of loadable binaries (ET_EXEC, ET_DYN)
+elf_types = [2, 3]
+
+# ELF e_machine to (name, little endian qemu name, big endian qemu name)
+elf_machines = {
+    3: ("X86", "i386", "i386"),
+    8: ("MIPS", "mipsel", "mips"),
+    20: ("PPC", "ppc", "ppc"),
+    21: ("PPC64", "ppc64", "ppc64"),
+    40: ("ARM", "arm", "armeb"),
+    62: ("AMD64", "x86_64", "x86_64"),
+    183: ("AARCH64", "aarch64", "aarch64"),
+}
+
+# Binaries that are present on most firmware, checked before everything else
+well_known_files = [
+    "bin/busybox",
+    "sbin/init",
+    "bin/sh",
+    "usr/sbin/httpd",
+    "lib/libc.so.0",
+    "lib/libc.so.6",
+]
 
 
 def get_arch(file_name):
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
+    artifact = rootfs_helper.open_artifact(file_name)
 
-        logging.info("Using {} as scratch directory".format(tmp_dir))
+    try:
+        # Staged directories and indexed tars can read any file directly
+        if artifact.is_dir() or artifact.get_index() is not None:
+            for name in well_known_files:
+                arch = get_arch_from_header(artifact.read(name, elf_header_size))
+                if arch:
+                    print("[+] File {} found with arch {}".format(name, arch.name))
+                    return arch
 
-        fs_path = os.path.join(tmp_dir, root_fs)
+        if artifact.is_dir():
+            return get_arch_from_files(sorted(get_files(artifact.path)))
 
-        os.mkdir(fs_path)
+        return get_arch_from_tar(artifact)
+
+    except tarfile.ReadError:
+        logging.warn("[-] Provided file {} is not a tar".format(file_name))
+        exit(1)
 
-        try:
-            tar_rootfs = tarfile.open(file_name)
-        except tarfile.ReadError:
-            logging.warn("[-] Provided file {} is not a tar".format(file_name))
-            exit(1)
 
-        tar_rootfs.extractall(path=fs_path)
+def get_arch_from_tar(artifact):
 
-        files = get_files(fs_path)
+    # Stream the members, reading only the header of each regular file
+    with artifact.open_tar(stream=True) as tar:
+        for member in tar:
+            if not member.isreg() or member.size < elf_header_size:
+                continue
 
-        return get_arch_from_files(files)
+            arch = get_arch_from_header(tar.extractfile(member).read(elf_header_size))
+
+            if arch:
+                print(
+                    "[+] File {} found with arch {}".format(
+                        member.name.split("/")[-1], arch.name
+                    )
+                )
+                return arch
+    return None
 
 
 def get_arch_from_files(files):
 
-    for file_name in sorted(files):
+    for file_name in files:
+
+        if os.path.islink(file_name) or not os.path.isfile(file_name):
+            continue
 
         try:
-            loaded_file = cle.Loader(file_name)
-        except:
+            with open(file_name, "rb") as f:
+                arch = get_arch_from_header(f.read(elf_header_size))
+        except OSError:
             continue
 
-        file_arch = loaded_file.main_object.arch
+        if arch:
+            print(
+                "[+] File {} found with arch {}".format(
+                    file_name.split("/")[-1], arch.name
+                )
+            )
+            return arch
+    return None
 
-        print(
-            "[+] File {} found with arch {}".format(file_name.split("/")[-1], file_arch)
-        )
 
-        return file_arch
-    return None
+def get_arch_from_header(header):
+
+    if not header or len(header) < elf_header_size or not header.startswith(elf_magic):
+        return None
+
+    # EI_CLASS: 1 is 32 bit, 2 is 64 bit
+    if header[4] not in (1, 2):
+        return None
+    bits = 32 if header[4] == 1 else 64
+
+    # EI_DATA: 1 is little endian, 2 is big endian
+    if header[5] not in (1, 2):
+        return None
+    little_endian = header[5] == 1
+
+    e_type, e_machine = struct.unpack("<HH" if little_endian else ">HH", header[16:20])
+
+    if e_type not in elf_types or e_machine not in elf_machines:
+        return None
+
+    name, qemu_le, qemu_be = elf_machines[e_machine]
+
+    if bits == 64 and e_machine == 8:
+        name, qemu_le, qemu_be = "MIPS64", "mips64el", "mips64"
+
+    return Arch(
+        "{}{} ({})".format(
+            name,
+            bits if name in ("MIPS", "ARM") else "",
+            "LE" if little_endian else "BE",
+        ),
+        qemu_le if little_endian else qemu_be,
+        "Iend_LE" if little_endian else "Iend_BE",
+        bits,
+    )
 
 
 def get_files(directory):
@@ -0,0 +1,492 @@
+import concurrent.futures
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import time
+from concurrent.futures.process import BrokenProcessPool
+from lib import pipeline_helper
+
+# Emulations at once. Each boots every strategy at once, see strategy_helper.
+default_workers = 4
+
+# Seconds an emulation may take, None for no limit
+job_timeout = 1800
+
+# Times a job may be started before it is failed, for workers that die or
+# batches that stop while it runs
+max_attempts = 3
+
+# Seconds to wait for a write lock held by another process
+busy_timeout = 60
+
+# Seconds the workers of an interrupted batch get to release their instances
+# and stop QEMU before they are killed
+interrupt_timeout = 10
+
+# Job statuses
+pending = "pending"
+running = "running"
+done = "done"
+failed = "failed"
+
+log_name = "emulate.log"
+lock_suffix = ".lock"
+
+# Expects job id then firmware file name
+job_folder = "{:06d}_{}"
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    arch TEXT,
+    strategy TEXT,
+    ips TEXT,
+    output TEXT,
+    error TEXT,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS stages (
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    attempt INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    ok INTEGER,
+    reason TEXT,
+    started REAL NOT NULL,
+    duration REAL,
+    PRIMARY KEY (job_id, attempt, stage)
+);
+"""
+
+
+class JobTimeout(Exception):
+    """
+    The emulation ran past job_timeout.
+    """
+
+
+class ResultStore(object):
+    """
+    SQLite database of a batch: one row per firmware in jobs, with its
+    status, architecture, winning strategy, guest IPs and error, and one row
+    per stage started in stages. A stage row with no ok yet was running when
+    its worker stopped. Every process opens its own store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=busy_timeout)
+        self.db.row_factory = sqlite3.Row
+        # Readers don't block the workers writing their stages
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(schema)
+
+    def add_jobs(self, paths):
+        """
+        Adds the firmware at paths, skipping those already in the store.
+        Returns how many were added.
+        """
+        with self.db:
+            cursor = self.db.executemany(
+                "INSERT OR IGNORE INTO jobs (path) VALUES (?)",
+                [(os.path.abspath(x),) for x in paths],
+            )
+
+        return cursor.rowcount
+
+    def recover(self, attempts=max_attempts):
+        """
+        Puts the jobs left running by a batch that stopped back to pending,
+        or fails them if they were started attempts times. Returns how many
+        will run again.
+        """
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ?"
+                " WHERE status = ? AND attempts >= ?",
+                (
+                    failed,
+                    "Stopped {} times".format(attempts),
+                    time.time(),
+                    running,
+                    attempts,
+                ),
+            )
+            cursor = self.db.execute(
+                "UPDATE jobs SET status = ? WHERE status = ?", (pending, running)
+            )
+
+        return cursor.rowcount
+
+    def retry_failed(self):
+
+        with self.db:
+            cursor = self.db.execute(
+                "UPDATE jobs SET status = ?, attempts = 0, error = NULL"
+                " WHERE status = ?",
+                (pending, failed),
+            )
+
+        return cursor.rowcount
+
+    def next_jobs(self, count):
+
+        rows = self.db.execute(
+            "SELECT id, path FROM jobs WHERE status = ? ORDER BY id LIMIT ?",
+            (pending, count),
+        )
+
+        return [(x["id"], x["path"]) for x in rows]
+
+    def start_job(self, job_id):
+        """
+        Marks the job running and returns its attempt number.
+        """
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, started = ?,"
+                " finished = NULL, error = NULL WHERE id = ?",
+                (running, time.time(), job_id),
+            )
+
+        return self.get_job(job_id)["attempts"]
+
+    def requeue_job(self, job_id, error, attempts=max_attempts):
+        """
+        Runs the job again later, unless it was started attempts times.
+        """
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END,"
+                " error = ?, finished = ? WHERE id = ?",
+                (attempts, failed, pending, error, time.time(), job_id),
+            )
+
+    def release_job(self, job_id):
+        """
+        Hands back a job the batch stopped itself, without counting the attempt.
+        """
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts - 1 WHERE id = ?",
+                (pending, job_id),
+            )
+
+    def finish_job(
+        self, job_id, ok, arch=None, strategy=None, ips=(), output=None, error=None
+    ):
+
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, arch = ?, strategy = ?, ips = ?,"
+                " output = ?, error = ?, finished = ? WHERE id = ?",
+                (
+                    done if ok else failed,
+                    arch,
+                    strategy,
+                    json.dumps(list(ips)),
+                    output,
+                    error,
+                    time.time(),
+                    job_id,
+                ),
+            )
+
+    def start_stage(self, job_id, attempt, stage):
+
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO stages (job_id, attempt, stage, started)"
+                " VALUES (?, ?, ?, ?)",
+                (job_id, attempt, stage, time.time()),
+            )
+
+    def finish_stage(self, job_id, attempt, result):
+
+        with self.db:
+            self.db.execute(
+                "UPDATE stages SET ok = ?, reason = ?, duration = ?"
+                " WHERE job_id = ? AND attempt = ? AND stage = ?",
+                (
+                    int(result.ok),
+                    result.reason,
+                    result.duration,
+                    job_id,
+                    attempt,
+                    result.stage,
+                ),
+            )
+
+    def get_job(self, job_id):
+
+        return self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def get_stages(self, job_id):
+
+        return self.db.execute(
+            "SELECT * FROM stages WHERE job_id = ? ORDER BY attempt, started",
+            (job_id,),
+        ).fetchall()
+
+    def counts(self):
+        """
+        Returns the number of jobs by status.
+        """
+        rows = self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+
+        return {status: count for status, count in rows}
+
+    def close(self):
+        self.db.close()
+
+
+def find_images(source, exclude=None):
+    """
+    Returns the firmware paths in source: every file under it if it is a
+    directory, else the paths it lists, one per line, relative to it.
+    Hidden files, comments and anything under exclude are skipped.
+    """
+    if not os.path.isdir(source):
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            lines = [x.strip() for x in f]
+
+        return [os.path.join(base, x) for x in lines if x and not x.startswith("#")]
+
+    exclude = os.path.abspath(exclude) if exclude else None
+    paths = []
+
+    for root, dirs, files in os.walk(source):
+        dirs[:] = sorted(
+            x
+            for x in dirs
+            if not x.startswith(".")
+            and os.path.abspath(os.path.join(root, x)) != exclude
+        )
+        paths.extend(
+            os.path.join(root, x) for x in sorted(files) if not x.startswith(".")
+        )
+
+    return paths
+
+
+def run_job(database, job_id, attempt, path, output_folder, timeout, options):
+    """
+    Runs the pipeline for one firmware in a worker process, recording each
+    stage in the store as it goes. Returns what finish_job takes.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Each job logs to its own output folder
+    handler = logging.FileHandler(os.path.join(output_folder, log_name))
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+
+    store = ResultStore(database)
+
+    def listener(stage, result):
+        if result is None:
+            store.start_stage(job_id, attempt, stage)
+        else:
+            store.finish_stage(job_id, attempt, result)
+
+    pipeline = pipeline_helper.Pipeline(
+        path, output_folder, listener=listener, **options
+    )
+
+    def raise_timeout(signum, frame):
+        raise JobTimeout("Timed out after {}s".format(timeout))
+
+    if timeout:
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.alarm(timeout)
+
+    try:
+        pipeline.run()
+    finally:
+        signal.alarm(0)
+        store.close()
+        root.removeHandler(handler)
+        handler.close()
+
+    return {
+        "ok": pipeline.ok,
+        "arch": pipeline.arch.qemu_name if pipeline.arch else None,
+        "strategy": pipeline.strategy,
+        "ips": pipeline.ips,
+        "output": pipeline.runner_path,
+        "error": pipeline.error,
+    }
+
+
+def start_worker(*args):
+    """
+    Runs run_job with args in a process of its own, which exits with it. A
+    job that kills its process takes no other job with it, and nothing it
+    leaves behind (instances, temporary or working directory) reaches the
+    next one. Returns the executor and the future of the job.
+    """
+    # Not forked, so the store connection and its lock stay with the batch
+    executor = concurrent.futures.ProcessPoolExecutor(
+        1, mp_context=multiprocessing.get_context("spawn")
+    )
+
+    return executor, executor.submit(run_job, *args)
+
+
+def stop_workers(executors, timeout=interrupt_timeout):
+    """
+    Interrupts the worker processes of executors, as Ctrl-C does, and kills
+    those still running after timeout.
+    """
+    processes = []
+
+    for executor in executors:
+        # The executor itself can only wait for its workers
+        processes.extend((executor._processes or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for process in processes:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGINT)
+
+    deadline = time.time() + timeout
+
+    for process in processes:
+        process.join(max(0, deadline - time.time()))
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+
+def record_job(store, job_id, path, future):
+    """
+    Stores the outcome of the job of a finished future. A job whose worker
+    died is run again later.
+    """
+    try:
+        result = future.result()
+    except BrokenProcessPool:
+        logging.warning("Worker died running {}".format(path))
+        store.requeue_job(job_id, "Worker died")
+        return
+    except Exception as e:
+        result = {"ok": False, "error": str(e)}
+
+    store.finish_job(job_id, **result)
+    logging.info("{}: {}".format(path, "done" if result["ok"] else result["error"]))
+
+
+def lock_store(database):
+    """
+    Keeps other batches off the store until the process exits.
+    """
+    lock_file = open(database + lock_suffix, "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise RuntimeError("Another batch is running on {}".format(database))
+
+    return lock_file
+
+
+def run_batch(
+    database,
+    output_dir,
+    source=None,
+    workers=default_workers,
+    timeout=job_timeout,
+    retry_failed=False,
+    **options
+):
+    """
+    Emulates every pending firmware in the store, workers at a time, after
+    adding those in source (see find_images). Jobs a stopped batch left
+    running are started again, so running it again with the same store
+    carries on where it stopped. options go to pipeline_helper.Pipeline.
+    Returns the number of jobs by status.
+    """
+    database = os.path.abspath(database)
+    output_dir = os.path.abspath(output_dir)
+
+    lock_file = lock_store(database)
+    store = ResultStore(database)
+
+    if source:
+        added = store.add_jobs(find_images(source, exclude=output_dir))
+        logging.info("Added {} firmware from {}".format(added, source))
+
+    resumed = store.recover()
+    if resumed:
+        logging.info("Resuming {} jobs".format(resumed))
+    if retry_failed:
+        logging.info("Retrying {} failed jobs".format(store.retry_failed()))
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs = {}
+
+    try:
+        while True:
+            for job_id, path in store.next_jobs(workers - len(jobs)):
+                attempt = store.start_job(job_id)
+                output_folder = os.path.join(
+                    output_dir, job_folder.format(job_id, os.path.basename(path))
+                )
+                executor, future = start_worker(
+                    database,
+                    job_id,
+                    attempt,
+                    path,
+                    output_folder,
+                    timeout,
+                    options,
+                )
+                jobs[future] = (job_id, path, executor)
+
+            if not jobs:
+                break
+
+            finished, _ = concurrent.futures.wait(
+                jobs, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for future in finished:
+                job_id, path, executor = jobs.pop(future)
+                executor.shutdown(wait=False)
+                record_job(store, job_id, path, future)
+    finally:
+        # Interrupted. The jobs that finished meanwhile are stored, the others
+        # are stopped and started again next time. Workers that got the
+        # Ctrl-C themselves count as stopped.
+        finished = [
+            x
+            for x in jobs
+            if x.done() and not isinstance(x.exception(), KeyboardInterrupt)
+        ]
+        stop_workers([x[2] for x in jobs.values()])
+
+        for future, (job_id, path, executor) in jobs.items():
+            if future in finished:
+                record_job(store, job_id, path, future)
+            else:
+                store.release_job(job_id)
+        counts = store.counts()
+        store.close()
+        lock_file.close()
+
+    return counts
@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+# Persistent extraction cache, keyed by MD5 checksum of the firmware or of any
+# item carved out of it. Each entry is a directory holding the extracted rootfs
+# artifact and/or the binwalk signature table of that item.
+cache_dir = os.environ.get(
+    "FW_EMULATOR_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "firmware_emulator"),
+)
+
+# Size cap in bytes, least recently used entries are evicted past this
+cache_max_size = int(os.environ.get("FW_EMULATOR_CACHE_SIZE", 20 * 1024 ** 3))
+
+rootfs_name = "rootfs"
+scan_name = "scan.json"
+
+# Known rootfs artifact suffixes, longest first
+rootfs_suffixes = [".tar.gz", ".tgz", ".tar", ".rootfs"]
+
+
+def rootfs_suffix(path):
+
+    for suffix in rootfs_suffixes:
+        if path.endswith(suffix):
+            return suffix
+
+    return ""
+
+
+def link_or_copy(src, dst):
+
+    if os.path.isdir(src) and not os.path.islink(src):
+        shutil.copytree(src, dst, symlinks=True, copy_function=link_or_copy)
+        return
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ExtractionCache(object):
+    """
+    On-disk, size capped, LRU evicted store of extraction results.
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = os.path.abspath(directory or cache_dir)
+        self.max_size = cache_max_size if max_size is None else max_size
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def entry_path(self, checksum):
+        return os.path.join(self.directory, checksum)
+
+    def touch(self, checksum):
+        """
+        Marks an entry as recently used.
+        """
+        try:
+            os.utime(self.entry_path(checksum))
+        except OSError:
+            pass
+
+    def get_rootfs(self, checksum):
+        """
+        Returns the path of the cached rootfs artifact for this checksum, or
+        None.
+        """
+        entry = self.entry_path(checksum)
+
+        try:
+            names = os.listdir(entry)
+        except OSError:
+            return None
+
+        for name in names:
+            if name == rootfs_name + rootfs_suffix(name):
+                self.touch(checksum)
+                return os.path.join(entry, name)
+
+        return None
+
+    def fetch_rootfs(self, checksum, output):
+        """
+        Links the cached rootfs artifact (a file, or a directory of hard
+        links) for this checksum to output (without suffix). Returns the
+        resulting path, or None on a cache miss.
+        """
+        cached = self.get_rootfs(checksum)
+
+        if not cached:
+            return None
+
+        output += rootfs_suffix(cached)
+
+        if not os.path.exists(output):
+            link_or_copy(cached, output)
+
+        logging.info("Extraction cache hit for {}".format(checksum))
+
+        return output
+
+    def put_rootfs(self, checksum, path):
+        """
+        Stores a rootfs artifact under this checksum.
+        """
+        if self.get_rootfs(checksum):
+            return
+
+        self._put_file(checksum, rootfs_name + rootfs_suffix(path), path)
+        self.evict()
+
+    def get_scan(self, checksum):
+        """
+        Returns the cached signature table for this checksum, or None.
+        """
+        try:
+            with open(os.path.join(self.entry_path(checksum), scan_name)) as f:
+                scan = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        self.touch(checksum)
+        return scan
+
+    def put_scan(self, checksum, scan):
+        """
+        Stores a JSON serializable signature table under this checksum.
+        """
+        entry = self.entry_path(checksum)
+        os.makedirs(entry, exist_ok=True)
+
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=entry)
+        with os.fdopen(tmp_fd, "w") as f:
+            json.dump(scan, f)
+        os.replace(tmp_path, os.path.join(entry, scan_name))
+
+    def _put_file(self, checksum, name, path):
+
+        entry = self.entry_path(checksum)
+        os.makedirs(entry, exist_ok=True)
+
+        # Stage next to the final name so concurrent readers never see a
+        # partially written artifact
+        tmp_path = os.path.join(entry, ".{}.{}".format(name, os.getpid()))
+        link_or_copy(path, tmp_path)
+
+        try:
+            os.replace(tmp_path, os.path.join(entry, name))
+        except OSError:
+            # a staged directory was stored by another process first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def size(self, checksum):
+
+        total = 0
+
+        for path, _, files in os.walk(self.entry_path(checksum)):
+            for file_name in files:
+                try:
+                    total += os.lstat(os.path.join(path, file_name)).st_size
+                except OSError:
+                    pass
+
+        return total
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits within its
+        size cap.
+        """
+        entries = []
+        total = 0
+
+        for checksum in os.listdir(self.directory):
+            try:
+                mtime = os.stat(self.entry_path(checksum)).st_mtime
+            except OSError:
+                continue
+            size = self.size(checksum)
+            total += size
+            entries.append((mtime, size, checksum))
+
+        for _, size, checksum in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            logging.debug("Evicting {} from extraction cache".format(checksum))
+            shutil.rmtree(self.entry_path(checksum), ignore_errors=True)
+            total -= size
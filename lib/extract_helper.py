@@ -3,15 +3,30 @@ import os
 import logging
 import shutil
 from lib.extractor_techniques.extractor import Extractor
+from lib import cache_helper
 
 # from extractor_techniques.extractor import Extractor
 
 # returns tar of rootfs
-def extract_image(firmware_path, work_dir):
+def extract_image(firmware_path, work_dir, use_cache=True):
+
+    extraction_cache = cache_helper.ExtractionCache() if use_cache else None
+
+    if extraction_cache:
+        os.makedirs(work_dir, exist_ok=True)
+        checksum = Extractor.io_md5(firmware_path)
+        tag = os.path.basename(firmware_path) + "_" + checksum
+        root_fs_tar = extraction_cache.fetch_rootfs(
+            checksum, os.path.join(work_dir, tag)
+        )
+        if root_fs_tar:
+            return root_fs_tar
 
     for technique in technique_list:
-        root_fs_tar = technique(firmware_path, work_dir)
+        root_fs_tar = technique(firmware_path, work_dir, extraction_cache)
         if root_fs_tar:
+            if extraction_cache:
+                extraction_cache.put_rootfs(checksum, root_fs_tar)
             return root_fs_tar
 
     logging.warn("Failed to extract firmware")
@@ -20,12 +35,12 @@ def extract_image(firmware_path, work_dir):
 
 
 # from sources.extractor.extractor import Extractor
-def extractor_firmadyne(firmware_path, work_dir):
+def extractor_firmadyne(firmware_path, work_dir, extraction_cache=None):
 
     logging.info("Using firmadyne extractor")
 
     # Create Firmadyne extractor
-    firm_extractor = Extractor(firmware_path, work_dir)
+    firm_extractor = Extractor(firmware_path, work_dir, cache=extraction_cache)
 
     firm_extractor.extract()
 
@@ -7,16 +7,29 @@ e.g. 'extractor.py <input> <output>'.
 """
 
 import argparse
+import collections
+import concurrent.futures
 import hashlib
+import mmap
 import multiprocessing
 import os
 import shutil
+import sys
 import tempfile
 import traceback
+import uuid
 
-import magic
 import binwalk
 
+try:
+    from lib import magic_helper
+except ImportError:
+    # Executed directly, make the repository root importable
+    sys.path.append(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    )
+    from lib import magic_helper
+
 
 class Extractor(object):
     """
@@ -43,9 +56,10 @@ class Extractor(object):
     ]
     UNIX_THRESHOLD = 4
 
-    # Lock to prevent concurrent access to visited set. Unfortunately, must be
-    # static because it cannot be pickled or passed as instance attribute.
-    visited_lock = multiprocessing.Lock()
+    # Output formats of the root filesystem, and their file suffix. "dir" is a
+    # staged directory, "tar" is uncompressed so it can be consumed without
+    # decompressing it again, "gztar" is the compact legacy format.
+    ROOTFS_FORMATS = {"dir": ".rootfs", "tar": ".tar", "gztar": ".tar.gz"}
 
     def __init__(
         self,
@@ -56,6 +70,8 @@ class Extractor(object):
         numproc=True,
         server=None,
         brand=None,
+        cache=None,
+        rootfs_format="tar",
     ):
         # Input firmware update file or directory
         self._input = os.path.abspath(indir)
@@ -68,17 +84,26 @@ class Extractor(object):
         # Whether to attempt to extract root filesystem
         self.do_rootfs = rootfs
 
+        # Output format of the root filesystem, see ROOTFS_FORMATS
+        if rootfs_format not in Extractor.ROOTFS_FORMATS:
+            raise ValueError("Unknown rootfs format: %s" % rootfs_format)
+        self.rootfs_format = rootfs_format
+
         # Brand of the firmware
         self.brand = None
 
         # Hostname of SQL server
         self.database = None
 
-        # Worker pool.
-        self._pool = multiprocessing.Pool() if numproc else None
+        # Persistent extraction cache (see lib/cache_helper.py), keyed by MD5
+        self.cache = cache
+
+        # Whether to schedule items, including nested ones, on a worker pool
+        self.scheduled = bool(numproc)
 
-        # Set containing MD5 checksums of visited items
-        self.visited = set()
+        # Dict (used as a set) containing MD5 checksums of visited items. While
+        # scheduling, this is a manager proxy shared by all worker processes.
+        self.visited = dict()
 
         # List containing tagged items to extract as 2-tuple: (tag [e.g. MD5],
         # path)
@@ -91,41 +116,55 @@ class Extractor(object):
         Eliminate attributes that should not be pickled.
         """
         self_dict = self.__dict__.copy()
-        del self_dict["_pool"]
         del self_dict["_list"]
+        del self_dict["extraction_items"]
         return self_dict
 
+    def visit(self, checksum):
+        """
+        Atomically mark a checksum as visited. Returns False if it already was.
+        """
+        token = uuid.uuid4().hex
+        return self.visited.setdefault(checksum, token) == token
+
     @staticmethod
     def io_dd(indir, offset, size, outdir):
         """
         Given a path to a target file, extract size bytes from specified offset
-        to given output file.
+        to given output file. The input is memory mapped and copied in 1MB
+        slices, hashing each slice on the way, so memory use stays bounded.
+        Returns the MD5 of the extracted data.
         """
         if not size:
-            return
+            return None
+
+        blocksize = 1024 * 1024
+        hasher = hashlib.md5()
 
         with open(indir, "rb") as ifp:
             with open(outdir, "wb") as ofp:
-                ifp.seek(offset, 0)
-                ofp.write(ifp.read(size))
+                with mmap.mmap(ifp.fileno(), 0, access=mmap.ACCESS_READ) as imap:
+                    view = memoryview(imap)
+                    try:
+                        end = min(offset + size, len(imap))
+                        while offset < end:
+                            chunk = view[offset : min(offset + blocksize, end)]
+                            hasher.update(chunk)
+                            ofp.write(chunk)
+                            chunk.release()
+                            offset += blocksize
+                    finally:
+                        view.release()
+
+        return hasher.hexdigest()
 
     @staticmethod
     def magic(indata, mime=False):
         """
-        Performs file magic while maintaining compatibility with different
-        libraries.
+        Performs file magic using the per-process, memoized handles from
+        lib/magic_helper.py.
         """
-
-        try:
-            if mime:
-                mymagic = magic.open(magic.MAGIC_MIME_TYPE)
-            else:
-                mymagic = magic.open(magic.MAGIC_NONE)
-            mymagic.load()
-        except AttributeError:
-            mymagic = magic.Magic(mime)
-            mymagic.file = mymagic.from_file
-        return mymagic.file(indata)
+        return magic_helper.from_file(indata, mime)
 
     @staticmethod
     def io_md5(target):
@@ -195,7 +234,7 @@ class Extractor(object):
     def extract(self):
         """
         Perform extraction of firmware updates from input to tarballs in output
-        directory using a thread pool.
+        directory using a process pool.
         """
         if os.path.isdir(self._input):
             for path, _, files in os.walk(self._input):
@@ -209,12 +248,116 @@ class Extractor(object):
         if self.output_dir and not os.path.isdir(self.output_dir):
             os.makedirs(self.output_dir)
 
-        if self._pool:
-            self._pool.map(self._extract_item, self._list)
+        if self.scheduled:
+            with concurrent.futures.ProcessPoolExecutor() as pool:
+                with multiprocessing.Manager() as manager:
+                    self.visited = manager.dict()
+                    try:
+                        self._schedule(pool)
+                    finally:
+                        self.visited = dict(self.visited)
         else:
             for item in self._list:
                 self._extract_item(item)
 
+    def _schedule(self, pool):
+        """
+        Run every item as a task on the pool. Items nested in archives or
+        compressed files are submitted as tasks of their own, and once a
+        task produces everything for its tag, pending tasks for that tag are
+        cancelled. Running ones stop at their next status check.
+        """
+        # Map of future to (tag, depth, ancestor checksums, parent temp dirs)
+        tasks = {}
+        # Map of temp dirs to number of children still extracting from them
+        temps = {}
+
+        def submit(path, depth, tag, parents, group):
+            future = pool.submit(self._extract_task, path, depth, tag)
+            tasks[future] = (tag, depth, parents, group)
+
+        def release(group):
+            if group:
+                temps[group] -= 1
+                if not temps[group]:
+                    del temps[group]
+                    for temp in group:
+                        Extractor.io_rm(temp)
+
+        for path in self._list:
+            submit(path, 0, None, [], None)
+
+        while tasks:
+            done, _ = concurrent.futures.wait(
+                tasks, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                tag, depth, parents, parent_group = tasks.pop(future)
+
+                try:
+                    result = future.result()
+                except concurrent.futures.CancelledError:
+                    result = None
+                except Exception:
+                    traceback.print_exc()
+                    result = None
+
+                if result:
+                    tag = result.tag
+
+                    # every ancestor of the item that found the rootfs maps to
+                    # it as well
+                    if result.produced and result.rootfs and self.cache:
+                        for checksum in parents:
+                            self.cache.put_rootfs(checksum, result.rootfs)
+
+                    group = tuple(result.temps)
+
+                    if result.complete:
+                        for other, task in tasks.items():
+                            if task[0] == tag:
+                                other.cancel()
+                    elif result.children:
+                        temps[group] = len(result.children)
+                        for child in result.children:
+                            submit(
+                                child,
+                                depth + 1,
+                                tag,
+                                parents + [result.checksum],
+                                group,
+                            )
+
+                    if group not in temps:
+                        for temp in group:
+                            Extractor.io_rm(temp)
+
+                release(parent_group)
+
+    def _extract_task(self, path, depth, tag):
+        """
+        Extract a single item on a worker. Nested items are not recursed into,
+        but returned to the scheduler along with the temporary directories
+        holding them, which the scheduler removes once they are done.
+        """
+        ext_item = ExtractionItem(self, path, depth, tag)
+        ext_item.extract()
+        ext_item.update_status()
+
+        # hand the temporary directories over to the scheduler
+        if ext_item.children:
+            ext_item.adopt(ext_item)
+
+        return TaskResult(
+            all(ext_item.status),
+            ext_item.produced,
+            ext_item.tag,
+            ext_item.checksum,
+            ext_item.get_rootfs_path(),
+            ext_item.temps,
+            ext_item.children,
+        )
+
     def _extract_item(self, path):
         """
         Wrapper function that creates an ExtractionItem and calls the extract()
@@ -228,6 +371,16 @@ class Extractor(object):
         ext_item.extract()
 
 
+# Single binwalk signature result, tagged with the analysis category it matched
+ScanEntry = collections.namedtuple("ScanEntry", ["offset", "description", "category"])
+
+# Outcome of an item extracted by the scheduler
+TaskResult = collections.namedtuple(
+    "TaskResult",
+    ["complete", "produced", "tag", "checksum", "rootfs", "temps", "children"],
+)
+
+
 class ExtractionItem(object):
     """
     Class that encapsulates the state of a single item that is being extracted.
@@ -237,7 +390,11 @@ class ExtractionItem(object):
     RECURSION_BREADTH = 5
     RECURSION_DEPTH = 3
 
-    def __init__(self, extractor, path, depth, tag=None):
+    # Signature categories, matched against result descriptions in the same
+    # way as binwalk's '-y' include filter
+    SCAN_CATEGORIES = ["header", "kernel", "filesystem", "archive", "compressed"]
+
+    def __init__(self, extractor, path, depth, tag=None, checksum=None):
         # Temporary directory
         self.temp = None
 
@@ -250,8 +407,8 @@ class ExtractionItem(object):
         # File path
         self.item = path
 
-        # Checksum
-        self.checksum = Extractor.io_md5(path)
+        # Checksum, reused if already computed while carving this item
+        self.checksum = checksum if checksum else Extractor.io_md5(path)
 
         # Tag
         self.tag = tag if tag else self.generate_tag()
@@ -263,6 +420,16 @@ class ExtractionItem(object):
             else None
         )
 
+        # Signature table, populated once by scan()
+        self.signatures = None
+
+        # Nested items deferred to the scheduler, the temporary directories
+        # holding them, and whether this item (or one of its nested items)
+        # produced the rootfs
+        self.children = []
+        self.temps = []
+        self.produced = False
+
         # Status, with terminate indicating early termination for this item
         self.terminate = False
         self.status = None
@@ -308,7 +475,7 @@ class ExtractionItem(object):
             else not self.extractor.do_kernel
         )
         rootfs_done = (
-            os.path.isfile(self.get_rootfs_path())
+            os.path.exists(self.get_rootfs_path())
             if self.extractor.do_rootfs and self.output
             else not self.extractor.do_rootfs
         )
@@ -332,9 +499,52 @@ class ExtractionItem(object):
     def get_rootfs_path(self):
         """
         Return the full path (including filename) to the output root filesystem
-        file.
+        file or directory.
         """
-        return self.output + ".tar.gz" if self.output else None
+        suffix = Extractor.ROOTFS_FORMATS[self.extractor.rootfs_format]
+        return self.output + suffix if self.output else None
+
+    def scan(self):
+        """
+        Performs a single unfiltered signature scan of this item and builds a
+        table of results, grouped by category. Subsequent calls return the
+        cached table.
+        """
+        if self.signatures is not None:
+            return self.signatures
+
+        cached = (
+            self.extractor.cache.get_scan(self.checksum)
+            if self.extractor.cache
+            else None
+        )
+        if cached is not None:
+            self.signatures = dict(
+                (category, [ScanEntry(*entry) for entry in entries])
+                for category, entries in cached.items()
+            )
+            return self.signatures
+
+        self.signatures = dict((category, []) for category in self.SCAN_CATEGORIES)
+        for module in binwalk.scan(self.item, signature=True, quiet=True):
+            for entry in module.results:
+                description = entry.description.lower()
+                for category in self.SCAN_CATEGORIES:
+                    if category in description:
+                        self.signatures[category].append(
+                            ScanEntry(entry.offset, entry.description, category)
+                        )
+
+        if self.extractor.cache:
+            self.extractor.cache.put_scan(self.checksum, self.signatures)
+
+        return self.signatures
+
+    def get_signatures(self, category):
+        """
+        Return the scan results matching the given category.
+        """
+        return self.scan()[category]
 
     def extract(self):
         """
@@ -355,12 +565,16 @@ class ExtractionItem(object):
 
         # check if checksum is in visited set
         self.printf(">> MD5: %s" % self.checksum)
-        with Extractor.visited_lock:
-            if self.checksum in self.extractor.visited:
-                self.printf(">> Skipping: %s..." % self.checksum)
-                return self.get_status()
-            else:
-                self.extractor.visited.add(self.checksum)
+        if not self.extractor.visit(self.checksum):
+            self.printf(">> Skipping: %s..." % self.checksum)
+            return self.get_status()
+
+        # check if a previous run already extracted a rootfs from this item
+        if self._check_cache():
+            self.printf(">> Skipping: cached!")
+            return self.get_status()
+
+        rootfs_done = self.get_rootfs_status()
 
         # check if filetype is blacklisted
         if self._check_blacklist():
@@ -383,6 +597,10 @@ class ExtractionItem(object):
                 )
             )
 
+            # Move to temporary directory so binwalk does not write to input
+            os.chdir(self.temp)
+            self.scan()
+
             for analysis in [
                 self._check_archive,
                 self._check_firmware,
@@ -390,6 +608,11 @@ class ExtractionItem(object):
                 self._check_rootfs,
                 self._check_compressed,
             ]:
+                # Another task may have completed this tag in the meantime
+                if self.extractor.scheduled and self.update_status():
+                    self.printf(">> Skipping: completed!")
+                    return True
+
                 # Move to temporary directory so binwalk does not write to input
                 os.chdir(self.temp)
 
@@ -397,6 +620,10 @@ class ExtractionItem(object):
                 if analysis():
                     if self.update_status():
                         self.printf(">> Skipping: completed!")
+                        # only cache the rootfs if this item produced it
+                        if not rootfs_done and self.get_rootfs_status():
+                            self.produced = True
+                            self._cache_rootfs()
                         return True
 
         except Exception:
@@ -404,6 +631,43 @@ class ExtractionItem(object):
 
         return False
 
+    def adopt(self, item):
+        """
+        Take over the temporary directory of an item whose nested items were
+        deferred to the scheduler, so it outlives the item.
+        """
+        if item is not self:
+            self.children.extend(item.children)
+            self.temps.extend(item.temps)
+        if item.temp:
+            self.temps.append(item.temp)
+            item.temp = None
+
+    def _check_cache(self):
+        """
+        If the extraction cache holds a rootfs for this checksum, link it to
+        the output path.
+        """
+        if (
+            not self.extractor.cache
+            or not self.output
+            or not self.extractor.do_rootfs
+            or self.get_rootfs_status()
+        ):
+            return False
+
+        if self.extractor.cache.fetch_rootfs(self.checksum, self.output):
+            return self.update_status()
+
+        return False
+
+    def _cache_rootfs(self):
+        """
+        Store the rootfs extracted for this item in the extraction cache.
+        """
+        if self.extractor.cache and self.get_rootfs_path():
+            self.extractor.cache.put_rootfs(self.checksum, self.get_rootfs_path())
+
     def _check_blacklist(self):
         """
         Check if this file is blacklisted for analysis based on file type.
@@ -464,106 +728,113 @@ class ExtractionItem(object):
         If this file is of a known firmware type, directly attempt to extract
         the kernel and root filesystem.
         """
-        for module in binwalk.scan(
-            self.item, "-y", "header", signature=True, quiet=True
-        ):
-            for entry in module.results:
-                # uImage
-                if "uImage header" in entry.description:
-                    if (
-                        not self.get_kernel_status()
-                        and "OS Kernel Image" in entry.description
-                    ):
-                        kernel_offset = entry.offset + 64
-                        kernel_size = 0
-
-                        for stmt in entry.description.split(","):
-                            if "image size:" in stmt:
-                                kernel_size = int(
-                                    "".join(i for i in stmt if i.isdigit()), 10
-                                )
-
-                        if (
-                            kernel_size != 0
-                            and kernel_offset + kernel_size
-                            <= os.path.getsize(self.item)
-                        ):
-                            self.printf(">>>> %s" % entry.description)
-
-                            tmp_fd, tmp_path = tempfile.mkstemp(dir=self.temp)
-                            os.close(tmp_fd)
-                            Extractor.io_dd(
-                                self.item, kernel_offset, kernel_size, tmp_path
-                            )
-                            kernel = ExtractionItem(
-                                self.extractor, tmp_path, self.depth, self.tag
-                            )
-
-                            return kernel.extract()
-                    # elif "RAMDisk Image" in entry.description:
-                    #     self.printf(">>>> %s" % entry.description)
-                    #     self.printf(">>>> Skipping: RAMDisk / initrd")
-                    #     self.terminate = True
-                    #     return True
-
-                # TP-Link or TRX
-                elif (
+        for entry in self.get_signatures("header"):
+            # uImage
+            if "uImage header" in entry.description:
+                if (
                     not self.get_kernel_status()
-                    and not self.get_rootfs_status()
-                    and "rootfs offset: " in entry.description
-                    and "kernel offset: " in entry.description
+                    and "OS Kernel Image" in entry.description
                 ):
-                    kernel_offset = 0
+                    kernel_offset = entry.offset + 64
                     kernel_size = 0
-                    rootfs_offset = 0
-                    rootfs_size = 0
 
                     for stmt in entry.description.split(","):
-                        if "kernel offset:" in stmt:
-                            kernel_offset = int(stmt.split(":")[1], 16)
-                        elif "kernel length:" in stmt:
-                            kernel_size = int(stmt.split(":")[1], 16)
-                        elif "rootfs offset:" in stmt:
-                            rootfs_offset = int(stmt.split(":")[1], 16)
-                        elif "rootfs length:" in stmt:
-                            rootfs_size = int(stmt.split(":")[1], 16)
-
-                    # compute sizes if only offsets provided
-                    if (
-                        kernel_offset != rootfs_size
-                        and kernel_size == 0
-                        and rootfs_size == 0
-                    ):
-                        kernel_size = rootfs_offset - kernel_offset
-                        rootfs_size = os.path.getsize(self.item) - rootfs_offset
+                        if "image size:" in stmt:
+                            kernel_size = int(
+                                "".join(i for i in stmt if i.isdigit()), 10
+                            )
 
-                    # ensure that computed values are sensible
                     if (
-                        kernel_size > 0
+                        kernel_size != 0
                         and kernel_offset + kernel_size <= os.path.getsize(self.item)
-                    ) and (
-                        rootfs_size != 0
-                        and rootfs_offset + rootfs_size <= os.path.getsize(self.item)
                     ):
                         self.printf(">>>> %s" % entry.description)
 
                         tmp_fd, tmp_path = tempfile.mkstemp(dir=self.temp)
                         os.close(tmp_fd)
-                        Extractor.io_dd(self.item, kernel_offset, kernel_size, tmp_path)
+                        checksum = Extractor.io_dd(
+                            self.item, kernel_offset, kernel_size, tmp_path
+                        )
                         kernel = ExtractionItem(
-                            self.extractor, tmp_path, self.depth, self.tag
+                            self.extractor, tmp_path, self.depth, self.tag, checksum
                         )
-                        kernel.extract()
 
-                        tmp_fd, tmp_path = tempfile.mkstemp(dir=self.temp)
-                        os.close(tmp_fd)
-                        Extractor.io_dd(self.item, rootfs_offset, rootfs_size, tmp_path)
-                        rootfs = ExtractionItem(
-                            self.extractor, tmp_path, self.depth, self.tag
-                        )
-                        rootfs.extract()
+                        done = kernel.extract()
+                        if kernel.children:
+                            self.adopt(kernel)
+                        return done
+                # elif "RAMDisk Image" in entry.description:
+                #     self.printf(">>>> %s" % entry.description)
+                #     self.printf(">>>> Skipping: RAMDisk / initrd")
+                #     self.terminate = True
+                #     return True
+
+            # TP-Link or TRX
+            elif (
+                not self.get_kernel_status()
+                and not self.get_rootfs_status()
+                and "rootfs offset: " in entry.description
+                and "kernel offset: " in entry.description
+            ):
+                kernel_offset = 0
+                kernel_size = 0
+                rootfs_offset = 0
+                rootfs_size = 0
+
+                for stmt in entry.description.split(","):
+                    if "kernel offset:" in stmt:
+                        kernel_offset = int(stmt.split(":")[1], 16)
+                    elif "kernel length:" in stmt:
+                        kernel_size = int(stmt.split(":")[1], 16)
+                    elif "rootfs offset:" in stmt:
+                        rootfs_offset = int(stmt.split(":")[1], 16)
+                    elif "rootfs length:" in stmt:
+                        rootfs_size = int(stmt.split(":")[1], 16)
+
+                # compute sizes if only offsets provided
+                if (
+                    kernel_offset != rootfs_size
+                    and kernel_size == 0
+                    and rootfs_size == 0
+                ):
+                    kernel_size = rootfs_offset - kernel_offset
+                    rootfs_size = os.path.getsize(self.item) - rootfs_offset
+
+                # ensure that computed values are sensible
+                if (
+                    kernel_size > 0
+                    and kernel_offset + kernel_size <= os.path.getsize(self.item)
+                ) and (
+                    rootfs_size != 0
+                    and rootfs_offset + rootfs_size <= os.path.getsize(self.item)
+                ):
+                    self.printf(">>>> %s" % entry.description)
 
-                        return self.update_status()
+                    tmp_fd, tmp_path = tempfile.mkstemp(dir=self.temp)
+                    os.close(tmp_fd)
+                    checksum = Extractor.io_dd(
+                        self.item, kernel_offset, kernel_size, tmp_path
+                    )
+                    kernel = ExtractionItem(
+                        self.extractor, tmp_path, self.depth, self.tag, checksum
+                    )
+                    kernel.extract()
+                    if kernel.children:
+                        self.adopt(kernel)
+
+                    tmp_fd, tmp_path = tempfile.mkstemp(dir=self.temp)
+                    os.close(tmp_fd)
+                    checksum = Extractor.io_dd(
+                        self.item, rootfs_offset, rootfs_size, tmp_path
+                    )
+                    rootfs = ExtractionItem(
+                        self.extractor, tmp_path, self.depth, self.tag, checksum
+                    )
+                    rootfs.extract()
+                    if rootfs.children:
+                        self.adopt(rootfs)
+
+                    return self.update_status()
         return False
 
     def _check_kernel(self):
@@ -572,23 +843,19 @@ class ExtractionItem(object):
         Only Linux kernels are currently extracted.
         """
         if not self.get_kernel_status():
-            for module in binwalk.scan(
-                self.item, "-y", "kernel", signature=True, quiet=True
-            ):
-                for entry in module.results:
-                    if "kernel version" in entry.description:
-                        if "Linux" in entry.description:
-                            if self.get_kernel_path():
-                                shutil.copy(self.item, self.get_kernel_path())
-                            else:
-                                self.extractor.do_kernel = False
-                            self.printf(">>>> %s" % entry.description)
-                            return True
-                        # VxWorks, etc
+            for entry in self.get_signatures("kernel"):
+                if "kernel version" in entry.description:
+                    if "Linux" in entry.description:
+                        if self.get_kernel_path():
+                            shutil.copy(self.item, self.get_kernel_path())
                         else:
-                            self.printf(">>>> Ignoring: %s" % entry.description)
-                            return False
-                return False
+                            self.extractor.do_kernel = False
+                        self.printf(">>>> %s" % entry.description)
+                        return True
+                    # VxWorks, etc
+                    else:
+                        self.printf(">>>> Ignoring: %s" % entry.description)
+                        return False
         return False
 
     def _check_rootfs(self):
@@ -596,7 +863,8 @@ class ExtractionItem(object):
         If this file contains a known filesystem type, extract it.
         """
 
-        if not self.get_rootfs_status():
+        # only run binwalk extraction if the signature scan found a filesystem
+        if not self.get_rootfs_status() and self.get_signatures("filesystem"):
             for module in binwalk.scan(
                 self.item, "-e", "-r", "-y", "filesystem", signature=True, quiet=True
             ):
@@ -611,14 +879,41 @@ class ExtractionItem(object):
                         self.printf(">>>> Extraction failed!")
                         return False
 
-                    self.printf(">>>> Found Linux filesystem in %s!" % unix[1])
-                    if self.output:
-                        shutil.make_archive(self.output, "gztar", root_dir=unix[1])
-                    else:
-                        self.extractor.do_rootfs = False
+                    self._save_rootfs(unix[1])
                     return True
         return False
 
+    def _save_rootfs(self, root_dir):
+        """
+        Stage or archive an extracted Linux filesystem to the output path.
+        """
+        self.printf(">>>> Found Linux filesystem in %s!" % root_dir)
+        if not self.output:
+            self.extractor.do_rootfs = False
+            return
+
+        # write under a temporary name, so that other tasks polling the
+        # status never see a partially written rootfs
+        tmp_base = "%s.%d" % (self.output, os.getpid())
+
+        if self.extractor.rootfs_format == "dir":
+            try:
+                # the extraction directory is discarded with this item, so
+                # simply move it if it is on the same filesystem
+                os.rename(root_dir, tmp_base)
+            except OSError:
+                shutil.copytree(root_dir, tmp_base, symlinks=True)
+            try:
+                os.rename(tmp_base, self.get_rootfs_path())
+            except OSError:
+                # another task staged it first
+                Extractor.io_rm(tmp_base)
+        else:
+            archive = shutil.make_archive(
+                tmp_base, self.extractor.rootfs_format, root_dir=root_dir
+            )
+            os.replace(archive, self.get_rootfs_path())
+
     def _check_compressed(self):
         """
         If this file appears to be compressed, decompress it and recurse over
@@ -635,6 +930,10 @@ class ExtractionItem(object):
         items.
         """
         desc = None
+        # only run binwalk extraction if the signature scan found this format
+        if not self.get_signatures(fmt):
+            return False
+
         # perform extraction
         for module in binwalk.scan(
             self.item, "-e", "-r", "-y", fmt, signature=True, quiet=True
@@ -655,11 +954,7 @@ class ExtractionItem(object):
 
                 # check for extracted filesystem, otherwise update queue
                 if unix[0]:
-                    self.printf(">>>> Found Linux filesystem in %s!" % unix[1])
-                    if self.output:
-                        shutil.make_archive(self.output, "gztar", root_dir=unix[1])
-                    else:
-                        self.extractor.do_rootfs = False
+                    self._save_rootfs(unix[1])
                     return True
                 else:
                     count = 0
@@ -689,6 +984,10 @@ class ExtractionItem(object):
                                 )
                                 self.terminate = True
                                 return True
+                            elif self.extractor.scheduled:
+                                # defer to the scheduler, which extracts
+                                # nested items in parallel
+                                self.children.append(os.path.join(root, filename))
                             else:
                                 new_item = ExtractionItem(
                                     self.extractor,
@@ -3,21 +3,33 @@ from contextlib import contextmanager
 import tempfile
 import tarfile
 import os
+import re
 import subprocess
 import shutil
 import stat
-import magic
+import struct
+from lib import index_helper
+from lib import magic_helper
+from lib import privileged_helper
+from lib import rootfs_helper
 
 image_name = "image.raw"
 
-# Expects full path to image
+# Expects full path to image and size in bytes
 # make_image_cmd = "qemu-img create -f raw \"{}\" 100M"
-make_image_cmd = 'qemu-img create -f raw "{}" 1G'
+make_image_cmd = 'qemu-img create -q -f raw "{}" {}'
 
-# TODO: Convert this to pyparted commands
-# Expects path to image
-fdisk_cmd = '/sbin/fdisk "{}"'
-partition_cmd_input = b"o\nn\np\n1\n\n\nw"
+# Images are sized from the rootfs footprint. Headroom is a ratio of that
+# footprint, never less than the minimum, for files written at build or run time.
+image_headroom = float(os.environ.get("FW_EMULATOR_IMAGE_HEADROOM", 0.5))
+image_min_headroom = 64 * 1024 ** 2
+image_alignment = 1024 ** 2
+
+# Single primary Linux partition, laid out the way fdisk does by default
+sector_size = 512
+partition_start = 2048
+partition_type = 0x83
+mbr_signature = b"\x55\xaa"
 
 # Mount qemu image
 # Expects path to image
@@ -39,6 +51,15 @@ fix_image_path = "scripts/fixImage.sh"
 # Expects mount_path
 fix_image_command = 'sudo chroot "{}" /busybox ash /fixImage.sh'
 
+# Rootless backend, run as root of a user namespace rather than through sudo
+# Expects staging path
+rootless_fix_image_command = 'unshare -r chroot "{}" /busybox ash /fixImage.sh'
+# Expects partition offset, staging path, image path, filesystem size in KB
+populate_cmd = 'unshare -r mke2fs -q -F -t ext2 -E offset={} -d "{}" "{}" {}k'
+# Expects command file, image path and partition offset
+debugfs_cmd = 'debugfs -w -f "{}" "{}?offset={}"'
+staging_dir = "staging"
+
 # Console
 console_name = "console.{}"
 console_mount_path = "firmadyne/console"
@@ -66,89 +87,249 @@ dmsetup_cmd = "sudo dmsetup remove {}"
 
 chown_cmd = "sudo chown -R {}:{} {}"
 
+# "helper" sends the privileged steps above to a helper started once with sudo,
+# see privileged_helper, "sudo" runs each command with sudo
+privileged_backend = os.environ.get("FW_EMULATOR_PRIVILEGED_BACKEND", "helper")
+
 # Main directory
 parent_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
 
+class ImageEditSession(object):
+    """
+    Queues edits to an image and applies them all in one mount. Nothing is
+    written before commit, and discard drops whatever was queued.
+    """
+
+    def __init__(self, work_dir, image_path, mount_path=None):
+        self.work_dir = work_dir
+        self.image_path = image_path
+        # Reuse an existing mount rather than mounting again
+        self.mount_path = mount_path
+        self.edits = []
+
+    def __len__(self):
+        return len(self.edits)
+
+    def queue(self, edit, *args):
+        self.edits.append((edit, args))
+        return self
+
+    def add_file(self, local_file, result_path):
+
+        if not os.path.exists(local_file):
+            raise RuntimeError("No local file {}".format(local_file))
+
+        return self.queue(apply_add_file, local_file, result_path)
+
+    def del_file(self, file_path):
+        return self.queue(apply_del_file, file_path)
+
+    def remove_root_passwd(self):
+        return self.queue(apply_remove_root_passwd)
+
+    def replace_tty_login(self):
+        return self.queue(apply_replace_tty_login)
+
+    def force_networking(self):
+        return self.queue(apply_force_networking)
+
+    def set_nvram(self, values):
+        return self.queue(apply_set_nvram, values)
+
+    def discard(self):
+        self.edits = []
+
+    def commit(self):
+
+        edits, self.edits = self.edits, []
+
+        if not edits:
+            return
+
+        logging.debug("Applying {} queued image edits".format(len(edits)))
+
+        if self.mount_path:
+            self.apply(self.mount_path, edits)
+            return
+
+        with mounted(self.work_dir, self.image_path) as fs_path:
+            self.apply(fs_path, edits)
+
+    def apply(self, fs_path, edits):
+
+        index = index_helper.load_index(self.image_path)
+
+        apply_edits(fs_path, edits, index)
+
+        if index is not None:
+            index.save(index_helper.get_index_path(self.image_path))
+
+
+@contextmanager
+def edit_session(work_dir, image_path, mount_path=None):
+
+    session = ImageEditSession(work_dir, image_path, mount_path)
+
+    yield session
+
+    session.commit()
+
+
+def apply_edits(fs_path, edits, index=None):
+
+    for edit, args in edits:
+        edit(fs_path, index, *args)
+
+
 def force_networking(work_dir, image_path):
 
+    with edit_session(work_dir, image_path) as session:
+        session.force_networking()
+
+
+def apply_force_networking(fs_path, index=None):
+
     force_script = "scripts/force_network.sh"
     force_path = os.path.join(parent_directory, force_script)
 
     run_cmd = "\n/bin/sh /firmadyne/force_network.sh &\n"
 
-    add_file(work_dir, image_path, force_path, "/firmadyne/force_network.sh")
+    apply_add_file(fs_path, index, force_path, "/firmadyne/force_network.sh")
 
     rcs_file = "rcS"
 
-    with mounted(work_dir, image_path) as fs_path:
+    # Append to preInit
+    pre_init_mounted = os.path.join(fs_path, pre_init_mount_path)
+    os.chmod(pre_init_mounted, 0o777)
+    with open(pre_init_mounted, "a") as f:
+        f.write(run_cmd)
+    update_index(fs_path, index, pre_init_mounted)
+
+    # Append to rcS
+    rcs_files = classify_files(fs_path, lambda file_name: file_name == rcs_file, index)
+    for file_path, file_type in rcs_files.items():
+        if file_type and "ASCII text" in file_type:
+            os.chmod(file_path, stat.S_IWRITE)
+            with open(file_path, "a") as f:
+                f.write(run_cmd)
+            update_index(fs_path, index, file_path)
+
+
+# Override nvram values, read by libnvram before its defaults
+def set_nvram(work_dir, image_path, values):
+
+    with edit_session(work_dir, image_path) as session:
+        session.set_nvram(values)
 
-        # Append to preInit
-        pre_init_mounted = os.path.join(fs_path, pre_init_mount_path)
-        os.chmod(pre_init_mounted, 0o777)
-        with open(pre_init_mounted, "a") as f:
-            f.write(run_cmd)
 
-        # Append to rcS
-        for path, subdir, files in os.walk(fs_path):
-            for file_name in files:
-                if file_name == rcs_file:
-                    file_path = os.path.join(path, file_name)
-                    if "ASCII text" in magic.from_file(file_path):
-                        os.chmod(file_path, stat.S_IWRITE)
-                        with open(file_path, "a") as f:
-                            f.write(run_cmd)
+def apply_set_nvram(fs_path, index, values):
+
+    override_dir = os.path.join(fs_path, base_path, override_path)
+    os.makedirs(override_dir, exist_ok=True)
+
+    for key, value in values.items():
+        logging.debug("Setting nvram {}={}".format(key, value))
+        key_path = os.path.join(override_dir, key)
+        with open(key_path, "w") as f:
+            f.write(value)
+        update_index(fs_path, index, key_path)
 
 
 # Find shadow and passwd files and strip passwords
 def remove_root_passwd(work_dir, image_path):
 
+    with edit_session(work_dir, image_path) as session:
+        session.remove_root_passwd()
+
+
+def apply_remove_root_passwd(fs_path, index=None):
+
     logging.debug("Removing root passwd from shadow and passwd")
     passwd_files = ["shadow", "passwd"]
 
-    with mounted(work_dir, image_path) as fs_path:
-        for path, subdir, files in os.walk(fs_path):
-            for file_name in files:
-                if any(x in file_name for x in passwd_files):
-                    file_path = os.path.join(path, file_name)
-                    if magic.from_file(file_path) == "ASCII text":
-                        lines = []
-                        with open(file_path, "r") as f:
-                            lines = f.readlines()
-                        os.chmod(file_path, stat.S_IWRITE)
-                        with open(file_path, "w") as f:
-                            for line in lines:
-                                if "root:" in line:
-                                    if file_name == "passwd":
-                                        f.write("root::0:0:root:/:/bin/sh\n")
-                                    else:
-                                        f.write("root::::::::\n")
-                                else:
-                                    f.write(line)
+    candidates = classify_files(
+        fs_path, lambda file_name: any(x in file_name for x in passwd_files), index
+    )
+    for file_path, file_type in candidates.items():
+        if file_type == "ASCII text":
+            file_name = os.path.basename(file_path)
+            lines = []
+            with open(file_path, "r") as f:
+                lines = f.readlines()
+            os.chmod(file_path, stat.S_IWRITE)
+            with open(file_path, "w") as f:
+                for line in lines:
+                    if "root:" in line:
+                        if file_name == "passwd":
+                            f.write("root::0:0:root:/:/bin/sh\n")
+                        else:
+                            f.write("root::::::::\n")
+                    else:
+                        f.write(line)
+            update_index(fs_path, index, file_path)
 
 
 # Replace tty respawning
 def replace_tty_login(work_dir, image_path):
 
+    with edit_session(work_dir, image_path) as session:
+        session.replace_tty_login()
+
+
+def apply_replace_tty_login(fs_path, index=None):
+
     logging.debug("Replacing default ttyS0 program to /bin/sh")
     init_file = "inittab"
 
-    with mounted(work_dir, image_path) as fs_path:
-        for path, subdir, files in os.walk(fs_path):
-            for file_name in files:
-                if file_name == init_file:
-                    file_path = os.path.join(path, file_name)
-                    if magic.from_file(file_path) == "ASCII text":
-                        lines = []
-                        with open(file_path, "r") as f:
-                            lines = f.readlines()
-                        os.chmod(file_path, stat.S_IWRITE)
-                        with open(file_path, "w") as f:
-                            for line in lines:
-                                if "ttyS0" in line:
-                                    f.write("ttyS0::respawn:/bin/sh\n")
-                                else:
-                                    f.write(line)
+    candidates = classify_files(
+        fs_path, lambda file_name: file_name == init_file, index
+    )
+    for file_path, file_type in candidates.items():
+        if file_type == "ASCII text":
+            lines = []
+            with open(file_path, "r") as f:
+                lines = f.readlines()
+            os.chmod(file_path, stat.S_IWRITE)
+            with open(file_path, "w") as f:
+                for line in lines:
+                    if "ttyS0" in line:
+                        f.write("ttyS0::respawn:/bin/sh\n")
+                    else:
+                        f.write(line)
+            update_index(fs_path, index, file_path)
+
+
+# Return the files under fs_path whose name matches, from the index if there
+# is one
+def find_files(fs_path, match, index=None):
+
+    if index is not None:
+        return [os.path.join(fs_path, x.path) for x in index.find(match)]
+
+    matches = []
+
+    for path, subdir, files in os.walk(fs_path):
+        for file_name in files:
+            if match(file_name):
+                matches.append(os.path.join(path, file_name))
+
+    return matches
+
+
+# Return the magic of each file under fs_path whose name matches
+def classify_files(fs_path, match, index=None):
+
+    if index is not None:
+        return {os.path.join(fs_path, x.path): x.magic for x in index.find(match)}
+
+    return magic_helper.from_files(find_files(fs_path, match))
+
+
+def update_index(fs_path, index, file_path):
+
+    if index is not None:
+        index.update(fs_path, os.path.relpath(file_path, fs_path))
 
 
 @contextmanager
@@ -160,53 +341,74 @@ def mounted(work_dir, image_path):
 
     fix_permissions(work_dir)
 
-    yield mount_path
-
-    cleanup_image_and_device(image_path, device)
+    try:
+        yield mount_path
+    finally:
+        cleanup_image_and_device(image_path, device)
 
 
 def del_file(work_dir, image_path, file_path):
 
+    with edit_session(work_dir, image_path) as session:
+        session.del_file(file_path)
+
+
+def apply_del_file(fs_path, index, file_path):
+
     logging.debug("Deleting file {}".format(file_path))
     file_path = file_path.lstrip("/")
 
-    with mounted(work_dir, image_path) as fs_path:
-        temp_path = os.path.join(fs_path, file_path)
-        print(temp_path)
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        elif os.path.islink(temp_path):
-            os.unlink(temp_path)
-        else:
-            logging.warning("Can't delete file {}".format(file_path))
+    temp_path = os.path.join(fs_path, file_path)
+    print(temp_path)
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    elif os.path.islink(temp_path):
+        os.unlink(temp_path)
+    else:
+        logging.warning("Can't delete file {}".format(file_path))
+
+    if index is not None:
+        index.remove(file_path)
 
 
 def add_file(work_dir, image_path, local_file, result_path):
 
+    with edit_session(work_dir, image_path) as session:
+        session.add_file(local_file, result_path)
+
+
+def apply_add_file(fs_path, index, local_file, result_path):
+
     result_path = result_path.lstrip("/")
 
-    if not os.path.exists(local_file):
-        raise RuntimeError("No local file {}".format(local_file))
+    temp_path = os.path.join(fs_path, result_path)
+    if os.path.isdir(local_file):
+        shutil.copytree(local_file, temp_path)
+    else:
+        shutil.copy(local_file, temp_path)
+
+    if index is not None:
+        index.update(fs_path, result_path)
 
-    with mounted(work_dir, image_path) as fs_path:
-        temp_path = os.path.join(fs_path, result_path)
-        if os.path.isdir(local_file):
-            shutil.copytree(local_file, temp_path)
-        else:
-            shutil.copy(local_file, temp_path)
 
+def make_image(
+    root_fs_tar, arch, work_dir, rootless=False, image_size=None, headroom=None
+):
 
-def make_image(root_fs_tar, arch, work_dir):
+    # Staged directory or tar, consumed directly without an intermediate copy
+    root_fs = rootfs_helper.open_artifact(root_fs_tar)
 
-    if isinstance(root_fs_tar, str):
-        logging.info("root_fs_tar was string, converted to tarfile")
-        root_fs_tar = tarfile.open(root_fs_tar)
+    if image_size is None:
+        image_size = get_image_size(root_fs, headroom)
+
+    if rootless:
+        return make_image_rootless(root_fs, arch, work_dir, image_size)
 
     # work_dir = tempfile.TemporaryDirectory()
 
     image_path = os.path.join(work_dir, image_name)
 
-    create_image(image_path)
+    create_image(image_path, image_size)
 
     make_partition_table(image_path)
 
@@ -218,7 +420,7 @@ def make_image(root_fs_tar, arch, work_dir):
 
     fix_permissions(work_dir)
 
-    root_fs_tar.extractall(path=mount_path)
+    root_fs.extract_to(mount_path)
 
     make_firmadyne_dirs(mount_path)
 
@@ -226,13 +428,131 @@ def make_image(root_fs_tar, arch, work_dir):
 
     setup_firmadyne(mount_path, arch)
 
+    index_helper.build_index(mount_path, image_path)
+
     cleanup_image_and_device(image_path, device)
 
     return image_path
 
 
+# Build the image from a staged directory, without loop devices, mounts or sudo
+def make_image_rootless(root_fs, arch, work_dir, image_size):
+
+    image_path = os.path.join(work_dir, image_name)
+    staging_path = os.path.join(work_dir, staging_dir)
+
+    os.mkdir(staging_path)
+
+    try:
+        root_fs.extract_to(staging_path)
+
+        make_firmadyne_dirs(staging_path)
+
+        patch_filesystem(staging_path, rootless_fix_image_command)
+
+        setup_firmadyne(staging_path, arch)
+
+        index_helper.build_index(staging_path, image_path)
+
+        create_image(image_path, image_size)
+
+        make_partition_table(image_path)
+
+        populate_image(image_path, staging_path)
+
+        make_device_nodes(image_path, staging_path)
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+    return image_path
+
+
+def get_partition_offset():
+
+    return partition_start * sector_size
+
+
+def populate_image(image_path, staging_path):
+
+    fs_size = os.path.getsize(image_path) - get_partition_offset()
+
+    populate_run_cmd = populate_cmd.format(
+        get_partition_offset(), staging_path, image_path, fs_size // 1024
+    )
+
+    subprocess.check_call(populate_run_cmd, shell=True)
+
+
+# Device nodes can't be created without privileges, so write them straight
+# into the filesystem with debugfs. The list is taken from fixImage.sh.
+def make_device_nodes(image_path, staging_path):
+
+    dev_path = os.path.join(staging_path, "dev")
+
+    device_count = 0
+    if os.path.isdir(dev_path):
+        for file_name in os.listdir(dev_path):
+            mode = os.lstat(os.path.join(dev_path, file_name)).st_mode
+            if stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+                device_count += 1
+
+    if device_count >= 5:
+        return
+
+    logging.debug("Recreating device nodes with debugfs")
+
+    with open(os.path.join(parent_directory, fix_image_path)) as f:
+        fix_image = f.read()
+
+    commands = ["mkdir /dev"]
+
+    for line in fix_image.splitlines():
+        line = line.strip()
+
+        mkdir = re.match(r"^mkdir -p (/dev/\S+)$", line)
+        if mkdir:
+            commands.append("mkdir {}".format(mkdir.group(1)))
+            continue
+
+        mknod = re.match(r"^mknod -m (\d+) (\S+) ([cb]) (\d+) (\d+)$", line)
+        if mknod:
+            perm, node, kind, major, minor = mknod.groups()
+            node_dir, node_name = os.path.split(node)
+            node_type = stat.S_IFCHR if kind == "c" else stat.S_IFBLK
+            # debugfs links new nodes into its working directory
+            commands.append("cd {}".format(node_dir))
+            commands.append("mknod {} {} {} {}".format(node_name, kind, major, minor))
+            commands.append(
+                "sif {} mode 0{:o}".format(node_name, node_type | int(perm, 8))
+            )
+
+    with tempfile.NamedTemporaryFile("w", suffix=".debugfs") as command_file:
+        command_file.write("\n".join(commands) + "\n")
+        command_file.flush()
+
+        debugfs_run_cmd = debugfs_cmd.format(
+            command_file.name, image_path, get_partition_offset()
+        )
+
+        subprocess.check_call(
+            debugfs_run_cmd,
+            shell=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+def use_helper():
+
+    return privileged_backend == "helper"
+
+
 def fix_permissions(mount_path):
 
+    if use_helper():
+        privileged_helper.get_client().chown(mount_path)
+        return
+
     username = os.environ["USER"]
 
     fix_chown = chown_cmd.format(username, username, mount_path)
@@ -242,6 +562,10 @@ def fix_permissions(mount_path):
 
 def mkfs_device(device):
 
+    if use_helper():
+        privileged_helper.get_client().mkfs(device)
+        return
+
     mkfs_run_cmd = mkfs_cmd.format(device)
 
     subprocess.check_call(mkfs_run_cmd, shell=True)
@@ -251,6 +575,14 @@ def mkfs_device(device):
 
 def cleanup_image_and_device(image_path, device):
 
+    if use_helper():
+        try:
+            for error in privileged_helper.get_client().detach(image_path):
+                print(error)
+        except RuntimeError as e:
+            print(e)
+        return
+
     umount_cmd_cleanup = umount_cmd.format(device)
     kpartx_cmd_cleanup = kpartx_cmd.format(image_path)
     # losetup_cmd_cleanup = losetup_cmd.format(device)
@@ -321,7 +653,7 @@ def get_nvram(arch):
     return os.path.join(binary_folder, nvram_arch)
 
 
-def patch_filesystem(mount_path):
+def patch_filesystem(mount_path, fix_command=fix_image_command):
 
     busybox_path = shutil.which("busybox")
 
@@ -331,7 +663,9 @@ def patch_filesystem(mount_path):
 
     shutil.copyfile(busybox_path, busybox_mount_path)
 
-    shutil.copyfile(fix_image_path, fix_image_mount_path)
+    shutil.copyfile(
+        os.path.join(parent_directory, fix_image_path), fix_image_mount_path
+    )
 
     # chmod a+x
     all_exec = stat.S_IXGRP | stat.S_IXOTH | stat.S_IXUSR
@@ -339,9 +673,12 @@ def patch_filesystem(mount_path):
     os.chmod(busybox_mount_path, all_exec)
     os.chmod(fix_image_mount_path, all_exec)
 
-    fix_image_cmd = fix_image_command.format(mount_path)
+    if fix_command == fix_image_command and use_helper():
+        privileged_helper.get_client().fixup(mount_path)
+    else:
+        fix_image_cmd = fix_command.format(mount_path)
 
-    subprocess.check_call(fix_image_cmd, shell=True)
+        subprocess.check_call(fix_image_cmd, shell=True)
 
     # Cleanup patch
     os.remove(busybox_mount_path)
@@ -379,6 +716,10 @@ def make_mount_path(work_dir, device):
     if not os.path.exists(mount_path):
         os.mkdir(mount_path)
 
+    if use_helper():
+        privileged_helper.get_client().mount(device, mount_path)
+        return mount_path
+
     mount_cmd = mount_format.format(device, mount_path)
 
     subprocess.check_call(mount_cmd, shell=True)
@@ -388,33 +729,74 @@ def make_mount_path(work_dir, device):
 
 def get_mounted_device(image_path):
 
-    mount_cmd = kpart_cmd.format(image_path)
+    if use_helper():
+        device = privileged_helper.get_client().attach(image_path)
+    else:
+        mount_cmd = kpart_cmd.format(image_path)
 
-    proc_output = subprocess.check_output(mount_cmd, shell=True)
+        proc_output = subprocess.check_output(mount_cmd, shell=True)
 
-    loop_device = proc_output.decode("UTF-8").split()[2]
+        loop_device = proc_output.decode("UTF-8").split()[2]
 
-    device = mapper_str.format(loop_device)
+        device = mapper_str.format(loop_device)
 
     print("[+] loop device at {}".format(device))
 
     return device
 
 
-def create_image(image_path):
+def get_image_size(root_fs, headroom=None):
 
-    image_cmd = make_image_cmd.format(image_path)
+    if headroom is None:
+        headroom = image_headroom
 
-    subprocess.check_call(image_cmd, shell=True)
+    footprint = root_fs.footprint()
 
+    fs_size = footprint + max(int(footprint * headroom), image_min_headroom)
 
-def make_partition_table(image_path):
+    image_size = get_partition_offset() + fs_size
+    image_size += -image_size % image_alignment
+
+    logging.debug(
+        "Rootfs footprint {} bytes, image size {} bytes".format(footprint, image_size)
+    )
 
-    partition_table_cmd = fdisk_cmd.format(image_path)
+    return image_size
 
-    proc = subprocess.Popen(partition_table_cmd, stdin=subprocess.PIPE, shell=True)
 
-    proc.communicate(partition_cmd_input)
+# Created sparse, only blocks the filesystem writes take up space
+def create_image(image_path, image_size):
 
-    if proc.returncode != 0:
+    image_cmd = make_image_cmd.format(image_path, image_size)
+
+    subprocess.check_call(image_cmd, shell=True)
+
+
+# Write an MBR with one Linux partition spanning the rest of the image
+def make_partition_table(image_path):
+
+    sectors = os.path.getsize(image_path) // sector_size - partition_start
+
+    if sectors <= 0:
         raise (RuntimeError("Make partition table failed"))
+
+    # Status, CHS start, type, CHS end (CHS unused, LBA only), LBA start, sectors
+    partition_entry = struct.pack(
+        "<B3sB3sII",
+        0x00,
+        b"\xfe\xff\xff",
+        partition_type,
+        b"\xfe\xff\xff",
+        partition_start,
+        sectors,
+    )
+
+    with open(image_path, "r+b") as f:
+        # Disk identifier
+        f.seek(440)
+        f.write(os.urandom(4))
+        # First partition entry, the remaining three are left empty
+        f.seek(446)
+        f.write(partition_entry)
+        f.seek(510)
+        f.write(mbr_signature)
@@ -0,0 +1,193 @@
+import collections
+import json
+import logging
+import os
+import stat
+import tempfile
+from lib import magic_helper
+
+# Written next to the image
+index_suffix = ".index"
+index_version = 1
+
+# One entry per file in the image, path is relative to the root
+Entry = collections.namedtuple(
+    "Entry", ["path", "type", "size", "mode", "target", "magic"]
+)
+
+file_types = [
+    (stat.S_ISREG, "f"),
+    (stat.S_ISDIR, "d"),
+    (stat.S_ISLNK, "l"),
+    (stat.S_ISCHR, "c"),
+    (stat.S_ISBLK, "b"),
+    (stat.S_ISFIFO, "p"),
+    (stat.S_ISSOCK, "s"),
+]
+
+
+def get_index_path(image_path):
+
+    return image_path + index_suffix
+
+
+def get_type(mode):
+
+    for is_type, type_name in file_types:
+        if is_type(mode):
+            return type_name
+
+    return "?"
+
+
+class FileIndex(object):
+    """
+    Path, type, size, mode, symlink target and magic class of every file in
+    an image, so lookups don't have to walk the mounted filesystem.
+    """
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        return self.entries.get(normalize(path))
+
+    def find(self, match, file_type="f"):
+        """
+        Returns the entries of type file_type (any type if None) whose base
+        name matches.
+        """
+        return [
+            entry
+            for entry in self.entries.values()
+            if file_type in (None, entry.type) and match(os.path.basename(entry.path))
+        ]
+
+    def update(self, fs_path, path):
+        """
+        Refreshes path, and everything under it, from the root at fs_path.
+        """
+        path = normalize(path)
+        full_path = os.path.join(fs_path, path)
+
+        self.remove(path)
+
+        if not os.path.lexists(full_path):
+            return
+
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            self.entries.update(scan(fs_path, full_path))
+        else:
+            self.add(fs_path, [full_path])
+
+    def remove(self, path):
+
+        path = normalize(path)
+        prefix = path + "/"
+
+        for name in list(self.entries):
+            if name == path or name.startswith(prefix):
+                del self.entries[name]
+
+    def add(self, fs_path, full_paths):
+
+        stats = {}
+        for full_path in full_paths:
+            try:
+                stats[full_path] = os.lstat(full_path)
+            except OSError:
+                continue
+
+        regular = [x for x, st in stats.items() if stat.S_ISREG(st.st_mode)]
+        magics = magic_helper.from_files(regular)
+
+        for full_path, st in stats.items():
+            path = normalize(os.path.relpath(full_path, fs_path))
+            target = None
+            if stat.S_ISLNK(st.st_mode):
+                target = os.readlink(full_path)
+
+            self.entries[path] = Entry(
+                path,
+                get_type(st.st_mode),
+                st.st_size,
+                stat.S_IMODE(st.st_mode),
+                target,
+                magics.get(full_path),
+            )
+
+    def save(self, index_path):
+
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=index_dir)
+        with os.fdopen(tmp_fd, "w") as f:
+            json.dump(
+                {
+                    "version": index_version,
+                    "entries": [list(x) for x in self.entries.values()],
+                },
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, index_path)
+
+
+def normalize(path):
+
+    return os.path.normpath(path).lstrip("/")
+
+
+def scan(fs_path, directory=None):
+
+    index = FileIndex()
+    full_paths = []
+
+    for path, dirs, files in os.walk(directory or fs_path):
+        full_paths.append(path)
+        for file_name in files:
+            full_paths.append(os.path.join(path, file_name))
+        # Symbolic links to directories aren't followed but are indexed
+        for dir_name in dirs:
+            dir_path = os.path.join(path, dir_name)
+            if os.path.islink(dir_path):
+                full_paths.append(dir_path)
+
+    index.add(fs_path, full_paths)
+
+    # The root itself is implied
+    index.entries.pop(".", None)
+
+    return index.entries
+
+
+def build_index(fs_path, image_path):
+    """
+    Indexes the root filesystem at fs_path and saves it next to the image.
+    """
+    index = FileIndex(scan(fs_path))
+
+    index.save(get_index_path(image_path))
+
+    logging.debug("Indexed {} files of {}".format(len(index), image_path))
+
+    return index
+
+
+def load_index(image_path):
+    """
+    Returns the FileIndex of an image, or None if it has none.
+    """
+    try:
+        with open(get_index_path(image_path)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if data.get("version") != index_version:
+        return None
+
+    return FileIndex({x[0]: Entry(*x) for x in data["entries"]})
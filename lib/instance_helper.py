@@ -0,0 +1,257 @@
+import atexit
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import socket
+import tempfile
+
+# Shared by every process on the host, one lock file per instance slot
+instance_dir = os.environ.get(
+    "FW_EMULATOR_INSTANCES", os.path.join("/", "tmp", "firmware_emulator")
+)
+max_instances = int(os.environ.get("FW_EMULATOR_MAX_INSTANCES", 256))
+
+# Slot n listens on base_port + n * ports_per_instance and up. Slot 0 gets the
+# ports and tap names used before instances existed.
+base_port = 2000
+ports_per_instance = 4
+
+# Interface names are limited to 15 characters, leaving room for .vlan
+tap_prefixes = ["tap_", "tap{}_"]
+
+# Network namespace of a slot, tied to the host by a veth pair on a /30 of its
+# own. The namespace end is the address the guest is reached on from the host.
+netns_name = "fw_emu_{}"
+host_veth_name = "fwe{}h"
+netns_veth_name = "fwe{}n"
+# Expects slot then host (1) or namespace (2) end
+transit_address = "10.254.{}.{}"
+
+lock_name = "{}.lock"
+work_name = "{}.work"
+temp_name = "tmp"
+
+# Every user allocates slots in the same directory, so ports and tap names stay
+# unique on the host. Sticky, so users only remove their own files.
+shared_mode = 0o1777
+lock_mode = 0o644
+
+
+class Instance(object):
+    """
+    Host resources of one emulation: socket ports, tap and vlan device
+    names, and a work directory for the serial and QMP sockets, the
+    mount point and per-run files. The slot is held through a lock on a file,
+    so it is released when the process exits, however it exits.
+    """
+
+    def __init__(self, manager, slot, lock_file):
+        self.manager = manager
+        self.slot = slot
+        self.lock_file = lock_file
+        self.work_dir = os.path.join(manager.directory, work_name.format(slot))
+        self.previous_temp = None
+
+        os.makedirs(self.work_dir)
+
+    @property
+    def ports(self):
+        start = base_port + self.slot * ports_per_instance
+        return list(range(start, start + ports_per_instance))
+
+    def get_tap_name(self, index):
+        prefix = tap_prefixes[0] if self.slot == 0 else tap_prefixes[1]
+        return prefix.format(self.slot) + str(index)
+
+    @property
+    def netns(self):
+        return netns_name.format(self.slot)
+
+    @property
+    def veths(self):
+        return host_veth_name.format(self.slot), netns_veth_name.format(self.slot)
+
+    @property
+    def transit_addresses(self):
+        return transit_address.format(self.slot, 1), transit_address.format(
+            self.slot, 2
+        )
+
+    def use_temp_dir(self):
+        """
+        Sends the temporary files of this process (tempfile, and the tools it
+        runs through TMPDIR) to the work directory, so they go with the slot
+        instead of piling up in /tmp.
+        """
+        temp_dir = os.path.join(self.work_dir, temp_name)
+        os.makedirs(temp_dir, exist_ok=True)
+
+        if self.previous_temp is None:
+            self.previous_temp = (tempfile.tempdir, os.environ.get("TMPDIR"))
+
+        tempfile.tempdir = temp_dir
+        os.environ["TMPDIR"] = temp_dir
+
+        return temp_dir
+
+    def restore_temp_dir(self):
+
+        if self.previous_temp is None:
+            return
+
+        tempfile.tempdir, environ_temp = self.previous_temp
+        if environ_temp is None:
+            os.environ.pop("TMPDIR", None)
+        else:
+            os.environ["TMPDIR"] = environ_temp
+        self.previous_temp = None
+
+    def release(self):
+        self.manager.release(self)
+
+    # Copies of a QemuImage share its instance
+    def __deepcopy__(self, memo):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class InstanceManager(object):
+    """
+    Hands out Instances with resources no other emulation on the host uses.
+    """
+
+    def __init__(self, directory=None, max_count=None):
+        self.directory = os.path.abspath(directory or instance_dir)
+        self.max_count = max_instances if max_count is None else max_count
+        self.instances = {}
+
+        os.makedirs(self.directory, exist_ok=True)
+        if os.stat(self.directory).st_uid == os.getuid():
+            os.chmod(self.directory, shared_mode)
+
+        atexit.register(self.release_all)
+
+    def allocate(self):
+
+        for slot in range(self.max_count):
+            if slot in self.instances:
+                continue
+
+            lock_file = self.lock(slot)
+            if lock_file is None:
+                continue
+
+            if not ports_free(base_port + slot * ports_per_instance):
+                lock_file.close()
+                continue
+
+            # Whatever is left belonged to a process that died holding the slot.
+            # It can't be removed if that process left an image mounted, or
+            # files of root or of another user.
+            work_dir = os.path.join(self.directory, work_name.format(slot))
+            shutil.rmtree(work_dir, ignore_errors=True)
+            if os.path.lexists(work_dir):
+                logging.warning(
+                    "Skipping instance {}, {} is left".format(slot, work_dir)
+                )
+                lock_file.close()
+                continue
+
+            instance = Instance(self, slot, lock_file)
+            self.instances[slot] = instance
+
+            logging.debug("Allocated instance {}".format(slot))
+
+            return instance
+
+        raise RuntimeError("No free instance out of {}".format(self.max_count))
+
+    # Returns the locked file of slot, or None if it is taken or can't be used
+    def lock(self, slot):
+
+        path = os.path.join(self.directory, lock_name.format(slot))
+
+        # Read only, so the lock files of other users can be locked too
+        try:
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+            except FileNotFoundError:
+                fd = os.open(
+                    path,
+                    os.O_RDONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                    lock_mode,
+                )
+        except OSError as e:
+            logging.debug("Skipping instance {}: {}".format(slot, e))
+            return None
+
+        lock_file = os.fdopen(fd)
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            lock_file.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+
+        return lock_file
+
+    def release(self, instance):
+
+        if self.instances.pop(instance.slot, None) is None:
+            return
+
+        instance.restore_temp_dir()
+        shutil.rmtree(instance.work_dir, ignore_errors=True)
+
+        # Unlocks the slot
+        instance.lock_file.close()
+
+        logging.debug("Released instance {}".format(instance.slot))
+
+    def release_all(self):
+
+        for instance in list(self.instances.values()):
+            self.release(instance)
+
+
+def ports_free(start, count=ports_per_instance):
+
+    for port in range(start, start + count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind(("", port))
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    return True
+
+
+manager = None
+
+
+def get_manager():
+    """
+    Returns the manager shared by this process.
+    """
+    global manager
+
+    if manager is None:
+        manager = InstanceManager()
+
+    return manager
+
+
+def allocate():
+
+    return get_manager().allocate()
@@ -0,0 +1,85 @@
+import functools
+import os
+import threading
+
+import magic
+
+# Number of classification results memoized per process
+cache_size = 65536
+
+# One loaded libmagic handle per process and mode, keyed by mime flag
+_handles = {}
+_handles_pid = None
+_handles_lock = threading.Lock()
+
+
+def _load_handle(mime):
+    """
+    Loads a libmagic handle while maintaining compatibility with different
+    libraries.
+    """
+    try:
+        if mime:
+            handle = magic.open(magic.MAGIC_MIME_TYPE)
+        else:
+            handle = magic.open(magic.MAGIC_NONE)
+        handle.load()
+        return handle.file
+    except AttributeError:
+        return magic.Magic(mime=mime).from_file
+
+
+def _get_handle(mime):
+
+    global _handles_pid
+
+    # Handles are not shared with forked workers, each loads its own
+    if _handles_pid != os.getpid():
+        _handles.clear()
+        _handles_pid = os.getpid()
+
+    if mime not in _handles:
+        _handles[mime] = _load_handle(mime)
+
+    return _handles[mime]
+
+
+def _classify(path, mime):
+
+    with _handles_lock:
+        return _get_handle(mime)(path)
+
+
+@functools.lru_cache(maxsize=cache_size)
+def _classify_cached(path, mime, inode, mtime, size):
+    return _classify(path, mime)
+
+
+def from_file(path, mime=False):
+    """
+    Returns the libmagic description (or MIME type) of path. Results are
+    memoized on (inode, mtime, size), so unchanged files are only classified
+    once per process.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return _classify(path, mime)
+
+    return _classify_cached(path, mime, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def from_files(paths, mime=False):
+    """
+    Classifies many paths in one call. Returns a dict of path to description,
+    with None for paths that could not be classified.
+    """
+    results = {}
+
+    for path in paths:
+        try:
+            results[path] = from_file(path, mime)
+        except Exception:
+            results[path] = None
+
+    return results
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+Applies a plan of host network operations (taps, vlans, veths, addresses,
+routes, namespaces) through netlink, in one privileged process. Reads the plan
+as JSON on stdin, a list of [operation, arguments]. Operations that already
+took effect are skipped, and a failed plan is rolled back. With --tolerant,
+every operation is tried and failures are only reported, as needed to tear
+down whatever is left.
+"""
+import errno
+import json
+import logging
+import os
+import subprocess
+import sys
+
+try:
+    import pyroute2
+except ImportError:
+    pyroute2 = None
+
+helper_path = os.path.realpath(__file__)
+
+# Expects namespace
+netns_exec_cmd = ["ip", "netns", "exec", "{}"]
+
+# Errors that mean there is nothing left to remove
+missing_errors = (errno.ENODEV, errno.ESRCH, errno.ENOENT, errno.EADDRNOTAVAIL)
+
+# Exit status of the helper when pyroute2 can't be imported under sudo
+unavailable_status = 3
+
+
+class NetlinkUnavailable(RuntimeError):
+    """
+    The helper ran, but the interpreter it ran in as root has no pyroute2.
+    Nothing was applied.
+    """
+
+
+# Only tells about this interpreter, sudo may not see the same packages
+def available():
+
+    return pyroute2 is not None
+
+
+def run_plan(plan, tolerant=False):
+    """
+    Runs the helper under sudo on plan. Raises RuntimeError if it failed, after
+    it rolled back.
+    """
+    if not plan:
+        return
+
+    command = ["sudo", sys.executable, helper_path]
+    if tolerant:
+        command.append("--tolerant")
+
+    proc = subprocess.run(
+        command, input=json.dumps(plan).encode("utf-8"), stdout=subprocess.PIPE
+    )
+
+    if proc.returncode == unavailable_status:
+        raise NetlinkUnavailable("pyroute2 can't be imported under sudo")
+    if proc.returncode != 0:
+        raise RuntimeError(
+            "Network plan failed: {}".format(proc.stdout.decode("utf-8", "ignore"))
+        )
+
+
+class Netlink(object):
+    """
+    Netlink sockets on the host and in network namespaces, opened on first use.
+    """
+
+    def __init__(self):
+        self.sockets = {}
+
+    def get(self, netns=None):
+
+        if netns not in self.sockets:
+            if netns:
+                self.sockets[netns] = pyroute2.NetNS(netns)
+            else:
+                self.sockets[netns] = pyroute2.IPRoute()
+
+        return self.sockets[netns]
+
+    def index(self, name, netns=None):
+
+        indexes = self.get(netns).link_lookup(ifname=name)
+
+        return indexes[0] if indexes else None
+
+    def close(self):
+
+        for sock in self.sockets.values():
+            sock.close()
+        self.sockets = {}
+
+
+# Each operation returns the operation that undoes it, or None if it didn't
+# change anything
+
+
+def netns_add(nl, name):
+
+    if name in pyroute2.netns.listnetns():
+        return None
+
+    pyroute2.netns.create(name)
+
+    return ["netns_del", {"name": name}]
+
+
+def netns_del(nl, name):
+
+    sock = nl.sockets.pop(name, None)
+    if sock:
+        sock.close()
+
+    if name in pyroute2.netns.listnetns():
+        pyroute2.netns.remove(name)
+
+
+def tap_add(nl, name, owner=None, netns=None):
+
+    if nl.index(name, netns) is not None:
+        return None
+
+    args = {} if owner is None else {"uid": owner}
+    nl.get(netns).link("add", ifname=name, kind="tuntap", mode="tap", **args)
+
+    return ["link_del", {"name": name, "netns": netns}]
+
+
+def vlan_add(nl, link, name, vlan_id, netns=None):
+
+    if nl.index(name, netns) is not None:
+        return None
+
+    nl.get(netns).link(
+        "add", ifname=name, kind="vlan", link=nl.index(link, netns), vlan_id=vlan_id
+    )
+
+    return ["link_del", {"name": name, "netns": netns}]
+
+
+def veth_add(nl, name, peer, peer_netns):
+
+    if nl.index(name) is not None:
+        return None
+
+    ipr = nl.get()
+    ipr.link("add", ifname=name, kind="veth", peer=peer)
+    ipr.link("set", index=nl.index(peer), net_ns_fd=peer_netns)
+
+    return ["link_del", {"name": name}]
+
+
+def link_up(nl, name, netns=None):
+
+    nl.get(netns).link("set", index=nl.index(name, netns), state="up")
+
+
+def link_down(nl, name, netns=None):
+
+    index = nl.index(name, netns)
+    if index is not None:
+        nl.get(netns).link("set", index=index, state="down")
+
+
+def link_del(nl, name, netns=None):
+
+    index = nl.index(name, netns)
+    if index is not None:
+        nl.get(netns).link("del", index=index)
+
+
+def addr_add(nl, name, address, prefixlen, netns=None):
+
+    index = nl.index(name, netns)
+
+    try:
+        nl.get(netns).addr("add", index=index, address=address, prefixlen=prefixlen)
+    except pyroute2.NetlinkError as e:
+        if e.code == errno.EEXIST:
+            return None
+        raise
+
+    return [
+        "addr_del",
+        {"name": name, "address": address, "prefixlen": prefixlen, "netns": netns},
+    ]
+
+
+def addr_del(nl, name, address, prefixlen, netns=None):
+
+    index = nl.index(name, netns)
+    if index is not None:
+        nl.get(netns).addr("del", index=index, address=address, prefixlen=prefixlen)
+
+
+def route_add(nl, dst, gateway, name, netns=None):
+
+    try:
+        nl.get(netns).route("add", dst=dst, gateway=gateway, oif=nl.index(name, netns))
+    except pyroute2.NetlinkError as e:
+        # A route that was there before isn't ours to remove on rollback
+        if e.code == errno.EEXIST:
+            return None
+        raise
+
+    return ["route_del", {"dst": dst, "name": name, "netns": netns}]
+
+
+def route_del(nl, dst, name, netns=None):
+
+    index = nl.index(name, netns)
+    if index is not None:
+        nl.get(netns).route("del", dst=dst, oif=index)
+
+
+def route_flush(nl, name, netns=None):
+
+    index = nl.index(name, netns)
+    if index is not None:
+        nl.get(netns).flush_routes(oif=index)
+
+
+# For what netlink doesn't cover, such as iptables and sysctl
+def run(nl, argv, netns=None):
+
+    if netns:
+        argv = [x.format(netns) for x in netns_exec_cmd] + argv
+
+    subprocess.check_call(argv)
+
+
+operations = {
+    "netns_add": netns_add,
+    "netns_del": netns_del,
+    "tap_add": tap_add,
+    "vlan_add": vlan_add,
+    "veth_add": veth_add,
+    "link_up": link_up,
+    "link_down": link_down,
+    "link_del": link_del,
+    "addr_add": addr_add,
+    "addr_del": addr_del,
+    "route_add": route_add,
+    "route_del": route_del,
+    "route_flush": route_flush,
+    "run": run,
+}
+
+
+def apply_plan(plan, tolerant=False):
+    """
+    Applies plan in this process, which needs the privileges. Returns the
+    errors of a tolerant run.
+    """
+    nl = Netlink()
+    undo = []
+    errors = []
+
+    try:
+        for name, args in plan:
+            try:
+                undo_op = operations[name](nl, **args)
+            except Exception as e:
+                if tolerant:
+                    if not is_missing(e):
+                        errors.append("{} {}: {}".format(name, args, e))
+                    continue
+                rollback(nl, undo)
+                raise RuntimeError("{} {}: {}".format(name, args, e))
+
+            if undo_op:
+                undo.append(undo_op)
+    finally:
+        nl.close()
+
+    return errors
+
+
+def rollback(nl, undo):
+
+    for name, args in reversed(undo):
+        try:
+            operations[name](nl, **args)
+        except Exception as e:
+            logging.warning("Could not roll back {} {}: {}".format(name, args, e))
+
+
+def is_missing(e):
+
+    return getattr(e, "code", None) in missing_errors
+
+
+def main():
+
+    if not available():
+        print("pyroute2 is not installed")
+        return unavailable_status
+
+    plan = json.load(sys.stdin)
+
+    try:
+        errors = apply_plan(plan, tolerant="--tolerant" in sys.argv)
+    except RuntimeError as e:
+        print(e)
+        return 1
+
+    for error in errors:
+        print(error)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
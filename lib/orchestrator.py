@@ -0,0 +1,348 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import time
+from lib import probe_helper
+from lib import qemu_runner
+from lib import serial_helper
+
+# Guests driven at once, and threads for the short blocking steps (network
+# plans, overlays), shared by every guest
+max_concurrent = 16
+blocking_workers = 8
+
+# Seconds each stage may take, None for no limit
+stage_timeouts = {
+    "probe": 90,
+    "network": 60,
+    "snapshot": 120,
+    "start": 30,
+    "ready": None,
+    "run": None,
+    "stop": 60,
+}
+
+# Seconds a boot waits for the network or the snapshot marker
+boot_timeout = 60
+
+# Outcome of one stage, reason is why it failed or stopped
+StageResult = collections.namedtuple(
+    "StageResult", ["stage", "ok", "reason", "duration"]
+)
+
+
+class EmulationResult(object):
+    """
+    Outcome of one guest: its stages in the order they ran, and what was
+    learned on the way.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self.ips = []
+        self.snapshot = None
+        self.readiness = []
+        # Boot milestones of the probe boot, see serial_helper.BootTimeline
+        self.timeline = None
+        # Seconds from start until the first service answered
+        self.boot_latency = None
+        self.error = None
+        self.cancelled = False
+
+    @property
+    def ok(self):
+        return (
+            not self.cancelled and self.error is None and all(x.ok for x in self.stages)
+        )
+
+    def get(self, stage):
+
+        for result in self.stages:
+            if result.stage == stage:
+                return result
+
+        return None
+
+    def to_dict(self):
+
+        return {
+            "name": self.name,
+            "ok": self.ok,
+            "ips": self.ips,
+            "timeline": self.timeline,
+            "boot_latency": self.boot_latency,
+            "readiness": [x._asdict() for x in self.readiness],
+            "error": self.error,
+            "cancelled": self.cancelled,
+            "stages": [x._asdict() for x in self.stages],
+        }
+
+    def __repr__(self):
+        return "EmulationResult({}, ok={}, stages={})".format(
+            self.name, self.ok, [x.stage for x in self.stages]
+        )
+
+
+class StageError(RuntimeError):
+    """
+    A stage didn't get the guest where it had to. Stops the later stages.
+    """
+
+
+class Orchestrator(object):
+    """
+    Drives the life cycle of many QemuImages from one event loop: probe the
+    network with a first boot, set up the host network, snapshot, start the
+    guest, run it and stop it. QEMU runs as asyncio subprocesses and the guests
+    are controlled through QMP, so no thread or process is needed per guest
+    besides QEMU itself.
+    """
+
+    def __init__(
+        self, concurrency=max_concurrent, timeouts=None, workers=None, graceful=False
+    ):
+        self.semaphore = None
+        self.concurrency = concurrency
+        self.timeouts = dict(stage_timeouts)
+        self.timeouts.update(timeouts or {})
+        self.workers = workers or blocking_workers
+        self.executor = None
+        # Powers guests down before stopping QEMU. Most firmware ignores the
+        # request, each guest then holds its slot until powerdown_timeout.
+        self.graceful = graceful
+
+    async def emulate(
+        self, image, name=None, run_time=0, on_running=None, probes=None, **ready
+    ):
+        """
+        Runs every stage for image and returns its EmulationResult. If probes
+        are given (an empty list for the default ones), waits for the services
+        first, ready holds the deadline and until arguments of
+        QemuImage.wait_ready. While the guest runs,
+        on_running is awaited with image (if given), then the guest is kept up
+        for run_time seconds. Cancelling stops the guest and its network
+        before returning.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        result = EmulationResult(name or image.image)
+        guest = Guest(self, image, result)
+
+        async with self.semaphore:
+            try:
+                await guest.stage("probe", guest.probe)
+                await guest.stage("network", guest.start_network)
+                if image.snapshot:
+                    await guest.stage("snapshot", guest.take_snapshot)
+                await guest.stage("start", guest.start)
+                if probes is not None:
+                    await guest.stage("ready", guest.wait_ready, probes, ready)
+                await guest.stage("run", guest.run, run_time, on_running)
+            except StageError as e:
+                result.error = str(e)
+            except asyncio.CancelledError:
+                result.cancelled = True
+                raise
+            finally:
+                await guest.stage("stop", guest.stop, fatal=False)
+
+        return result
+
+    async def emulate_all(self, images, **kwargs):
+        """
+        Emulates every image at once, at most concurrency at a time, and
+        returns their results in order.
+        """
+        return await asyncio.gather(
+            *[self.emulate(image, **kwargs) for image in images]
+        )
+
+    def run(self, images, **kwargs):
+        """
+        Blocking entry point for emulate_all.
+        """
+        try:
+            return asyncio.run(self.emulate_all(images, **kwargs))
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops the threads of the blocking steps. Emulating again starts new
+        ones.
+        """
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+        # Tied to the event loop that is gone
+        self.semaphore = None
+
+    async def run_blocking(self, function, *args):
+
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+        loop = asyncio.get_event_loop()
+
+        return await loop.run_in_executor(self.executor, function, *args)
+
+
+class Guest(object):
+    """
+    Stages of one QemuImage under an Orchestrator.
+    """
+
+    def __init__(self, orchestrator, image, result):
+        self.orchestrator = orchestrator
+        self.image = image
+        self.result = result
+        self.proc = None
+        self.network_up = False
+
+    async def stage(self, name, function, *args, fatal=True):
+
+        start = time.time()
+        timeout = self.orchestrator.timeouts.get(name)
+
+        try:
+            await asyncio.wait_for(function(*args), timeout)
+            stage_result = StageResult(name, True, None, time.time() - start)
+        except asyncio.TimeoutError:
+            stage_result = StageResult(
+                name, False, "timeout after {}s".format(timeout), time.time() - start
+            )
+        except Exception as e:
+            stage_result = StageResult(name, False, str(e), time.time() - start)
+
+        logging.debug("{} {}: {}".format(self.result.name, name, stage_result))
+        self.result.stages.append(stage_result)
+
+        if fatal and not stage_result.ok:
+            raise StageError("{} failed: {}".format(name, stage_result.reason))
+
+    async def probe(self):
+
+        image = self.image
+
+        await self.orchestrator.run_blocking(image.prepare_drive)
+
+        watcher = await serial_helper.watch_boot_async(
+            image.get_boot_command(),
+            image.serial_file,
+            image.endianess,
+            boot_timeout,
+            env=qemu_runner.arm_env,
+            qmp_path=image.get_qmp_path(),
+        )
+
+        image.timeline = watcher.timeline
+        self.result.timeline = watcher.timeline.to_dict()
+
+        if not image.configure_network(watcher.table):
+            raise StageError(
+                "No network found, guest stopped on {}".format(watcher.reason)
+            )
+
+        self.result.ips = list(image.ips)
+
+    async def start_network(self):
+
+        await self.orchestrator.run_blocking(self.image.start_network)
+        self.network_up = True
+
+    async def take_snapshot(self):
+
+        image = self.image
+
+        # Taken by an earlier run on the same image
+        snapshot = await self.orchestrator.run_blocking(image.find_snapshot)
+        if snapshot:
+            self.result.snapshot = snapshot
+            return
+
+        snapshot, command, marker = await self.orchestrator.run_blocking(
+            image.prepare_snapshot
+        )
+
+        async def save_state(watcher):
+            client = await image.connect_qmp()
+            try:
+                await client.save_state(snapshot.state)
+            finally:
+                await image.close_qmp()
+
+        watcher = await serial_helper.watch_boot_async(
+            command,
+            image.serial_file,
+            image.endianess,
+            boot_timeout,
+            env=qemu_runner.arm_env,
+            marker=marker,
+            on_ready=save_state,
+            qmp_path=image.get_qmp_path(),
+        )
+
+        self.result.snapshot = image.finish_snapshot(snapshot, watcher)
+
+    async def start(self):
+
+        image = self.image
+        snapshot = self.result.snapshot
+
+        await self.orchestrator.run_blocking(image.prepare_drive, snapshot)
+
+        self.proc = await asyncio.create_subprocess_exec(
+            *image.get_boot_command(snapshot),
+            env=qemu_runner.arm_env,
+            stdout=asyncio.subprocess.DEVNULL
+        )
+
+        image.boot_started = time.time()
+
+        await image.connect_qmp()
+
+    async def wait_ready(self, probes, ready):
+
+        ready_ok = await self.image.wait_ready(probes or None, **ready)
+
+        self.result.readiness = self.image.readiness
+        self.result.boot_latency = probe_helper.first_ready(self.image.readiness)
+
+        if not ready_ok:
+            raise StageError("No service answered")
+
+    async def run(self, run_time, on_running):
+
+        if on_running:
+            await on_running(self.image)
+
+        if run_time:
+            try:
+                await asyncio.wait_for(self.proc.wait(), run_time)
+            except asyncio.TimeoutError:
+                return
+
+            raise StageError("QEMU exited with {}".format(self.proc.returncode))
+
+    async def stop(self):
+
+        image = self.image
+
+        try:
+            if image.qmp:
+                try:
+                    await image.stop_guest(self.orchestrator.graceful)
+                except (RuntimeError, OSError, asyncio.TimeoutError) as e:
+                    logging.warning("Could not stop guest cleanly: {}".format(e))
+                    await image.close_qmp()
+
+            if self.proc:
+                await serial_helper.stop_process_async(self.proc)
+        finally:
+            if self.network_up:
+                self.network_up = False
+                await self.orchestrator.run_blocking(image.stop_network)
@@ -0,0 +1,185 @@
+import logging
+import os
+import time
+from lib import arch_helper
+from lib import extract_helper
+from lib import image_helper
+from lib import instance_helper
+from lib import profile_helper
+from lib import strategy_helper
+from lib.orchestrator import StageResult
+
+# Stages of an emulation, in order
+stages = ["extract", "arch", "image", "strategy", "export"]
+
+# Expects the firmware file name, then the strategy if not the default one
+runner_name = "{}_runner_{}.sh"
+
+# In the work directory. The extractor takes whatever it finds in there for the
+# rootfs, so nothing else (such as the temporary directory) may be in it.
+extract_dir = "extracted"
+
+
+class StageFailed(RuntimeError):
+    """
+    A stage ran, but didn't get what the next one needs.
+    """
+
+
+class Pipeline(object):
+    """
+    What emulate_me.py does for one firmware: extract its root filesystem,
+    find its architecture, build the image, search for a boot strategy that
+    brings the network up and export a runner script to output_folder.
+    listener, if given, is called with the stage name and None when a stage
+    starts, and with its StageResult when it ends.
+    """
+
+    def __init__(
+        self,
+        firmware,
+        output_folder,
+        rootless=False,
+        overlay=False,
+        netns=False,
+        profile=None,
+        script_only=True,
+        listener=None,
+    ):
+        self.firmware = firmware
+        self.output_folder = output_folder
+        self.rootless = rootless
+        self.overlay = overlay
+        self.netns = netns
+        self.profile_spec = profile
+        self.script_only = script_only
+        self.listener = listener
+
+        self.instance = None
+        self.fw_tar = None
+        self.arch = None
+        self.image = None
+        self.profile = None
+        self.result = None
+        self.runner_path = None
+
+        self.stages = []
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None and len(self.stages) == len(stages)
+
+    @property
+    def failed_stage(self):
+
+        for result in self.stages:
+            if not result.ok:
+                return result.stage
+
+        return None
+
+    @property
+    def ips(self):
+        return list(self.result.runner.ips) if self.result else []
+
+    @property
+    def strategy(self):
+        return self.result.strategy.name if self.result else None
+
+    def run(self):
+        """
+        Runs every stage until one fails. Returns whether all of them passed.
+        """
+        # Ports, tap devices and work directory of its own, so runs can go side by side
+        self.instance = instance_helper.allocate()
+        self.instance.use_temp_dir()
+
+        try:
+            for name in stages:
+                if not self.stage(name, getattr(self, "do_" + name)):
+                    break
+        finally:
+            if self.result:
+                self.result.runner.instance.release()
+            self.instance.release()
+
+        return self.ok
+
+    def stage(self, name, function):
+
+        if self.listener:
+            self.listener(name, None)
+
+        start = time.time()
+
+        try:
+            function()
+            result = StageResult(name, True, None, time.time() - start)
+        except Exception as e:
+            logging.exception("Stage {} failed".format(name))
+            result = StageResult(name, False, str(e), time.time() - start)
+            self.error = "{} failed: {}".format(name, e)
+
+        self.stages.append(result)
+        if self.listener:
+            self.listener(name, result)
+
+        return result.ok
+
+    def do_extract(self):
+
+        output_dir = os.path.join(self.instance.work_dir, extract_dir)
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.fw_tar = extract_helper.extract_image(self.firmware, output_dir)
+        if self.fw_tar is None:
+            raise StageFailed("No root filesystem found")
+
+    def do_arch(self):
+
+        self.arch = arch_helper.get_arch(self.fw_tar)
+        if self.arch is None:
+            raise StageFailed("Unknown architecture")
+
+    def do_image(self):
+
+        self.image = image_helper.make_image(
+            self.fw_tar,
+            self.arch.qemu_name,
+            self.instance.work_dir,
+            rootless=self.rootless,
+        )
+
+        self.profile = profile_helper.select_profile(self.arch.qemu_name, self.image)
+        if self.profile_spec:
+            self.profile = profile_helper.parse_profile(self.profile_spec, self.profile)
+
+    def do_strategy(self):
+
+        # Every strategy boots at once from a copy-on-write view of the image
+        self.result = strategy_helper.find_strategy(
+            self.image,
+            self.arch.qemu_name,
+            self.arch.memory_endness,
+            netns=self.netns,
+            profile=self.profile,
+        )
+        if self.result is None:
+            raise StageFailed("No strategy brought the network up")
+
+        strategy_helper.promote(self.result, self.image)
+        self.result.runner.overlay = self.overlay
+
+    def do_export(self):
+
+        strategy = ""
+        if self.result.strategy.name != "default":
+            strategy = self.result.strategy.name + "_"
+
+        script_name = runner_name.format(os.path.basename(self.firmware), strategy)
+
+        self.result.runner.export(
+            self.output_folder, script_name=script_name, script_only=self.script_only
+        )
+        self.runner_path = os.path.join(self.output_folder, script_name)
@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+"""
+Long lived privileged helper for image and device operations. Started once
+with sudo, it serves the user who started it on a Unix socket, one JSON
+request per line: attach an image with kpartx, make its filesystem, mount it,
+hand it over to the user, run the firmadyne fixup in it and detach it.
+
+Devices are tracked per connection and detached when the connection closes,
+so a client that crashes doesn't leak loop and mapper devices. They are also
+recorded in a state file, and whatever a crashed helper left attached is
+cleaned up by the next one.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import re
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+helper_path = os.path.realpath(__file__)
+
+# Root owned, so no other user can plant files or symlinks where the helper
+# writes. One socket (and lock and state file) per user the helper serves.
+runtime_dir = os.environ.get(
+    "FW_EMULATOR_RUNTIME", os.path.join("/", "run", "firmware_emulator")
+)
+runtime_mode = 0o755
+# Expects uid
+socket_name = "privileged.{}.sock"
+state_suffix = ".state"
+lock_suffix = ".lock"
+
+# Mount points have to be in the work directory of an instance slot, see
+# instance_helper
+instance_dir = os.environ.get(
+    "FW_EMULATOR_INSTANCES", os.path.join("/", "tmp", "firmware_emulator")
+)
+work_pattern = re.compile(r"^\d+\.work$")
+
+# Seconds the helper waits without clients before exiting
+idle_timeout = 300
+connect_timeout = 10
+poll_interval = 0.1
+
+# Expects image path
+attach_cmd = ["kpartx", "-a", "-s", "-v", "{}"]
+detach_cmd = ["kpartx", "-d", "{}"]
+mapper_str = "/dev/mapper/{}"
+# Expects device
+mkfs_cmd = ["mkfs.ext2", "-q", "{}"]
+# Expects device then mount path
+mount_cmd = ["mount", "-o", "nosuid,nodev", "{}", "{}"]
+# Expects mount path
+umount_cmd = ["umount", "{}"]
+fixup_cmd = ["chroot", "{}", "/busybox", "ash", "/fixImage.sh"]
+
+peercred_format = "3i"
+
+
+def get_socket_path(uid=None):
+
+    return os.path.join(
+        runtime_dir, socket_name.format(os.getuid() if uid is None else uid)
+    )
+
+
+def check_runtime_dir(path):
+    """
+    Creates path if needed, and makes sure only root can write to it.
+    """
+    try:
+        os.mkdir(path, runtime_mode)
+    except FileExistsError:
+        pass
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise RuntimeError("{} is not a directory".format(path))
+    if info.st_uid != 0 or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise RuntimeError(
+            "{} has to be owned by root and writable by root only".format(path)
+        )
+
+
+def open_nofollow(path, flags, mode=0o600):
+
+    return os.open(path, flags | os.O_NOFOLLOW | os.O_CLOEXEC, mode)
+
+
+def check_mount_path(mount_path, uid):
+    """
+    Returns mount_path resolved, if it is a directory of uid in the work
+    directory of an instance slot.
+    """
+    mount_path = os.path.realpath(mount_path)
+    instances = os.path.realpath(instance_dir)
+
+    relative = os.path.relpath(mount_path, instances).split(os.sep)
+    if relative[0] == ".." or not work_pattern.match(relative[0]):
+        raise RuntimeError("{} is not in an instance work directory".format(mount_path))
+
+    path = instances
+    for name in relative:
+        path = os.path.join(path, name)
+        info = os.lstat(path)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != uid:
+            raise RuntimeError("{} is not a directory of uid {}".format(path, uid))
+
+    return mount_path
+
+
+def format_cmd(cmd, *args):
+
+    args = iter(args)
+
+    return [next(args) if x == "{}" else x for x in cmd]
+
+
+class DeviceTable(object):
+    """
+    Images attached by the helper, to their device and mount paths, saved to
+    the state file on every change.
+    """
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.images = {}
+        self.lock = threading.RLock()
+
+    def load(self):
+
+        try:
+            with os.fdopen(open_nofollow(self.state_path, os.O_RDONLY)) as f:
+                self.images = json.load(f)
+        except (OSError, ValueError):
+            self.images = {}
+
+    def save(self):
+
+        # Created new, never a file someone left there
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.state_path),
+            prefix=os.path.basename(self.state_path) + ".",
+        )
+        with os.fdopen(tmp_fd, "w") as f:
+            json.dump(self.images, f)
+        os.replace(tmp_path, self.state_path)
+
+    def attach(self, image_path):
+
+        with self.lock:
+            if image_path in self.images:
+                raise RuntimeError("{} is already attached".format(image_path))
+
+            output = subprocess.check_output(
+                format_cmd(attach_cmd, image_path), stderr=subprocess.STDOUT
+            )
+            # add map loop0p1 (253:0): 0 ... linear 7:0 2048
+            device = mapper_str.format(output.decode("utf-8").split()[2])
+
+            self.images[image_path] = {"device": device, "mounts": []}
+            self.save()
+
+        return device
+
+    def get_image(self, device):
+
+        for image_path, record in self.images.items():
+            if record["device"] == device:
+                return image_path
+
+        raise RuntimeError("{} is not attached".format(device))
+
+    def mount(self, device, mount_path):
+
+        with self.lock:
+            record = self.images[self.get_image(device)]
+
+            subprocess.check_call(format_cmd(mount_cmd, device, mount_path))
+
+            record["mounts"].append(mount_path)
+            self.save()
+
+    def is_mounted(self, mount_path):
+
+        return any(mount_path in x["mounts"] for x in self.images.values())
+
+    def detach(self, image_path):
+        """
+        Unmounts and detaches image_path. Keeps going past failures, as it
+        also cleans up after crashes, and returns them.
+        """
+        errors = []
+
+        with self.lock:
+            record = self.images.pop(image_path, None)
+            if record is None:
+                return errors
+
+            for mount_path in reversed(record["mounts"]):
+                errors.extend(call(format_cmd(umount_cmd, mount_path)))
+
+            errors.extend(call(format_cmd(detach_cmd, image_path)))
+
+            self.save()
+
+        return errors
+
+    def detach_all(self):
+
+        with self.lock:
+            for image_path in list(self.images):
+                for error in self.detach(image_path):
+                    logging.warning(error)
+
+
+def call(command):
+
+    try:
+        proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        return ["{}: {}".format(" ".join(command), e)]
+
+    if proc.returncode != 0:
+        return [
+            "{}: {}".format(" ".join(command), proc.stdout.decode("utf-8", "ignore"))
+        ]
+
+    return []
+
+
+def chown_tree(path, uid, gid):
+
+    os.lchown(path, uid, gid)
+
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            os.lchown(os.path.join(root, name), uid, gid)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one client. Only the user that started the helper (and root) may
+    connect, and devices can only be used by the connection that attached
+    them.
+    """
+
+    def setup(self):
+        super().setup()
+        self.attached = []
+
+    def handle(self):
+
+        server = self.server
+
+        _, uid, _ = struct.unpack(
+            peercred_format,
+            self.request.getsockopt(
+                socket.SOL_SOCKET,
+                socket.SO_PEERCRED,
+                struct.calcsize(peercred_format),
+            ),
+        )
+        if uid not in (server.owner_uid, 0):
+            logging.warning("Refused client of uid {}".format(uid))
+            return
+
+        self.uid = uid
+
+        server.connected(1)
+
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    response = {"result": self.dispatch(**request)}
+                except Exception as e:
+                    response = {"error": "{}: {}".format(type(e).__name__, e)}
+
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        finally:
+            # Whatever the client didn't detach, it crashed or forgot
+            for image_path in self.attached:
+                for error in server.table.detach(image_path):
+                    logging.warning(error)
+
+            server.connected(-1)
+
+    def dispatch(self, op, args):
+
+        table = self.server.table
+
+        if op == "attach":
+            image_path = os.path.realpath(args["image_path"])
+            if not os.path.isfile(image_path):
+                raise RuntimeError("No image at {}".format(image_path))
+
+            device = table.attach(image_path)
+            self.attached.append(image_path)
+
+            return device
+
+        if op == "detach":
+            image_path = self.get_attached(args["image_path"])
+            self.attached.remove(image_path)
+
+            return table.detach(image_path)
+
+        if op == "mkfs":
+            self.get_attached_device(args["device"])
+
+            subprocess.check_call(
+                format_cmd(mkfs_cmd, args["device"]), stdout=subprocess.DEVNULL
+            )
+
+        elif op == "mount":
+            self.get_attached_device(args["device"])
+            mount_path = check_mount_path(args["mount_path"], self.uid)
+
+            table.mount(args["device"], mount_path)
+
+        elif op == "chown":
+            path = os.path.realpath(args["path"])
+            if os.lstat(path).st_uid != self.server.owner_uid and not table.is_mounted(
+                path
+            ):
+                raise RuntimeError("{} is not the user's".format(path))
+
+            chown_tree(path, self.server.owner_uid, self.server.owner_gid)
+
+        elif op == "fixup":
+            mount_path = os.path.realpath(args["mount_path"])
+            if not table.is_mounted(mount_path):
+                raise RuntimeError("{} is not mounted by the helper".format(mount_path))
+
+            subprocess.check_call(format_cmd(fixup_cmd, mount_path))
+
+        else:
+            raise RuntimeError("Unknown operation {}".format(op))
+
+        return None
+
+    def get_attached(self, image_path):
+
+        image_path = os.path.realpath(image_path)
+        if image_path not in self.attached:
+            raise RuntimeError("{} was not attached by this client".format(image_path))
+
+        return image_path
+
+    def get_attached_device(self, device):
+
+        return self.get_attached(self.server.table.get_image(device))
+
+
+class HelperServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, owner_uid, owner_gid, table):
+        self.owner_uid = owner_uid
+        self.owner_gid = owner_gid
+        self.table = table
+        self.clients = 0
+        self.last_seen = time.time()
+        self.clients_lock = threading.Lock()
+
+        super().__init__(path, RequestHandler)
+
+    def connected(self, count):
+
+        with self.clients_lock:
+            self.clients += count
+            self.last_seen = time.time()
+
+    def idle(self):
+
+        with self.clients_lock:
+            return self.clients == 0 and time.time() - self.last_seen >= idle_timeout
+
+    def watch_idle(self):
+
+        while not self.idle():
+            time.sleep(idle_timeout / 10)
+
+        self.shutdown()
+
+
+def serve(path, owner_uid, owner_gid):
+    """
+    Binds the socket, cleans up after a previous helper, then detaches from
+    the caller and serves until idle. Returns in the caller once clients can
+    connect.
+    """
+    check_runtime_dir(os.path.dirname(path))
+
+    lock_file = os.fdopen(
+        open_nofollow(path + lock_suffix, os.O_WRONLY | os.O_CREAT), "w"
+    )
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            # Another helper is starting or running
+            return 0
+        raise
+
+    table = DeviceTable(path + state_suffix)
+    table.load()
+    table.detach_all()
+
+    if os.path.lexists(path):
+        os.remove(path)
+
+    server = HelperServer(path, owner_uid, owner_gid, table)
+    os.chown(path, owner_uid, owner_gid)
+    os.chmod(path, 0o600)
+
+    if os.fork() != 0:
+        # The child holds the lock and the socket
+        return 0
+
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+    threading.Thread(target=server.watch_idle, daemon=True).start()
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        table.detach_all()
+        os.remove(path)
+
+    return 0
+
+
+class HelperClient(object):
+    """
+    Connection to the helper, starting it with sudo if it isn't running. The
+    devices attached through it are detached when it is closed, or when the
+    process exits.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_socket_path()
+        self.sock = None
+        self.lock = threading.Lock()
+
+        try:
+            self.connect()
+        except OSError:
+            self.start()
+            self.connect(connect_timeout)
+
+        self.reader = self.sock.makefile("rb")
+
+    def connect(self, timeout=0):
+
+        deadline = time.time() + timeout
+
+        while True:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(self.path)
+                return
+            except OSError:
+                self.sock.close()
+                if time.time() >= deadline:
+                    raise
+                time.sleep(poll_interval)
+
+    def start(self):
+
+        logging.debug("Starting privileged helper on {}".format(self.path))
+
+        # The helper finds its socket in runtime_dir from the uid
+        subprocess.check_call(
+            [
+                "sudo",
+                sys.executable,
+                helper_path,
+                str(os.getuid()),
+                str(os.getgid()),
+                os.path.abspath(instance_dir),
+            ]
+        )
+
+    def call(self, op, **args):
+
+        with self.lock:
+            self.sock.sendall(
+                json.dumps({"op": op, "args": args}).encode("utf-8") + b"\n"
+            )
+            line = self.reader.readline()
+
+        if not line:
+            raise RuntimeError("Privileged helper closed the connection")
+
+        response = json.loads(line.decode("utf-8"))
+        if "error" in response:
+            raise RuntimeError("Privileged helper {}: {}".format(op, response["error"]))
+
+        return response["result"]
+
+    def attach(self, image_path):
+        return self.call("attach", image_path=image_path)
+
+    def mkfs(self, device):
+        return self.call("mkfs", device=device)
+
+    def mount(self, device, mount_path):
+        return self.call("mount", device=device, mount_path=mount_path)
+
+    def chown(self, path):
+        return self.call("chown", path=path)
+
+    def fixup(self, mount_path):
+        return self.call("fixup", mount_path=mount_path)
+
+    def detach(self, image_path):
+        return self.call("detach", image_path=image_path)
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+client = None
+# Edit sessions run in threads, which would each start a helper
+client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the connection shared by this process.
+    """
+    global client
+
+    with client_lock:
+        if client is None:
+            client = HelperClient()
+
+    return client
+
+
+def main():
+
+    global instance_dir
+
+    if len(sys.argv) != 4:
+        print("Usage: {} uid gid instance_dir".format(sys.argv[0]))
+        return 1
+
+    if os.geteuid() != 0:
+        print("The privileged helper has to run as root")
+        return 1
+
+    uid, gid = int(sys.argv[1]), int(sys.argv[2])
+    instance_dir = sys.argv[3]
+
+    return serve(get_socket_path(uid), uid, gid)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+import asyncio
+import collections
+import logging
+import re
+import time
+
+# Seconds to wait for a service to come up, for one attempt, and between two
+default_deadline = 120
+attempt_timeout = 3
+retry_interval = 0.5
+read_size = 4096
+
+# Expects path then host
+http_request = "GET {} HTTP/1.0\r\nHost: {}\r\nConnection: close\r\n\r\n"
+http_status = re.compile(rb"^HTTP/\d\.\d (\d{3})")
+
+# kind is tcp (connect), http (GET path, any status) or banner (pattern in
+# what the service sends first, such as telnet or ssh)
+Probe = collections.namedtuple("Probe", ["kind", "port", "path", "pattern"])
+Probe.__new__.__defaults__ = ("/", None)
+
+# Services found on most firmware
+default_probes = [
+    Probe("http", 80),
+    Probe("tcp", 443),
+    Probe("banner", 23, pattern=rb"login|Login|\xff"),
+    Probe("banner", 22, pattern=rb"^SSH-"),
+]
+
+# ready_time is seconds from the start (the guest boot if known) until the
+# service answered, ttfb seconds from the request (or connection, for a
+# banner) to the first byte. detail is the HTTP status, the banner or the
+# last error.
+ProbeResult = collections.namedtuple(
+    "ProbeResult",
+    ["kind", "address", "port", "ok", "ready_time", "ttfb", "attempts", "detail"],
+)
+
+
+class ProbeFailed(Exception):
+    """
+    The service answered, but not as expected.
+    """
+
+
+async def check_tcp(address, probe):
+
+    _, writer = await asyncio.open_connection(address, probe.port)
+    writer.close()
+
+    return None, None
+
+
+async def check_http(address, probe):
+
+    reader, writer = await asyncio.open_connection(address, probe.port)
+
+    try:
+        writer.write(http_request.format(probe.path, address).encode("ascii"))
+        await writer.drain()
+        sent = time.time()
+
+        data = await reader.read(read_size)
+        ttfb = time.time() - sent
+    finally:
+        writer.close()
+
+    match = http_status.match(data)
+    if not match:
+        raise ProbeFailed("Not HTTP: {!r}".format(data[:64]))
+
+    return ttfb, int(match.group(1))
+
+
+async def check_banner(address, probe):
+
+    reader, writer = await asyncio.open_connection(address, probe.port)
+    connected = time.time()
+
+    ttfb = None
+    data = b""
+
+    try:
+        while True:
+            chunk = await reader.read(read_size)
+            if not chunk:
+                raise ProbeFailed("Closed after {!r}".format(data[:64]))
+            if ttfb is None:
+                ttfb = time.time() - connected
+
+            data += chunk
+            if re.search(probe.pattern or b".", data):
+                break
+    finally:
+        writer.close()
+
+    return ttfb, data[:64].decode("utf-8", "replace")
+
+
+checks = {
+    "tcp": check_tcp,
+    "http": check_http,
+    "banner": check_banner,
+}
+
+
+async def wait_ready(address, probe, deadline=default_deadline, start=None):
+    """
+    Tries probe on address until it succeeds or deadline seconds pass, and
+    returns its ProbeResult.
+    """
+    start = time.time() if start is None else start
+    end = time.time() + deadline
+    attempts = 0
+    detail = None
+
+    while True:
+        attempts += 1
+        try:
+            ttfb, detail = await asyncio.wait_for(
+                checks[probe.kind](address, probe), attempt_timeout
+            )
+            result = ProbeResult(
+                probe.kind,
+                address,
+                probe.port,
+                True,
+                time.time() - start,
+                ttfb,
+                attempts,
+                detail,
+            )
+            logging.debug("Service ready: {}".format(result))
+            return result
+        except (OSError, asyncio.TimeoutError, ProbeFailed) as e:
+            detail = str(e) or type(e).__name__
+
+        if time.time() + retry_interval >= end:
+            return ProbeResult(
+                probe.kind, address, probe.port, False, None, None, attempts, detail
+            )
+
+        await asyncio.sleep(retry_interval)
+
+
+async def wait_all(
+    addresses, probes=None, deadline=default_deadline, start=None, until="all"
+):
+    """
+    Probes every address with every probe at once and returns the results.
+    With until="any", stops as soon as one service answers: the probes still
+    waiting are reported as not ready.
+    """
+    probes = default_probes if probes is None else probes
+
+    # Guests the network of which wasn't found have nothing to probe
+    if not addresses or not probes:
+        return []
+
+    targets = [(address, probe) for address in addresses for probe in probes]
+    tasks = [
+        asyncio.ensure_future(wait_ready(address, probe, deadline, start))
+        for address, probe in targets
+    ]
+
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            if until == "any" and any(x.result().ok for x in done):
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    # Lets the cancelled probes finish
+    await asyncio.wait(tasks)
+
+    results = []
+    for (address, probe), task in zip(targets, tasks):
+        if task.cancelled():
+            results.append(
+                ProbeResult(
+                    probe.kind, address, probe.port, False, None, None, 0, "not waited"
+                )
+            )
+        else:
+            results.append(task.result())
+
+    return results
+
+
+def first_ready(results):
+    """
+    Returns the seconds until the first service answered, or None.
+    """
+    times = [x.ready_time for x in results if x.ok]
+
+    return min(times) if times else None
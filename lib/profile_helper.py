@@ -0,0 +1,152 @@
+import collections
+import functools
+import logging
+import os
+import re
+import subprocess
+from lib import index_helper
+
+# How QEMU runs a guest. memory is in MB, tb_size (the translation cache) too.
+# mttcg runs each virtual CPU on a host thread of its own. None leaves the QEMU
+# default. tb_size is given the way the installed QEMU takes it.
+Profile = collections.namedtuple(
+    "Profile", ["memory", "smp", "cpu", "mttcg", "tb_size"]
+)
+
+# Per arch, before the guest is looked at. Malta has no more than 256MB of low
+# memory, and multi-threaded TCG only pays off with more than one CPU. QEMU
+# 5.0 and later default to a translation cache of up to 1GB per guest, far
+# more than firmware runs through, and what limits how many guests fit on a
+# host.
+default_profiles = {
+    "mips": Profile(256, 1, None, None, 64),
+    "arm": Profile(256, 1, None, None, 64),
+}
+
+# Overrides every profile, such as "memory=128,smp=2,mttcg=1,tb_size=64"
+profile_env = "FW_EMULATOR_PROFILE"
+
+# Guest memory for a root filesystem of up to so many bytes, the largest step
+# for anything bigger. Firmware targets devices with little RAM.
+memory_steps = [
+    (32 * 1024 ** 2, 128),
+    (None, 256),
+]
+
+# Expects memory in MB, SMP count and CPU model
+memory_arg = "-m {}"
+smp_arg = "-smp {}"
+cpu_arg = "-cpu {}"
+accel_arg = "-accel tcg"
+# QEMU before 5.0 only takes the translation cache size this way
+legacy_tb_size_arg = "-tb-size {}"
+legacy_version = (5, 0)
+
+version_pattern = re.compile(rb"version (\d+)\.(\d+)")
+
+
+def get_family(arch):
+
+    return "mips" if "mips" in arch else "arm"
+
+
+def select_profile(arch, image_path=None):
+    """
+    Returns the profile to boot image_path with. Memory is sized from the root
+    filesystem in the image index, if there is one.
+    """
+    profile = default_profiles[get_family(arch)]
+
+    index = index_helper.load_index(image_path) if image_path else None
+    if index is not None:
+        footprint = sum(x.size for x in index.entries.values() if x.type == "f")
+        for limit, memory in memory_steps:
+            if limit is None or footprint <= limit:
+                break
+        profile = profile._replace(memory=min(memory, profile.memory))
+
+    spec = os.environ.get(profile_env)
+    if spec:
+        profile = parse_profile(spec, profile)
+
+    logging.debug("Execution profile {}".format(profile))
+
+    return profile
+
+
+def parse_profile(spec, base):
+    """
+    Returns base with the fields set in spec, a comma separated list of
+    field=value.
+    """
+    fields = {}
+
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+
+        name, _, value = item.partition("=")
+        name = name.strip().replace("-", "_")
+        if name not in Profile._fields:
+            raise ValueError("Unknown profile field {}".format(name))
+
+        value = value.strip()
+        if not value:
+            raise ValueError("No value for profile field {}".format(name))
+
+        if name == "cpu":
+            fields[name] = value
+        elif name == "mttcg":
+            fields[name] = value.lower() in ("1", "yes", "true", "on")
+        else:
+            fields[name] = int(value)
+            if fields[name] <= 0:
+                raise ValueError("Profile field {} has to be positive".format(name))
+
+    return base._replace(**fields)
+
+
+@functools.lru_cache(maxsize=None)
+def get_qemu_version(command):
+    """
+    Returns the (major, minor) version of the QEMU binary command, or None if
+    it can't be run.
+    """
+    try:
+        output = subprocess.check_output(
+            [command, "--version"], stderr=subprocess.DEVNULL, timeout=10
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    match = version_pattern.search(output)
+    if match is None:
+        return None
+
+    return int(match.group(1)), int(match.group(2))
+
+
+# command is the QEMU binary the arguments are for, which picks their syntax
+def get_profile_args(profile, command=None):
+
+    args = [memory_arg.format(profile.memory)]
+
+    if profile.smp and profile.smp > 1:
+        args.append(smp_arg.format(profile.smp))
+    if profile.cpu:
+        args.append(cpu_arg.format(profile.cpu))
+
+    version = get_qemu_version(command) if command else None
+
+    accel = accel_arg
+    if profile.mttcg is not None:
+        accel += ",thread={}".format("multi" if profile.mttcg else "single")
+    if profile.tb_size:
+        if version and version < legacy_version:
+            args.append(legacy_tb_size_arg.format(profile.tb_size))
+        else:
+            accel += ",tb-size={}".format(profile.tb_size)
+    if accel != accel_arg:
+        args.append(accel)
+
+    return args
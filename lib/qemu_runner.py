@@ -1,12 +1,18 @@
 import os
 import subprocess
 import logging
-import re
 import shlex
-import socket
-import struct
 import shutil
 import copy
+import collections
+import hashlib
+import tempfile
+from lib import netlink_helper
+from lib import probe_helper
+from lib import profile_helper
+from lib import qmp_helper
+from lib import serial_helper
+from lib import storage_helper
 
 # Main directory
 parent_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -19,59 +25,91 @@ qemu_commands = {
 }
 machine_args = [
     '-append "firmadyne.syscall={} root=/dev/sda1 console=ttyS0 nandsim.parts=64,64,64,64,64,64,64,64,64,64 rdinit=/firmadyne/preInit.sh rw debug ignore_loglevel print-fatal-signals=1"',
-    "-m 1024",
 ]
 arm_board = "-M virt"
 mips_board = "-M malta"
 kernel_arg = "-kernel {}"
-drive_arg_mips = "-drive if=ide,format=raw,file={}"
-drive_arg_arm = (
-    "-drive if=none,file={},format=raw,id=rootfs -device virtio-blk-device,drive=rootfs"
+# Expects image path then image format
+drive_arg_mips = "-drive if=ide,format={1},file={0}"
+drive_arg_arm = "-drive if=none,file={0},format={1},id=rootfs -device virtio-blk-device,drive=rootfs"
+
+# Per-run copy-on-write layer, so runtime writes never touch the base image
+overlay_name = "overlay.qcow2"
+
+# Guest state saved once it is up, restored instead of booting again. disk is
+# a qcow2 layer on the image holding the disk as it was when saved.
+Snapshot = collections.namedtuple("Snapshot", ["disk", "state"])
+# Kept across runs, in a directory per image holding the snapshots of its
+# current contents only. The image path is saved in it, so the snapshots of
+# images gone are removed.
+snapshot_dir = os.environ.get(
+    "FW_EMULATOR_SNAPSHOTS",
+    os.path.join(os.path.expanduser("~"), ".cache", "firmware_emulator_snapshots"),
 )
+snapshot_image_name = "image"
+snapshot_disk_name = "disk.qcow2"
+snapshot_state_name = "state"
+# Expects state file
+incoming_arg = '-incoming "exec:cat {}"'
+# Restored guests need the same serial ports, the first one on the terminal
+console_serial_arg = "-serial mon:stdio"
 arm_env = {"QEMU_AUDIO_DRV": "none"}
 
 # Needs temp directory plus serial files
 logging_args = [
     "-serial file:{}/qemu.initial.serial.log",
     "-serial unix:{}/serial.S1,server,nowait",
-    "-monitor unix:{}/monitor,server,nowait",
+    "-qmp unix:{}/qmp,server,nowait",
 ]
 no_display_option = "-display none"
 
 verbose_arg = "-nographic"
 
+# Expects the four socket ports
 mips_network_args = [
     "-net nic,vlan=0",
-    "-net socket,vlan=0,listen=:2000",
+    "-net socket,vlan=0,listen=:{0}",
     "-net nic,vlan=1",
-    "-net socket,vlan=0,listen=:2001",
+    "-net socket,vlan=0,listen=:{1}",
     "-net nic,vlan=2",
-    "-net socket,vlan=0,listen=:2002",
+    "-net socket,vlan=0,listen=:{2}",
     "-net nic,vlan=3",
-    "-net socket,vlan=0,listen=:2003",
+    "-net socket,vlan=0,listen=:{3}",
 ]
+# Expects the first tap device
 extra_mips_net = [
     "-net nic,vlan=0",
-    "-net tap,vlan=0,id=net0,ifname=tap_0,script=no",
+    "-net tap,vlan=0,id=net0,ifname={},script=no",
 ]
+# Expects the four socket ports
 arm_network_args = [
     "-device virtio-net-device,netdev=net1",
-    "-netdev socket,listen=:2000,id=net1",
+    "-netdev socket,listen=:{0},id=net1",
     "-device virtio-net-device,netdev=net2",
-    "-netdev socket,listen=:2001,id=net2",
+    "-netdev socket,listen=:{1},id=net2",
     "-device virtio-net-device,netdev=net3",
-    "-netdev socket,listen=:2002,id=net3",
+    "-netdev socket,listen=:{2},id=net3",
     "-device virtio-net-device,netdev=net4",
-    "-netdev socket,listen=:2003,id=net4",
+    "-netdev socket,listen=:{3},id=net4",
 ]
 
+# Expects the first tap device
 extra_arm_net = [
     "-device virtio-net-device,netdev=net0",
-    "-netdev tap,id=net0,ifname=tap_0,script=no",
+    "-netdev tap,id=net0,ifname={},script=no",
 ]
 
-# Expects TAPDEV_I
-set_up_tunnel = "sudo tunctl -t {} -u root"
+# Expects dev or net, then the tap index. Kept apart from the net0 to net4
+# ids given on the command line.
+hotplug_id = "hot{}{}"
+
+# Used without an instance
+default_ports = [2000, 2001, 2002, 2003]
+default_tap_name = "tap_{}"
+
+# Expects TAPDEV_I, then the owner. Taps belong to the user running this, so
+# QEMU can open them without root.
+set_up_tunnel = "sudo tunctl -t {} -u {}"
 
 # Expects TAPDEV_I, HOSTNETDEV_I.VLANID, VLANID, HOSTNETDEV_I.VLANID
 set_up_vlan = [
@@ -95,24 +133,109 @@ vlan_down = "sudo ip link delete {}"
 # tap_dev
 del_dev = "sudo tunctl -d {}"
 
+# "netlink" applies each network bring-up or teardown in one privileged
+# process, "shell" runs the commands above one by one
+network_backend = os.environ.get(
+    "FW_EMULATOR_NET_BACKEND", "netlink" if netlink_helper.available() else "shell"
+)
+
+# Drops from root back to the user once in the namespace, so QEMU's sockets
+# and files stay the user's. Expects uid then gid.
+run_as_user = "setpriv --reuid={} --regid={} --init-groups"
+
+# Network namespace mode, replaces the leading sudo of a command
+# Expects namespace
+netns_exec = "sudo ip netns exec {} "
+
+# Expects namespace, host veth, namespace veth, host address, namespace address
+# and guest address. Connections to the namespace address reach the guest.
+netns_up = [
+    "sudo ip netns add {0}",
+    "sudo ip link add {1} type veth peer name {2}",
+    "sudo ip link set {2} netns {0}",
+    "sudo ip addr add {3}/30 dev {1}",
+    "sudo ip link set {1} up",
+    "sudo ip netns exec {0} ip addr add {4}/30 dev {2}",
+    "sudo ip netns exec {0} ip link set {2} up",
+    "sudo ip netns exec {0} ip link set lo up",
+    "sudo ip netns exec {0} sysctl -qw net.ipv4.ip_forward=1",
+    "sudo ip netns exec {0} iptables -t nat -A PREROUTING -i {2} -j DNAT --to-destination {5}",
+]
+
+# Expects tap dev. The guest sees forwarded connections come from its own subnet.
+netns_masquerade = "sudo iptables -t nat -A POSTROUTING -o {} -j MASQUERADE"
+
+# Expects namespace, takes the veth pair and tap devices with it
+netns_down = ["sudo ip netns del {}"]
+
 
 class QemuImage:
-    def __init__(self, arch, endianess, image, tmp_dir, debug=False):
+    def __init__(
+        self,
+        arch,
+        endianess,
+        image,
+        tmp_dir,
+        debug=False,
+        overlay=False,
+        snapshot=None,
+        instance=None,
+        netns=False,
+        profile=None,
+    ):
         self.arch = arch
         self.endianess = endianess
         self.image = image
+        self.overlay = overlay
+        # Ports, tap names and work directory unique on the host, see
+        # instance_helper
+        self.instance = instance
+        if tmp_dir is None and instance:
+            tmp_dir = instance.work_dir
+        # Taps and QEMU in the network namespace of the instance
+        if netns and not instance:
+            raise RuntimeError("Network namespaces need an instance")
+        self.netns = netns
+        # Readiness point to snapshot at: "network", a serial marker or None
+        self.snapshot = snapshot
         self.kernel = self.get_kernel()
+        # Memory, CPUs and TCG settings, see profile_helper
+        self.profile = profile or profile_helper.select_profile(arch, image)
         self.debug = debug
         self.tmp_dir = tmp_dir
         self.serial_file = "{}/qemu.initial.serial.log".format(tmp_dir)
         self.start_net = None
         self.stop_net = None
+        # The same as start_net and stop_net, for the netlink backend
+        self.start_plan = None
+        self.stop_plan = None
+        self.network_backend = network_backend
         self.ips = []
+        # Control connection to the running guest, see connect_qmp
+        self.qmp = None
+        # When the running guest was started, and its last readiness results
+        self.boot_started = None
+        self.readiness = []
+        # BootTimeline of the last boot followed on the serial log
+        self.timeline = None
 
     def start_network(self):
 
         for ip in self.ips:
-            logging.info("Device available on {}".format(ip))
+            if self.netns:
+                logging.info(
+                    "Device {} available on {}".format(ip, self.get_exposed_address())
+                )
+            else:
+                logging.info("Device available on {}".format(ip))
+
+        if self.start_net and self.use_netlink():
+            try:
+                # Rolled back if any step fails
+                netlink_helper.run_plan(self.start_plan)
+                return
+            except netlink_helper.NetlinkUnavailable as e:
+                self.use_shell(e)
 
         if self.start_net:
             for net_cmds in self.start_net:
@@ -124,6 +247,14 @@ class QemuImage:
 
     def stop_network(self):
 
+        if self.stop_net and self.use_netlink():
+            try:
+                # Goes through every step even if some fail
+                netlink_helper.run_plan(self.stop_plan, tolerant=True)
+                return
+            except netlink_helper.NetlinkUnavailable as e:
+                self.use_shell(e)
+
         if self.stop_net:
             for net_cmds in self.stop_net:
                 for cmd in net_cmds:
@@ -132,12 +263,29 @@ class QemuImage:
         else:
             logging.warning("Can't stop network. No network configured")
 
+    def use_netlink(self):
+
+        return self.network_backend == "netlink" and netlink_helper.available()
+
+    # For this image and the ones made after it
+    def use_shell(self, reason):
+
+        global network_backend
+
+        logging.warning("{}, running the network commands instead".format(reason))
+        self.network_backend = network_backend = "shell"
+
     def setup_network(self, timeout=60):
         logging.debug("Getting network information")
 
-        log = self.get_serial_log(timeout)
+        events = self.get_serial_events(timeout)
+
+        return self.configure_network(events)
+
+    # Sets up the network commands from the events of a boot
+    def configure_network(self, events):
 
-        net_info = self.get_network_info(log, self.endianess)
+        net_info = self.get_network_info(events, self.endianess)
         print(net_info)
 
         # If we get no network info, than we can't network :(
@@ -159,10 +307,13 @@ class QemuImage:
         iface_dev,
         vlan=None,
         mac=None,
-        tap_dev="tap_0",
-        host_net_dev="tap_0",
+        tap_dev=None,
+        host_net_dev=None,
     ):
 
+        tap_dev = tap_dev or self.get_tap_name(0)
+        host_net_dev = host_net_dev or tap_dev
+
         logging.debug("Adding {} {} {}".format(dev_ip, host_ip, iface_dev))
         self.ips.append(dev_ip)
         net_info = {}
@@ -195,9 +346,15 @@ class QemuImage:
             net_cmd.append(del_dev.format(network_dict["tap_dev"]))
             # Do routing
 
-            stop_network_commands.append(net_cmd)
+            stop_network_commands.append(self.in_netns(net_cmd))
+
+        if self.netns:
+            stop_network_commands.append(
+                [x.format(self.instance.netns) for x in netns_down]
+            )
 
         self.stop_net = stop_network_commands
+        self.stop_plan = self.get_stop_network_plan(network_list)
 
         return stop_network_commands
 
@@ -207,7 +364,7 @@ class QemuImage:
 
         for network_dict in network_list:
             # Setup with tunctl
-            net_cmd = [set_up_tunnel.format(network_dict["tap_dev"])]
+            net_cmd = [set_up_tunnel.format(network_dict["tap_dev"], os.getuid())]
 
             # Setup vlan
             if network_dict["vlan"]:
@@ -233,19 +390,204 @@ class QemuImage:
                 )
             )
 
-            start_network_commands.append(net_cmd)
+            if self.netns:
+                net_cmd.append(netns_masquerade.format(network_dict["tap_dev"]))
+
+            start_network_commands.append(self.in_netns(net_cmd))
+
+        if self.netns and network_list:
+            host_veth, netns_veth = self.instance.veths
+            start_network_commands.insert(
+                0,
+                [
+                    x.format(
+                        self.instance.netns,
+                        host_veth,
+                        netns_veth,
+                        self.instance.transit_addresses[0],
+                        self.instance.transit_addresses[1],
+                        network_list[0]["ip"],
+                    )
+                    for x in netns_up
+                ],
+            )
 
         self.start_net = start_network_commands
+        self.start_plan = self.get_start_network_plan(network_list)
 
         return start_network_commands
 
+    # Netlink operations doing what the start commands do, see netlink_helper
+    def get_start_network_plan(self, network_list):
+
+        netns = self.instance.netns if self.netns else None
+        plan = []
+
+        if self.netns and network_list:
+            host_veth, netns_veth = self.instance.veths
+            host_address, netns_address = self.instance.transit_addresses
+            plan.extend(
+                [
+                    ["netns_add", {"name": netns}],
+                    [
+                        "veth_add",
+                        {"name": host_veth, "peer": netns_veth, "peer_netns": netns},
+                    ],
+                    [
+                        "addr_add",
+                        {"name": host_veth, "address": host_address, "prefixlen": 30},
+                    ],
+                    ["link_up", {"name": host_veth}],
+                    [
+                        "addr_add",
+                        {
+                            "name": netns_veth,
+                            "address": netns_address,
+                            "prefixlen": 30,
+                            "netns": netns,
+                        },
+                    ],
+                    ["link_up", {"name": netns_veth, "netns": netns}],
+                    ["link_up", {"name": "lo", "netns": netns}],
+                    [
+                        "run",
+                        {
+                            "argv": ["sysctl", "-qw", "net.ipv4.ip_forward=1"],
+                            "netns": netns,
+                        },
+                    ],
+                    [
+                        "run",
+                        {
+                            "argv": [
+                                "iptables",
+                                "-t",
+                                "nat",
+                                "-A",
+                                "PREROUTING",
+                                "-i",
+                                netns_veth,
+                                "-j",
+                                "DNAT",
+                                "--to-destination",
+                                network_list[0]["ip"],
+                            ],
+                            "netns": netns,
+                        },
+                    ],
+                ]
+            )
+
+        for network_dict in network_list:
+            tap_dev = network_dict["tap_dev"]
+            host_net_dev = network_dict["host_net_dev"]
+
+            plan.append(
+                ["tap_add", {"name": tap_dev, "owner": os.getuid(), "netns": netns}]
+            )
+
+            if network_dict["vlan"]:
+                plan.append(
+                    [
+                        "vlan_add",
+                        {
+                            "link": tap_dev,
+                            "name": host_net_dev,
+                            "vlan_id": network_dict["vlan"],
+                            "netns": netns,
+                        },
+                    ]
+                )
+                plan.append(["link_up", {"name": tap_dev, "netns": netns}])
+            plan.append(["link_up", {"name": host_net_dev, "netns": netns}])
+
+            plan.append(
+                [
+                    "addr_add",
+                    {
+                        "name": tap_dev,
+                        "address": network_dict["host_ip"],
+                        "prefixlen": 24,
+                        "netns": netns,
+                    },
+                ]
+            )
+            plan.append(
+                [
+                    "route_add",
+                    {
+                        "dst": network_dict["ip"] + "/32",
+                        "gateway": network_dict["host_ip"],
+                        "name": tap_dev,
+                        "netns": netns,
+                    },
+                ]
+            )
+
+            if self.netns:
+                plan.append(
+                    [
+                        "run",
+                        {
+                            "argv": shlex.split(netns_masquerade.format(tap_dev))[1:],
+                            "netns": netns,
+                        },
+                    ]
+                )
+
+        return plan
+
+    def get_stop_network_plan(self, network_list):
+
+        netns = self.instance.netns if self.netns else None
+        plan = []
+
+        for network_dict in network_list:
+            tap_dev = network_dict["tap_dev"]
+            host_net_dev = network_dict["host_net_dev"]
+
+            plan.append(["route_flush", {"name": host_net_dev, "netns": netns}])
+            plan.append(["link_down", {"name": tap_dev, "netns": netns}])
+            if network_dict["vlan"]:
+                plan.append(["link_del", {"name": host_net_dev, "netns": netns}])
+            plan.append(["link_del", {"name": tap_dev, "netns": netns}])
+
+        if self.netns:
+            plan.append(["netns_del", {"name": netns}])
+
+        return plan
+
+    # Moves commands into the namespace of the instance in namespace mode
+    def in_netns(self, commands):
+
+        if not self.netns:
+            return commands
+
+        return [
+            x.replace("sudo ", netns_exec.format(self.instance.netns), 1)
+            for x in commands
+        ]
+
+    # Host side address the guest is reached on in namespace mode
+    def get_exposed_address(self):
+
+        return self.instance.transit_addresses[1]
+
+    # Prefix of the QEMU command, which has to run where its taps are
+    def get_run_prefix(self):
+
+        if self.netns and self.start_net:
+            return netns_exec.format(self.instance.netns)
+
+        return "sudo "
+
     def get_tap_info(self, network_info):
         tap_devs = []
         host_net_devs = []
         network_dicts = []
 
         for i, (ip, dev, vlan, mac) in enumerate(network_info):
-            tap_dev = "tap_{}".format(i)
+            tap_dev = self.get_tap_name(i)
             host_net_dev = tap_dev
             if vlan:
                 host_net_dev += ".{}".format(vlan)
@@ -263,13 +605,16 @@ class QemuImage:
 
         return network_dicts
 
-    # I hate this function. This needs to be reworked.
+    # data is the serial log (text or lines) or its EventTable
     def get_network_info(self, data, endianness):
         brifs = []
         vlans = []
         network = set()
         success = False
 
+        # Parsed once, every lookup below is a query on the table
+        data = serial_helper.parse_log(data, endianness)
+
         # find interfaces with non loopback ip addresses
         ifacesWithIps = self.findNonLoInterfaces(data, endianness)
 
@@ -312,39 +657,10 @@ class QemuImage:
         return ".".join([str(x) for x in tups])
 
     def findMacChanges(self, data, endianness):
-        lines = self.stripTimestamps(data)
-        candidates = filter(lambda l: l.startswith("ioctl_SIOCSIFHWADDR"), lines)
-
-        result = []
-        if endianness == "eb":
-            fmt = ">I"
-        elif endianness == "el":
-            fmt = "<I"
-        for c in candidates:
-            g = re.match(
-                r"^ioctl_SIOCSIFHWADDR\[[^\]]+\]: dev:([^ ]+) mac:0x([0-9a-f]+) 0x([0-9a-f]+)",
-                c,
-            )
-            if g:
-                (iface, mac0, mac1) = g.groups()
-                m0 = struct.pack(fmt, int(mac0, 16))[2:]
-                m1 = struct.pack(fmt, int(mac1, 16))
-                mac = "%02x:%02x:%02x:%02x:%02x:%02x" % struct.unpack("BBBBBB", m0 + m1)
-                result.append((iface, mac))
-        return result
+        return serial_helper.parse_log(data, endianness).macs()
 
     def findVlanInfoForDev(self, data, dev):
-        # lines = data.split("\r\n")
-        lines = self.stripTimestamps(data)
-        results = []
-        candidates = filter(lambda l: l.startswith("register_vlan_dev"), lines)
-        for c in candidates:
-            g = re.match(
-                r"register_vlan_dev\[[^\]]+\]: dev:%s vlan_id:([0-9]+)" % dev, c
-            )
-            if g:
-                results.append(int(g.group(1)))
-        return results
+        return serial_helper.parse_log(data, self.endianess).vlans(dev)
 
     def buildConfig(self, brif, iface, vlans, macs):
         # there should be only one ip
@@ -368,27 +684,42 @@ class QemuImage:
 
         return (ip, dev, vlan_id, mac)
 
+    def get_serial_events(self, timeout=60):
+        """
+        Boots the image until the network settles and returns the EventTable
+        of its serial log.
+        """
+        return self.watch_serial(timeout).table
+
     def get_serial_log(self, timeout=60):
 
-        logging.debug("Getting serial from {} second run".format(timeout))
+        self.watch_serial(timeout)
 
-        temp_debug = self.debug
+        with open(self.serial_file, "rb") as f:
+            return f.read().decode("utf-8", "ignore")
 
-        self.debug = False
-        command = self.build_run_command()
-        command = " ".join(command)
+    def watch_serial(self, timeout=60):
 
-        self.debug = temp_debug
+        logging.debug("Getting serial from {} second run".format(timeout))
+
+        command = self.get_boot_command()
+
+        self.prepare_drive()
 
-        command = shlex.split(command)
         logging.debug(command)
-        try:
-            subprocess.check_output(command, env=arm_env, timeout=timeout)
-        except:
-            logging.debug("done")
 
-        with open(self.serial_file, "rb") as f:
-            return f.read().decode("utf-8", "ignore")
+        # Stops as soon as the network settles or the guest fails
+        watcher = serial_helper.watch_boot(
+            command,
+            self.serial_file,
+            self.endianess,
+            timeout,
+            env=arm_env,
+            qmp_path=self.get_qmp_path(),
+        )
+        self.timeline = watcher.timeline
+
+        return watcher
 
     def run_interactive(self, networked=False):
 
@@ -397,16 +728,25 @@ class QemuImage:
 
         logging.debug("Press Ctrl+a then x to exit")
 
+        snapshot = self.get_snapshot()
+
         temp_debug = self.debug
 
         self.debug = True
 
-        command = self.build_run_command()
+        command = self.build_run_command(snapshot=snapshot)
         # grep_cmd = " | grep -v firmadyne"
         grep_cmd = " "
-        command = "sudo QEMU_AUDIO_DRV=none " + " ".join(command) + grep_cmd
+        command = (
+            self.get_run_prefix()
+            + "env QEMU_AUDIO_DRV=none "
+            + " ".join(command)
+            + grep_cmd
+        )
         self.debug = temp_debug
 
+        self.prepare_drive(snapshot)
+
         os.environ.update(arm_env)
         logging.debug(command)
         try:
@@ -420,55 +760,17 @@ class QemuImage:
     def stripTimestamps(self, data):
         lines = data.split("\n")
         # throw out the timestamps
-        lines = [re.sub(r"^\[[^\]]*\] firmadyne: ", "", l) for l in lines]
+        lines = [serial_helper.timestamp_pattern.sub("", l) for l in lines]
         return lines
 
     # Get the netwokr interfaces in the router, except 127.0.0.1
     def findNonLoInterfaces(self, data, endianness):
-        # lines = data.split("\r\n")
-        lines = self.stripTimestamps(data)
-        candidates = filter(
-            lambda l: l.startswith("__inet_insert_ifa"), lines
-        )  # logs for the inconfig process
-        result = []
-        if endianness == "Iend_BE":
-            fmt = ">I"
-        elif endianness == "Iend_LE":
-            fmt = "<I"
-        for c in candidates:
-            g = re.match(
-                r"^__inet_insert_ifa\[[^\]]+\]: device:([^ ]+) ifa:0x([0-9a-f]+)", c
-            )
-            if g:
-                (iface, addr) = g.groups()
-                addr = socket.inet_ntoa(struct.pack(fmt, int(addr, 16)))
-                if addr != "127.0.0.1" and addr != "0.0.0.0":
-                    result.append((iface, addr))
-        return result
+        return serial_helper.parse_log(data, endianness).addresses()
 
     def findIfacesForBridge(self, data, brif):
-        # lines = data.split("\r\n")
-        lines = self.stripTimestamps(data)
-        result = []
-        candidates = filter(
-            lambda l: l.startswith("br_dev_ioctl") or l.startswith("br_add_if"), lines
-        )
-        for c in candidates:
-            for p in [
-                r"^br_dev_ioctl\[[^\]]+\]: br:%s dev:(.*)",
-                r"^br_add_if\[[^\]]+\]: br:%s dev:(.*)",
-            ]:
-                pat = p % brif
-                g = re.match(pat, c)
-                if g:
-                    iface = g.group(1)
-                    # we only add it if the interface is not the bridge itself
-                    # there are images that call brctl addif br0 br0 (e.g., 5152)
-                    if iface != brif:
-                        result.append(iface.strip())
-        return result
-
-    def build_run_command(self):
+        return serial_helper.parse_log(data, self.endianess).bridge_members(brif)
+
+    def build_run_command(self, snapshot=None, drive=None):
 
         if self.arch not in qemu_commands.keys():
             raise (RuntimeError("{} not in qemu commands".format(self.arch)))
@@ -478,49 +780,362 @@ class QemuImage:
         if "mips" in self.arch:
             run_command.append(mips_board)
             if self.start_net:
-                run_command.extend(extra_mips_net)
+                run_command.extend(
+                    [x.format(self.get_tap_name(0)) for x in extra_mips_net]
+                )
             else:
-                run_command.extend(mips_network_args)
+                run_command.extend(
+                    [x.format(*self.get_ports()) for x in mips_network_args]
+                )
 
         elif "arm" in self.arch:
             run_command.append(arm_board)
             if self.start_net:
-                run_command.extend(extra_arm_net)
+                run_command.extend(
+                    [x.format(self.get_tap_name(0)) for x in extra_arm_net]
+                )
             else:
-                run_command.extend(arm_network_args)
+                run_command.extend(
+                    [x.format(*self.get_ports()) for x in arm_network_args]
+                )
 
         run_command.append(kernel_arg.format(self.kernel))
+        drive_path, drive_format = drive or self.get_drive(snapshot)
         if "mips" in self.arch:
-            run_command.append(drive_arg_mips.format(self.image))
+            run_command.append(drive_arg_mips.format(drive_path, drive_format))
         elif "arm" in self.arch:
-            run_command.append(drive_arg_arm.format(self.image))
+            run_command.append(drive_arg_arm.format(drive_path, drive_format))
 
-        if self.debug:
-            run_command.extend([machine_args[0].format(0), machine_args[1]])
+        # Restored guests keep the devices they were saved with
+        if self.debug and not snapshot:
+            run_command.append(machine_args[0].format(0))
         else:
-            run_command.extend([machine_args[0].format(1), machine_args[1]])
+            run_command.append(machine_args[0].format(1))
+        run_command.extend(
+            profile_helper.get_profile_args(self.profile, qemu_commands[self.arch])
+        )
 
-        if self.debug:
+        if self.debug and not snapshot:
             run_command.append(verbose_arg)
         else:
             logging_files_arg = [x.format(self.tmp_dir) for x in logging_args]
+            if self.debug:
+                logging_files_arg[0] = console_serial_arg
             run_command.extend(logging_files_arg)
             run_command.append(no_display_option)
 
+        if snapshot:
+            run_command.append(incoming_arg.format(snapshot.state))
+
         return run_command
 
-    def get_kernel(self):
+    # Headless command, with the serial logs and control sockets, as a list
+    def get_boot_command(self, snapshot=None, drive=None):
 
-        if "mips" in self.arch:
-            kernel_binary = "vmlinux.{}".format(self.arch)
+        temp_debug = self.debug
+        self.debug = False
+        command = self.build_run_command(snapshot=snapshot, drive=drive)
+        self.debug = temp_debug
+
+        # Taps only exist in the namespace, entering it takes root
+        if self.netns and self.start_net:
+            command = [
+                self.get_run_prefix(),
+                run_as_user.format(os.getuid(), os.getgid()),
+            ] + command
+
+        return shlex.split(" ".join(command))
+
+    # Snapshots only fit the devices and network they were taken with. The
+    # ports, taps and paths of the instance aren't in the saved state, so they
+    # are left out and another instance can restore them.
+    def get_snapshot_key(self):
+
+        runner = copy.copy(self)
+        runner.instance = None
+        runner.tmp_dir = ""
+        runner.debug = False
+        command = runner.build_run_command(drive=("", ""))
+
+        return hashlib.md5(" ".join(command).encode("utf-8")).hexdigest()
+
+    # Snapshots of the image as it is now. Changing it moves them elsewhere.
+    def get_snapshot_dir(self):
+
+        image_path = os.path.realpath(self.image)
+        info = os.stat(image_path)
+
+        return os.path.join(
+            snapshot_dir,
+            hashlib.md5(image_path.encode("utf-8")).hexdigest(),
+            "{}_{}".format(info.st_size, info.st_mtime_ns),
+        )
+
+    def find_snapshot(self):
+        """
+        Returns the snapshot for the current configuration and image contents,
+        taken by this run or an earlier one, or None.
+        """
+        path = os.path.join(self.get_snapshot_dir(), self.get_snapshot_key())
+        snapshot = Snapshot(
+            os.path.join(path, snapshot_disk_name),
+            os.path.join(path, snapshot_state_name),
+        )
+
+        # Only complete snapshots are moved there
+        if not os.path.exists(snapshot.state):
+            return None
+
+        return snapshot
+
+    def drop_snapshots(self):
+        """
+        Removes every snapshot of the image, for when it is about to change.
+        """
+        shutil.rmtree(os.path.dirname(self.get_snapshot_dir()), ignore_errors=True)
+
+    def get_snapshot(self, timeout=60):
+        """
+        Returns the snapshot for the current configuration, taking it first if
+        needed. Returns None when snapshots are off or the guest never got up.
+        """
+        if not self.snapshot:
+            return None
+
+        snapshot = self.find_snapshot()
+
+        if snapshot is None:
+            try:
+                snapshot = self.take_snapshot(timeout)
+            except (RuntimeError, OSError) as e:
+                logging.warning("Could not snapshot, booting instead: {}".format(e))
+                return None
+
+        return snapshot
+
+    def take_snapshot(self, timeout=60):
+        """
+        Boots the image until it reaches the readiness point and saves the
+        guest there.
+        """
+        snapshot, command, marker = self.prepare_snapshot()
+
+        watcher = serial_helper.watch_boot(
+            command,
+            self.serial_file,
+            self.endianess,
+            timeout,
+            env=arm_env,
+            marker=marker,
+            on_ready=lambda w: qmp_helper.save_state_now(
+                self.get_qmp_path(), snapshot.state
+            ),
+            qmp_path=self.get_qmp_path(),
+        )
+
+        return self.finish_snapshot(snapshot, watcher)
+
+    # Returns the snapshot to take, the command to boot for it and the serial
+    # marker to wait for. It is taken in a directory of its own, moved in place
+    # by finish_snapshot.
+    def prepare_snapshot(self):
+
+        base_dir = self.get_snapshot_dir()
+        os.makedirs(base_dir, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=self.get_snapshot_key() + ".", dir=base_dir)
+
+        snapshot = Snapshot(
+            os.path.join(path, snapshot_disk_name),
+            os.path.join(path, snapshot_state_name),
+        )
+        storage_helper.create_overlay(os.path.realpath(self.image), snapshot.disk)
+
+        command = self.get_boot_command(drive=(snapshot.disk, "qcow2"))
+        marker = None if self.snapshot == "network" else self.snapshot
+
+        logging.debug("Booting to take a snapshot at {}".format(self.snapshot))
+
+        return snapshot, command, marker
+
+    def finish_snapshot(self, snapshot, watcher):
+
+        self.timeline = watcher.timeline
+        temp_path = os.path.dirname(snapshot.disk)
+
+        if watcher.reason not in serial_helper.ready_reasons:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise RuntimeError("Guest stopped on {}".format(watcher.reason))
+
+        base_dir = os.path.dirname(temp_path)
+        path = os.path.join(base_dir, self.get_snapshot_key())
+
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Another run saved the same one first
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+        self.prune_snapshots(base_dir)
+
+        return self.find_snapshot()
+
+    # Removes the snapshots of earlier contents of the image, and of images
+    # that are gone
+    def prune_snapshots(self, base_dir):
+
+        image_dir = os.path.dirname(base_dir)
+
+        with open(os.path.join(image_dir, snapshot_image_name), "w") as f:
+            f.write(os.path.realpath(self.image))
+
+        for name in os.listdir(image_dir):
+            path = os.path.join(image_dir, name)
+            if path != base_dir and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+        for name in os.listdir(snapshot_dir):
+            try:
+                with open(os.path.join(snapshot_dir, name, snapshot_image_name)) as f:
+                    image_path = f.read()
+            except OSError:
+                continue
+
+            if not os.path.exists(image_path):
+                shutil.rmtree(os.path.join(snapshot_dir, name), ignore_errors=True)
+
+    def get_qmp_path(self):
+
+        return os.path.join(self.tmp_dir, "qmp")
+
+    async def connect_qmp(self, timeout=qmp_helper.connect_timeout):
+        """
+        Connects to the QMP socket of the running guest. Only guests started
+        without debug, or from a snapshot, have one.
+        """
+        self.qmp = await qmp_helper.QmpClient(self.get_qmp_path()).connect(timeout)
+
+        return self.qmp
+
+    async def close_qmp(self):
+
+        if self.qmp:
+            await self.qmp.close()
+            self.qmp = None
+
+    async def stop_guest(self, graceful=True, timeout=qmp_helper.powerdown_timeout):
+        """
+        Powers the guest down, or stops QEMU at once if not graceful, and
+        closes the connection.
+        """
+        if graceful:
+            await self.qmp.shutdown(timeout)
         else:
-            kernel_binary = "zImage.{}".format(self.arch)
+            await self.qmp.quit()
+
+        await self.close_qmp()
+
+    async def add_tap_device(self, index, mac=None):
+        """
+        Hot plugs a network card on tap device index of this guest, which has
+        to exist on the host already.
+        """
+        model = qmp_helper.hotplug_models["mips" if "mips" in self.arch else "arm"]
+
+        await self.qmp.add_net_device(
+            hotplug_id.format("dev", index),
+            hotplug_id.format("net", index),
+            self.get_tap_name(index),
+            model,
+            mac,
+        )
+
+    async def remove_tap_device(self, index):
+
+        await self.qmp.del_net_device(
+            hotplug_id.format("dev", index), hotplug_id.format("net", index)
+        )
 
-        binary_folder = os.path.join(parent_directory, "binaries")
+    def get_boot_timeline(self):
+        """
+        Returns the boot milestones of the last boot as a dict, from the
+        serial log left behind if the boot wasn't followed.
+        """
+        if self.timeline is None:
+            try:
+                with open(self.serial_file, "rb") as f:
+                    return serial_helper.parse_timeline(f, self.endianess).to_dict()
+            except OSError:
+                return None
 
-        return os.path.join(binary_folder, kernel_binary)
+        return self.timeline.to_dict()
 
-    def export(self, location, script_name="runner.sh", script_only=False):
+    def get_probe_addresses(self):
+
+        # Only the first address is forwarded out of a namespace
+        if self.netns and self.ips:
+            return [self.get_exposed_address()]
+
+        return list(self.ips)
+
+    async def wait_ready(
+        self, probes=None, deadline=probe_helper.default_deadline, until="any"
+    ):
+        """
+        Probes the services of the guest (see probe_helper) until they answer
+        or deadline seconds pass. Times are from the start of the guest when
+        known. Returns whether any answered.
+        """
+        self.readiness = await probe_helper.wait_all(
+            self.get_probe_addresses(), probes, deadline, self.boot_started, until
+        )
+
+        boot_latency = probe_helper.first_ready(self.readiness)
+        if boot_latency is not None:
+            logging.info("Serving {:.1f}s after boot".format(boot_latency))
+
+        return boot_latency is not None
+
+    def get_ports(self):
+
+        if self.instance:
+            return self.instance.ports
+
+        return default_ports
+
+    def get_tap_name(self, index):
+
+        if self.instance:
+            return self.instance.get_tap_name(index)
+
+        return default_tap_name.format(index)
+
+    def get_drive(self, snapshot=None):
+
+        if self.overlay or snapshot:
+            return os.path.join(self.tmp_dir, overlay_name), "qcow2"
+
+        return self.image, storage_helper.get_image_format(self.image)
+
+    # Every run starts from a fresh overlay on top of the untouched base, or of
+    # the disk of the snapshot it restores
+    def prepare_drive(self, snapshot=None):
+
+        if snapshot:
+            storage_helper.create_overlay(
+                os.path.abspath(snapshot.disk), self.get_drive(snapshot)[0]
+            )
+        elif self.overlay:
+            storage_helper.create_overlay(
+                os.path.abspath(self.image), self.get_drive()[0]
+            )
+
+    def get_kernel(self):
+
+        return get_kernel_path(self.arch)
+
+    def export(
+        self, location, script_name="runner.sh", script_only=False, image_format=None
+    ):
 
         runner_copy = copy.deepcopy(self)
 
@@ -530,12 +1145,21 @@ class QemuImage:
         bash_filename = script_name
         file_path = os.path.join(location, bash_filename)
 
+        image_path = self.image
+        snapshot = self.find_snapshot() if self.snapshot else None
+
+        # Only the blocks in use are copied or converted
         if not script_only:
             shutil.copy(self.kernel, location)
-            shutil.copy(self.image, location)
+            image_path = self.export_image(location, image_format)
+            if snapshot:
+                snapshot = self.export_snapshot(snapshot, location, image_path)
+        elif snapshot:
+            snapshot = None
+            logging.warning("Snapshot not exported without the image")
 
         runner_copy.kernel = self.kernel.split("/")[-1]
-        runner_copy.image = self.image.split("/")[-1]
+        runner_copy.image = image_path.split("/")[-1]
         runner_copy.tmp_dir = "."
         runner_copy.debug = True
 
@@ -548,7 +1172,20 @@ class QemuImage:
 
         bash_file += "\nset QEMU_AUDIO_DRV=none\n"
 
-        bash_file += "sudo " + " \\\n".join(runner_copy.build_run_command())
+        if self.overlay or snapshot:
+            base_image = snapshot.disk if snapshot else runner_copy.image
+            bash_file += (
+                storage_helper.overlay_cmd.format(
+                    base_image,
+                    storage_helper.get_image_format(base_image),
+                    runner_copy.get_drive(snapshot)[0],
+                )
+                + "\n"
+            )
+
+        bash_file += self.get_run_prefix() + " \\\n".join(
+            runner_copy.build_run_command(snapshot=snapshot)
+        )
 
         bash_file += "\n# Stop networking\n"
 
@@ -557,3 +1194,45 @@ class QemuImage:
 
         with open(file_path, "w") as f:
             f.write(bash_file)
+
+    def export_image(self, location, image_format=None):
+
+        source_format = storage_helper.get_image_format(self.image)
+
+        if image_format is None or image_format == source_format:
+            return storage_helper.sparse_copy(self.image, location)
+
+        image_base = os.path.splitext(os.path.basename(self.image))[0]
+        if image_format == "qcow2":
+            image_base += storage_helper.qcow2_suffix
+        else:
+            image_base += ".raw"
+
+        return storage_helper.convert_image(
+            self.image, os.path.join(location, image_base), image_format
+        )
+
+    # Returns the exported snapshot, relative to location
+    def export_snapshot(self, snapshot, location, image_path):
+
+        disk_path = os.path.join(location, "snapshot.qcow2")
+        state_path = os.path.join(location, "snapshot.state")
+
+        storage_helper.sparse_copy(snapshot.disk, disk_path)
+        storage_helper.rebase_image(disk_path, os.path.basename(image_path))
+        shutil.copy(snapshot.state, state_path)
+
+        return Snapshot(os.path.basename(disk_path), os.path.basename(state_path))
+
+
+# Suffix picks an alternate kernel, such as _3.2
+def get_kernel_path(arch, suffix=""):
+
+    if "mips" in arch:
+        kernel_binary = "vmlinux.{}{}".format(arch, suffix)
+    else:
+        kernel_binary = "zImage.{}{}".format(arch, suffix)
+
+    binary_folder = os.path.join(parent_directory, "binaries")
+
+    return os.path.join(binary_folder, kernel_binary)
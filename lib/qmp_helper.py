@@ -0,0 +1,398 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import socket
+import time
+
+# Seconds to wait for QEMU to create its socket, and for a command to complete
+connect_timeout = 10
+command_timeout = 30
+# Seconds the guest gets to power down before QEMU is told to quit
+powerdown_timeout = 30
+poll_interval = 0.25
+
+# Events kept for wait_event, newest last
+event_history = 64
+
+# Expects the state file
+migrate_uri = "exec:cat > {}"
+migrate_failed = ("failed", "cancelled")
+
+# Network devices that can be added to a running guest, by arch
+hotplug_models = {
+    "mips": "pcnet",
+    "arm": "virtio-net-pci",
+}
+
+
+class QmpError(RuntimeError):
+    """
+    Error returned by QEMU for a command, with its class, such as
+    GenericError or DeviceNotFound.
+    """
+
+    def __init__(self, command, error):
+        self.error_class = error.get("class")
+        super().__init__(
+            "{}: {} {}".format(command, self.error_class, error.get("desc"))
+        )
+
+
+class QmpClient(object):
+    """
+    asyncio client for the QEMU machine protocol on a Unix socket. Commands
+    and events share the socket: a reader task hands each response to the
+    command waiting on it, so one event loop can control many guests.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.pending = {}
+        self.next_id = 0
+        self.events = collections.deque(maxlen=event_history)
+        self.event_waiters = []
+        self.version = None
+
+    async def connect(self, timeout=connect_timeout):
+
+        deadline = time.time() + timeout
+
+        # QEMU creates the socket once it has started
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except OSError:
+                if time.time() >= deadline:
+                    raise
+                await asyncio.sleep(poll_interval)
+
+        greeting = json.loads(await self.reader.readline())
+        self.version = greeting["QMP"]["version"]["qemu"]
+
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+        await self.execute("qmp_capabilities")
+
+        return self
+
+    async def read_loop(self):
+
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+
+                message = json.loads(line)
+
+                if "event" in message:
+                    self.events.append(message)
+                    for names, future in self.event_waiters:
+                        if message["event"] in names and not future.done():
+                            future.set_result(message)
+                    continue
+
+                future = self.pending.pop(message.get("id"), None)
+                if future and not future.done():
+                    future.set_result(message)
+        finally:
+            error = ConnectionError("QMP connection to {} closed".format(self.path))
+            for future in list(self.pending.values()):
+                if not future.done():
+                    future.set_exception(error)
+            self.pending = {}
+            for _, future in self.event_waiters:
+                if not future.done():
+                    future.set_exception(error)
+
+    async def execute(self, command, arguments=None, timeout=command_timeout):
+        """
+        Runs a QMP command and returns its result. Raises QmpError if QEMU
+        refused it.
+        """
+        self.check_connected()
+
+        self.next_id += 1
+        request_id = self.next_id
+
+        request = {"execute": command, "id": request_id}
+        if arguments:
+            request["arguments"] = arguments
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+
+        self.writer.write(json.dumps(request).encode("utf-8") + b"\n")
+        await self.writer.drain()
+
+        try:
+            response = await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+        if "error" in response:
+            raise QmpError(command, response["error"])
+
+        return response.get("return")
+
+    async def wait_event(self, names, timeout=None, since=None):
+        """
+        Waits for one of the events in names and returns it. Events received
+        after since (a time from time.time) count as well.
+        """
+        if isinstance(names, str):
+            names = (names,)
+
+        if since is not None:
+            for event in self.events:
+                if event["event"] in names and event_time(event) >= since:
+                    return event
+
+        self.check_connected()
+
+        waiter = (names, asyncio.get_event_loop().create_future())
+        self.event_waiters.append(waiter)
+
+        try:
+            return await asyncio.wait_for(waiter[1], timeout)
+        finally:
+            self.event_waiters.remove(waiter)
+
+    def check_connected(self):
+
+        # Nothing would ever answer
+        if self.read_task is None or self.read_task.done():
+            raise ConnectionError("QMP connection to {} closed".format(self.path))
+
+    async def human_command(self, line):
+        """
+        Runs a human monitor command, for what QMP has no stable command.
+        """
+        return await self.execute("human-monitor-command", {"command-line": line})
+
+    # Life cycle
+
+    async def pause(self):
+        await self.execute("stop")
+
+    async def resume(self):
+        await self.execute("cont")
+
+    async def quit(self):
+        """
+        Stops QEMU at once. The connection closes with it.
+        """
+        try:
+            await self.execute("quit")
+        except ConnectionError:
+            pass
+
+    async def shutdown(self, timeout=powerdown_timeout):
+        """
+        Asks the guest to power down and waits for it, then stops QEMU.
+        Returns whether the guest powered down by itself.
+        """
+        since = time.time()
+        await self.execute("system_powerdown")
+
+        try:
+            await self.wait_event("SHUTDOWN", timeout, since)
+            clean = True
+        except ConnectionError:
+            # QEMU exits once the guest is off
+            return True
+        except asyncio.TimeoutError:
+            logging.debug("Guest didn't power down, quitting")
+            clean = False
+
+        await self.quit()
+
+        return clean
+
+    # Snapshots, internal to qcow2 drives
+
+    async def save_snapshot(self, name):
+        await self.check_human_command("savevm {}".format(name))
+
+    async def load_snapshot(self, name):
+        await self.check_human_command("loadvm {}".format(name))
+
+    async def delete_snapshot(self, name):
+        await self.check_human_command("delvm {}".format(name))
+
+    async def list_snapshots(self):
+        return await self.human_command("info snapshots")
+
+    async def check_human_command(self, line):
+
+        # These only print anything when they fail
+        output = await self.human_command(line)
+        if output.strip():
+            raise QmpError(line, {"class": "GenericError", "desc": output.strip()})
+
+    async def save_state(self, state_path, timeout=120):
+        """
+        Migrates the running guest to state_path, leaving it paused, so the
+        disk matches the saved state.
+        """
+        await self.execute(
+            "migrate", {"uri": migrate_uri.format(os.path.abspath(state_path))}
+        )
+
+        deadline = time.time() + timeout
+
+        while True:
+            status = (await self.execute("query-migrate")).get("status")
+
+            if status == "completed":
+                return
+            if status in migrate_failed or time.time() >= deadline:
+                raise RuntimeError("Could not save guest state: {}".format(status))
+
+            await asyncio.sleep(poll_interval)
+
+    # Network devices
+
+    async def add_net_device(self, device_id, netdev_id, ifname, model, mac=None):
+        """
+        Adds a network card to the guest, on the host tap device ifname.
+        """
+        await self.execute(
+            "netdev_add",
+            {
+                "type": "tap",
+                "id": netdev_id,
+                "ifname": ifname,
+                "script": "no",
+                "downscript": "no",
+            },
+        )
+
+        device = {"driver": model, "id": device_id, "netdev": netdev_id}
+        if mac:
+            device["mac"] = mac
+
+        try:
+            await self.execute("device_add", device)
+        except QmpError:
+            await self.execute("netdev_del", {"id": netdev_id})
+            raise
+
+    async def del_net_device(self, device_id, netdev_id, timeout=command_timeout):
+
+        since = time.time()
+        await self.execute("device_del", {"id": device_id})
+        # The guest has to let go of the device first
+        await self.wait_event("DEVICE_DELETED", timeout, since)
+
+        await self.execute("netdev_del", {"id": netdev_id})
+
+    async def set_link(self, name, up):
+        await self.execute("set_link", {"name": name, "up": up})
+
+    # Status
+
+    async def status(self):
+        """
+        Returns the run state, such as running, paused or shutdown.
+        """
+        return (await self.execute("query-status"))["status"]
+
+    async def health(self, timeout=5):
+        """
+        Returns whether QEMU answers, its run state and its virtual CPUs.
+        """
+        try:
+            status = await self.execute("query-status", timeout=timeout)
+            cpus = await self.execute("query-cpus-fast", timeout=timeout)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            return {"responsive": False, "error": str(e)}
+
+        return {
+            "responsive": True,
+            "status": status["status"],
+            "running": status["running"],
+            "cpus": len(cpus),
+        }
+
+    async def close(self):
+
+        if self.writer:
+            self.writer.close()
+        if self.read_task:
+            try:
+                await self.read_task
+            except ConnectionError:
+                pass
+        self.writer = None
+        self.read_task = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+def event_time(event):
+
+    timestamp = event.get("timestamp", {})
+
+    return timestamp.get("seconds", 0) + timestamp.get("microseconds", 0) / 1e6
+
+
+def quit_now(path, timeout=1):
+    """
+    Tells QEMU to quit, without an event loop. Returns whether it was told.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+
+    try:
+        sock.connect(path)
+        reader = sock.makefile("rb")
+        reader.readline()
+        for command in ("qmp_capabilities", "quit"):
+            sock.sendall(json.dumps({"execute": command}).encode("utf-8") + b"\n")
+            reader.readline()
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+    return True
+
+
+def save_state_now(path, state_path, timeout=120):
+    """
+    QmpClient.save_state, without an event loop.
+    """
+
+    async def save_state():
+        async with QmpClient(path) as client:
+            await client.save_state(state_path, timeout)
+
+    asyncio.run(save_state())
+
+
+async def quit_async(path, timeout=1):
+    """
+    The same as quit_now, on an event loop.
+    """
+    client = QmpClient(path)
+
+    try:
+        await asyncio.wait_for(client.connect(0), timeout)
+        await client.quit()
+    except (OSError, ValueError, asyncio.TimeoutError):
+        return False
+    finally:
+        await client.close()
+
+    return True
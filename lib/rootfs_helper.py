@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import stat
+import subprocess
+import tarfile
+
+# Suffix of the member index written next to uncompressed rootfs tars
+index_suffix = ".idx"
+
+# Expects source directory then destination directory
+copy_tree_cmd = ["cp", "-a", "{0}/.", "{1}"]
+
+
+class RootfsArtifact(object):
+    """
+    Root filesystem handed from the extractor to the later stages. It is
+    either a staged directory or a tar (uncompressed or compressed), which is
+    consumed in place rather than unpacked to a scratch directory first.
+    Uncompressed tars are indexed, so single members can be read by seeking.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.index = None
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def open_tar(self, stream=False):
+        """
+        Opens the tar, as a forward-only stream if requested.
+        """
+        return tarfile.open(self.path, "r|*" if stream else "r:*")
+
+    def extract_to(self, dest):
+        """
+        Populates dest with the root filesystem.
+        """
+        if self.is_dir():
+            copy_cmd = [x.format(self.path, dest) for x in copy_tree_cmd]
+            subprocess.check_call(copy_cmd)
+        else:
+            with self.open_tar(stream=True) as tar:
+                tar.extractall(path=dest)
+
+    def get_index(self):
+        """
+        Returns a dict of member name to (data offset, size, is regular file)
+        for an uncompressed tar, building and persisting it if needed. Returns None
+        for other artifacts.
+        """
+        if self.index is not None or self.is_dir():
+            return self.index
+
+        index_path = self.path + index_suffix
+
+        try:
+            if os.path.getmtime(index_path) >= os.path.getmtime(self.path):
+                with open(index_path) as f:
+                    self.index = json.load(f)
+                return self.index
+        except (OSError, ValueError):
+            pass
+
+        # Members of compressed tars can't be seeked to
+        try:
+            tar = tarfile.open(self.path, "r:")
+        except tarfile.ReadError:
+            return None
+
+        index = {}
+        with tar:
+            for member in tar:
+                index[normalize(member.name)] = (
+                    member.offset_data,
+                    member.size,
+                    member.isreg(),
+                )
+
+        self.index = index
+
+        try:
+            with open(index_path, "w") as f:
+                json.dump(index, f)
+        except OSError:
+            logging.debug("Could not write rootfs index {}".format(index_path))
+
+        return self.index
+
+    def read(self, name, size=-1):
+        """
+        Reads up to size bytes of the regular file name, relative to the
+        root. Returns None if it is not a regular file in the artifact.
+        """
+        name = normalize(name)
+
+        if self.is_dir():
+            file_path = os.path.join(self.path, name)
+            if os.path.islink(file_path) or not os.path.isfile(file_path):
+                return None
+            with open(file_path, "rb") as f:
+                return f.read(size)
+
+        index = self.get_index()
+
+        if index is not None:
+            if name not in index or not index[name][2]:
+                return None
+            offset, length, _ = index[name]
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                return f.read(length if size < 0 else min(size, length))
+
+        with self.open_tar() as tar:
+            for member in tar:
+                if normalize(member.name) == name:
+                    if not member.isreg():
+                        return None
+                    return tar.extractfile(member).read(size)
+        return None
+
+    def size(self):
+        """
+        Returns the total size in bytes of the regular files in the root
+        filesystem.
+        """
+        total = 0
+
+        if self.is_dir():
+            for path, _, files in os.walk(self.path):
+                for file_name in files:
+                    total += os.lstat(os.path.join(path, file_name)).st_size
+        else:
+            with self.open_tar(stream=True) as tar:
+                for member in tar:
+                    if member.isreg():
+                        total += member.size
+
+        return total
+
+    def footprint(self, block_size=4096):
+        """
+        Returns the space in bytes the root filesystem takes up once written
+        out, with every entry rounded up to whole blocks.
+        """
+        total = 0
+
+        def blocks(size):
+            return max(1, -(-size // block_size)) * block_size
+
+        if self.is_dir():
+            for path, dirs, files in os.walk(self.path):
+                total += blocks(0) * len(dirs)
+                for file_name in files:
+                    st = os.lstat(os.path.join(path, file_name))
+                    total += blocks(st.st_size if stat.S_ISREG(st.st_mode) else 0)
+            return total
+
+        index = self.get_index()
+
+        if index is not None:
+            for _, size, isreg in index.values():
+                total += blocks(size if isreg else 0)
+            return total
+
+        with self.open_tar(stream=True) as tar:
+            for member in tar:
+                total += blocks(member.size if member.isreg() else 0)
+
+        return total
+
+
+def normalize(name):
+
+    return os.path.normpath(name).lstrip("/")
+
+
+def open_artifact(root_fs):
+    """
+    Returns a RootfsArtifact for a path, an artifact or an open tarfile.
+    """
+    if isinstance(root_fs, RootfsArtifact):
+        return root_fs
+
+    if isinstance(root_fs, tarfile.TarFile):
+        return RootfsArtifact(root_fs.name)
+
+    return RootfsArtifact(root_fs)
@@ -0,0 +1,493 @@
+import asyncio
+import collections
+import io
+import json
+import logging
+import os
+import re
+import socket
+import struct
+import subprocess
+import time
+from lib import qmp_helper
+
+# Seconds without a new network event, once an address is assigned, before the
+# network configuration is considered stable
+settle_time = 8
+poll_interval = 0.25
+# Bytes of log read at a time
+read_size = 1024 ** 2
+# Seconds QEMU gets to exit before it is killed
+stop_timeout = 5
+
+timestamp_pattern = re.compile(r"^\[[^\]]*\] firmadyne: ")
+
+# Firmadyne events that change the network configuration, to the kind of
+# event and the pattern of their arguments
+network_events = {
+    "__inet_insert_ifa": ("address", re.compile(r"device:([^ ]+) ifa:0x([0-9a-f]+)")),
+    "br_add_if": ("bridge", re.compile(r"br:([^ ]+) dev:(.*)")),
+    "br_dev_ioctl": ("bridge", re.compile(r"br:([^ ]+) dev:(.*)")),
+    "register_vlan_dev": ("vlan", re.compile(r"dev:([^ ]+) vlan_id:([0-9]+)")),
+    "ioctl_SIOCSIFHWADDR": (
+        "mac",
+        re.compile(r"dev:([^ ]+) mac:0x([0-9a-f]+) 0x([0-9a-f]+)"),
+    ),
+}
+# Expects the event name then its arguments, with or without timestamp
+event_pattern = re.compile(
+    r"^(?:\[[^\]]*\] firmadyne: )?({})\[[^\]]+\]: (.*)".format("|".join(network_events))
+)
+
+# The guest won't get any further
+panic_signatures = ("Kernel panic", "Rebooting in ")
+reboot_signatures = ("reboot: Restarting system", "Restarting system.")
+# Printed once per boot, a second one means the guest rebooted
+boot_signature = "Linux version "
+
+ignored_addresses = ("127.0.0.1", "0.0.0.0")
+
+# Reasons for which the guest is considered up
+ready_reasons = ("network", "marker")
+
+# Kernel timestamp of a line, in seconds since the guest booted
+kernel_time_pattern = re.compile(r"^\[\s*(\d+\.\d+)\]")
+
+# Boot milestones, in the order they are expected, to the pattern of the first
+# line that reaches them or the kind of the first network event that does
+boot_milestones = [
+    ("kernel", re.compile(r"Linux version ")),
+    ("rootfs", re.compile(r"VFS: Mounted root")),
+    ("preinit", re.compile(r"preInit\.sh")),
+    ("init", re.compile(r"do_execve\[[^\]]*\]: argv:\s*\S*/(?:init|rcS|linuxrc)\b")),
+    ("address", "address"),
+    ("bridge", "bridge"),
+    ("listen", re.compile(r"inet_bind\[.*SOCK_STREAM")),
+]
+
+# Parsed event, dev is the interface (or bridge) it applies to
+Event = collections.namedtuple("Event", ["kind", "dev", "value", "line"])
+
+
+class EventTable(object):
+    """
+    Network events of a firmadyne serial log, parsed in one pass and grouped
+    by kind and by device. Only the events are kept, not the log.
+    """
+
+    def __init__(self, endianness):
+        self.fmt = ">I" if endianness == "Iend_BE" else "<I"
+        self.events = collections.defaultdict(list)
+        self.devices = collections.defaultdict(list)
+        self.line_count = 0
+
+    def feed(self, line):
+        """
+        Parses one line of the log. Returns its Event, or None.
+        """
+        self.line_count += 1
+
+        match = event_pattern.match(line)
+        if not match:
+            return None
+
+        name, args = match.groups()
+        kind, args_pattern = network_events[name]
+
+        args = args_pattern.match(args.rstrip("\r\n"))
+        if not args:
+            return None
+
+        if kind == "address":
+            dev, addr = args.groups()
+            value = socket.inet_ntoa(struct.pack(self.fmt, int(addr, 16)))
+        elif kind == "bridge":
+            dev, value = args.group(1), args.group(2).strip()
+        elif kind == "vlan":
+            dev, value = args.group(1), int(args.group(2))
+        else:
+            dev, mac0, mac1 = args.groups()
+            m0 = struct.pack(self.fmt, int(mac0, 16))[2:]
+            m1 = struct.pack(self.fmt, int(mac1, 16))
+            value = "%02x:%02x:%02x:%02x:%02x:%02x" % struct.unpack("BBBBBB", m0 + m1)
+
+        event = Event(kind, dev, value, self.line_count)
+        self.events[kind].append(event)
+        self.devices[(kind, dev)].append(event)
+
+        return event
+
+    def feed_all(self, lines):
+
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", "ignore")
+            self.feed(line)
+
+        return self
+
+    def addresses(self):
+        """
+        Returns (interface, address) of every non loopback address assigned.
+        """
+        return [
+            (x.dev, x.value)
+            for x in self.events["address"]
+            if x.value not in ignored_addresses
+        ]
+
+    def bridge_members(self, bridge):
+        """
+        Returns the interfaces added to the bridge, without itself.
+        """
+        return [x.value for x in self.devices[("bridge", bridge)] if x.value != bridge]
+
+    def vlans(self, dev):
+        return [x.value for x in self.devices[("vlan", dev)]]
+
+    def macs(self):
+        return [(x.dev, x.value) for x in self.events["mac"]]
+
+
+def parse_log(data, endianness):
+    """
+    Returns the EventTable of a log given as text, as an iterable of lines
+    (such as an open file) or as an EventTable already.
+    """
+    if isinstance(data, EventTable):
+        return data
+
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", "ignore")
+
+    if isinstance(data, str):
+        data = io.StringIO(data)
+
+    return EventTable(endianness).feed_all(data)
+
+
+class BootTimeline(object):
+    """
+    When each boot milestone was reached, in host time (seconds since start,
+    when the log was read as it was written) and guest time (the kernel
+    timestamp of the line).
+    """
+
+    def __init__(self, start=None):
+        self.start = start
+        self.milestones = {}
+
+    def feed(self, line, line_count, now=None, event=None):
+
+        for name, match in boot_milestones:
+            if name in self.milestones:
+                continue
+
+            if isinstance(match, str):
+                reached = event is not None and event.kind == match
+            else:
+                reached = match.search(line) is not None
+
+            if reached:
+                guest_time = kernel_time_pattern.match(line)
+                self.milestones[name] = {
+                    "host": None if self.start is None else now - self.start,
+                    "guest": float(guest_time.group(1)) if guest_time else None,
+                    "line": line_count,
+                }
+
+    def last(self):
+        """
+        Returns the last milestone reached, where a stalled boot stopped.
+        """
+        reached = [x for x, _ in boot_milestones if x in self.milestones]
+
+        return reached[-1] if reached else None
+
+    def to_dict(self):
+
+        return {
+            "start": self.start,
+            "last": self.last(),
+            "milestones": [
+                dict(
+                    name=name,
+                    **self.milestones.get(
+                        name, {"host": None, "guest": None, "line": None}
+                    )
+                )
+                for name, _ in boot_milestones
+            ],
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+
+def parse_timeline(data, endianness):
+    """
+    Returns the BootTimeline of a log already written, in guest time only.
+    """
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", "ignore")
+
+    if isinstance(data, str):
+        data = io.StringIO(data)
+
+    table = EventTable(endianness)
+    timeline = BootTimeline()
+
+    for line in data:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "ignore")
+        timeline.feed(line, table.line_count + 1, event=table.feed(line))
+
+    return timeline
+
+
+class SerialWatcher(object):
+    """
+    Follows a serial log while the guest boots, and tells when it is no use
+    waiting any longer: the network configuration settled (or marker was
+    printed, if given), or the guest panicked or rebooted.
+    """
+
+    def __init__(self, log_path, endianness, settle=settle_time, marker=None):
+        self.log_path = log_path
+        self.table = EventTable(endianness)
+        self.settle = settle
+        self.marker = marker
+        self.last_event = None
+        self.boots = 0
+        self.reason = None
+        self.offset = 0
+        self.partial = b""
+        self.timeline = BootTimeline(time.time())
+
+    def feed(self, line, now=None):
+        """
+        Updates the state from one line of the log.
+        """
+        now = time.time() if now is None else now
+
+        if self.marker and self.marker in line:
+            self.reason = "marker"
+
+        event = self.table.feed(line)
+        self.timeline.feed(line, self.table.line_count, now, event)
+
+        if event:
+            self.last_event = now
+        elif boot_signature in line:
+            self.boots += 1
+            if self.boots > 1:
+                self.reason = "reboot"
+        elif any(x in line for x in panic_signatures):
+            self.reason = "panic"
+        elif any(x in line for x in reboot_signatures):
+            self.reason = "reboot"
+
+    def read(self, now=None):
+        """
+        Feeds the lines appended to the log since the last read.
+        """
+        try:
+            f = open(self.log_path, "rb")
+        except OSError:
+            return
+
+        with f:
+            f.seek(self.offset)
+            while True:
+                data = f.read(read_size)
+                if not data:
+                    break
+                self.offset += len(data)
+
+                lines = (self.partial + data).split(b"\n")
+                self.partial = lines.pop()
+
+                for line in lines:
+                    self.feed(line.decode("utf-8", "ignore").rstrip("\r"), now)
+
+    def stable(self, now=None):
+
+        now = time.time() if now is None else now
+
+        return bool(self.table.addresses()) and now - self.last_event >= self.settle
+
+    def check(self, exited, deadline):
+        """
+        Reads the log and returns why to stop watching, or None.
+        """
+        now = time.time()
+        self.read(now)
+
+        if self.reason:
+            pass
+        elif self.marker is None and self.stable(now):
+            self.reason = "network"
+        elif exited:
+            self.reason = "exit"
+        elif now >= deadline:
+            self.reason = "timeout"
+
+        return self.reason
+
+    def watch(self, proc, timeout):
+        """
+        Follows the log until the network is stable, the guest fails, QEMU
+        exits or timeout seconds pass. Returns why it stopped.
+        """
+        deadline = time.time() + timeout
+
+        while not self.check(proc.poll() is not None, deadline):
+            time.sleep(poll_interval)
+
+        return self.finish()
+
+    async def watch_async(self, proc, timeout):
+        """
+        The same as watch, for an asyncio subprocess.
+        """
+        deadline = time.time() + timeout
+
+        while not self.check(proc.returncode is not None, deadline):
+            await asyncio.sleep(poll_interval)
+
+        return self.finish()
+
+    def finish(self):
+
+        # Lines written while stopping are still wanted
+        self.read()
+        if self.partial:
+            self.feed(self.partial.decode("utf-8", "ignore").rstrip("\r"))
+            self.partial = b""
+
+        return self.reason
+
+
+def stop_process(proc, qmp_path=None):
+    """
+    Stops QEMU, asking it to quit through QMP first if it has a socket.
+    """
+    if proc.poll() is not None:
+        return
+
+    if qmp_path and qmp_helper.quit_now(qmp_path):
+        try:
+            proc.wait(stop_timeout)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+    proc.terminate()
+
+    try:
+        proc.wait(stop_timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+async def stop_process_async(proc, qmp_path=None):
+    """
+    The same as stop_process, for an asyncio subprocess.
+    """
+    if proc.returncode is not None:
+        return
+
+    if qmp_path and await qmp_helper.quit_async(qmp_path):
+        try:
+            await asyncio.wait_for(proc.wait(), stop_timeout)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+    proc.terminate()
+
+    try:
+        await asyncio.wait_for(proc.wait(), stop_timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+
+def watch_boot(
+    command,
+    log_path,
+    endianness,
+    timeout,
+    env=None,
+    settle=settle_time,
+    marker=None,
+    on_ready=None,
+    qmp_path=None,
+):
+    """
+    Boots command and returns the SerialWatcher that followed log_path, once
+    the guest has been stopped. on_ready is called with the watcher while the
+    guest still runs, if it got up. QEMU is stopped through qmp_path if given.
+    """
+    if os.path.exists(log_path):
+        os.remove(log_path)
+
+    watcher = SerialWatcher(log_path, endianness, settle, marker)
+
+    proc = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+
+    try:
+        watcher.watch(proc, timeout)
+        if on_ready and watcher.reason in ready_reasons:
+            on_ready(watcher)
+    finally:
+        stop_process(proc, qmp_path)
+
+    logging.debug(
+        "Serial watch stopped on {} after {} addresses".format(
+            watcher.reason, len(watcher.table.addresses())
+        )
+    )
+
+    return watcher
+
+
+async def watch_boot_async(
+    command,
+    log_path,
+    endianness,
+    timeout,
+    env=None,
+    settle=settle_time,
+    marker=None,
+    on_ready=None,
+    qmp_path=None,
+):
+    """
+    The same as watch_boot, on an event loop. on_ready is a coroutine
+    function.
+    """
+    if os.path.exists(log_path):
+        os.remove(log_path)
+
+    watcher = SerialWatcher(log_path, endianness, settle, marker)
+
+    proc = await asyncio.create_subprocess_exec(
+        *command, env=env, stdout=subprocess.DEVNULL
+    )
+
+    try:
+        await watcher.watch_async(proc, timeout)
+        if on_ready and watcher.reason in ready_reasons:
+            await on_ready(watcher)
+    finally:
+        await stop_process_async(proc, qmp_path)
+
+    logging.debug(
+        "Serial watch stopped on {} after {} addresses".format(
+            watcher.reason, len(watcher.table.addresses())
+        )
+    )
+
+    return watcher
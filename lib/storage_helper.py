@@ -0,0 +1,72 @@
+import logging
+import os
+import subprocess
+
+# Copies only allocated blocks, sharing them outright where the filesystem
+# supports reflinks
+# Expects source then destination
+sparse_copy_cmd = 'cp --reflink=auto --sparse=always "{}" "{}"'
+
+# Copy-on-write qcow2 overlay on top of a base image
+# Expects base image, base image format, overlay path
+overlay_cmd = 'qemu-img create -q -f qcow2 -b "{}" -F {} "{}"'
+
+# Only clusters that are in use end up in the output
+# Expects output format, source, destination
+convert_cmd = 'qemu-img convert -q -O {} "{}" "{}"'
+
+# Points an overlay at another copy of its base, without touching the data
+# Expects new base image, its format, overlay path
+rebase_cmd = 'qemu-img rebase -q -u -b "{}" -F {} "{}"'
+
+qcow2_suffix = ".qcow2"
+
+
+def get_image_format(image_path):
+
+    return "qcow2" if image_path.endswith(qcow2_suffix) else "raw"
+
+
+def sparse_copy(src, dst):
+
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    subprocess.check_call(sparse_copy_cmd.format(src, dst), shell=True)
+
+    return dst
+
+
+def create_overlay(base_path, overlay_path):
+
+    if os.path.exists(overlay_path):
+        os.remove(overlay_path)
+
+    logging.debug("Creating overlay {} on {}".format(overlay_path, base_path))
+
+    run_cmd = overlay_cmd.format(base_path, get_image_format(base_path), overlay_path)
+
+    subprocess.check_call(run_cmd, shell=True)
+
+    return overlay_path
+
+
+def convert_image(src, dst, image_format="qcow2"):
+
+    run_cmd = convert_cmd.format(image_format, src, dst)
+
+    subprocess.check_call(run_cmd, shell=True)
+
+    return dst
+
+
+def get_allocated_size(image_path):
+
+    return os.stat(image_path).st_blocks * 512
+
+
+def rebase_image(image_path, base_path):
+
+    run_cmd = rebase_cmd.format(base_path, get_image_format(base_path), image_path)
+
+    subprocess.check_call(run_cmd, shell=True)
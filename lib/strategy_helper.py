@@ -0,0 +1,245 @@
+import asyncio
+import collections
+import logging
+import os
+import shutil
+from lib import image_helper
+from lib import index_helper
+from lib import instance_helper
+from lib import qemu_runner
+from lib import serial_helper
+from lib import storage_helper
+
+# A way to boot the firmware. kernel is the suffix of an alternate kernel
+# (vmlinux.<arch><kernel>), force_network runs force_network.sh at boot and
+# nvram sets nvram_overrides.
+Strategy = collections.namedtuple(
+    "Strategy", ["name", "kernel", "force_network", "nvram"]
+)
+
+# Tried at once, earlier ones win ties
+default_strategies = [
+    Strategy("default", None, False, False),
+    Strategy("forced", None, True, False),
+    Strategy("nvram", None, False, True),
+    Strategy("forced_nvram", None, True, True),
+    Strategy("kernel_3.2", "_3.2", False, False),
+    Strategy("kernel_3.2_forced", "_3.2", True, False),
+]
+
+# Values most firmware looks up to configure its LAN
+nvram_overrides = {
+    "lan_ipaddr": "192.168.0.1",
+    "lan_netmask": "255.255.255.0",
+    "lan_proto": "static",
+    "lan_if": "br0",
+    "restore_defaults": "1",
+}
+
+# Seconds each candidate boots for, and candidates booting at once
+boot_timeout = 60
+max_concurrent = len(default_strategies)
+
+# Edited candidates get a copy of the image, reflinked where the filesystem can
+clone_name = "image.raw"
+
+# Winning configuration, its runner holds the instance of the candidate
+StrategyResult = collections.namedtuple(
+    "StrategyResult", ["strategy", "runner", "image"]
+)
+
+
+class Candidate(object):
+    """
+    One strategy booted from its own copy-on-write view of the base image, on
+    an instance of its own.
+    """
+
+    def __init__(self, strategy, image, arch, endianess, netns=False, profile=None):
+        self.strategy = strategy
+        self.base_image = image
+        self.arch = arch
+        self.endianess = endianess
+        self.netns = netns
+        self.profile = profile
+        self.instance = None
+        self.runner = None
+        self.image = None
+
+    def is_available(self):
+
+        return self.strategy.kernel is None or os.path.exists(self.get_kernel())
+
+    def get_kernel(self):
+
+        return qemu_runner.get_kernel_path(self.arch, self.strategy.kernel or "")
+
+    def edits(self):
+
+        return self.strategy.force_network or self.strategy.nvram
+
+    def prepare(self):
+        """
+        Sets up the disk and the runner. Blocking, the image may be mounted.
+        """
+        self.instance = instance_helper.allocate()
+
+        if self.edits():
+            self.image = storage_helper.sparse_copy(
+                self.base_image, os.path.join(self.instance.work_dir, clone_name)
+            )
+            index_path = index_helper.get_index_path(self.base_image)
+            if os.path.exists(index_path):
+                shutil.copy(index_path, index_helper.get_index_path(self.image))
+
+            with image_helper.edit_session(
+                self.instance.work_dir, self.image
+            ) as session:
+                if self.strategy.force_network:
+                    session.force_networking()
+                    session.del_file("/sbin/reboot")
+                if self.strategy.nvram:
+                    session.set_nvram(nvram_overrides)
+        else:
+            self.image = self.base_image
+
+        # The base image is only ever read
+        self.runner = qemu_runner.QemuImage(
+            self.arch,
+            self.endianess,
+            self.image,
+            None,
+            overlay=not self.edits(),
+            instance=self.instance,
+            netns=self.netns,
+            profile=self.profile,
+        )
+        self.runner.kernel = self.get_kernel()
+        self.runner.prepare_drive()
+
+    async def run(self, timeout):
+        """
+        Boots the candidate until its network settles. Returns whether it did.
+        """
+        loop = asyncio.get_event_loop()
+
+        prepare = loop.run_in_executor(None, self.prepare)
+        try:
+            await asyncio.shield(prepare)
+        except asyncio.CancelledError:
+            # The image may be mounted, cleaning up has to wait
+            await prepare
+            raise
+
+        runner = self.runner
+
+        watcher = await serial_helper.watch_boot_async(
+            runner.get_boot_command(),
+            runner.serial_file,
+            runner.endianess,
+            timeout,
+            env=qemu_runner.arm_env,
+            qmp_path=runner.get_qmp_path(),
+        )
+        runner.timeline = watcher.timeline
+
+        logging.debug(
+            "Strategy {} stopped on {}".format(self.strategy.name, watcher.reason)
+        )
+
+        return runner.configure_network(watcher.table)
+
+    def release(self):
+
+        if self.instance:
+            self.instance.release()
+            self.instance = None
+
+
+async def search(
+    image,
+    arch,
+    endianess,
+    strategies=None,
+    timeout=boot_timeout,
+    concurrency=max_concurrent,
+    netns=False,
+    profile=None,
+):
+    """
+    Boots every strategy at once, concurrency at a time, and returns the
+    StrategyResult of the first one whose network comes up, or None. The
+    others are cancelled, and image is never written to.
+    """
+    candidates = [
+        Candidate(x, image, arch, endianess, netns, profile)
+        for x in strategies or default_strategies
+    ]
+    candidates = [x for x in candidates if x.is_available()]
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(candidate):
+        async with semaphore:
+            return await candidate.run(timeout)
+
+    tasks = {asyncio.ensure_future(run(x)): x for x in candidates}
+    winner = None
+
+    try:
+        pending = set(tasks)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            # Earlier strategies first when several finish together
+            for task in sorted(done, key=lambda x: candidates.index(tasks[x])):
+                if task.exception():
+                    logging.warning(
+                        "Strategy {} failed: {}".format(
+                            tasks[task].strategy.name, task.exception()
+                        )
+                    )
+                elif task.result():
+                    winner = tasks[task]
+                    break
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Lets the losers stop QEMU before their instances go
+        if tasks:
+            await asyncio.wait(tasks)
+
+        for candidate in candidates:
+            if candidate is not winner:
+                candidate.release()
+
+    if winner is None:
+        return None
+
+    logging.info("Strategy {} brought the network up".format(winner.strategy.name))
+
+    return StrategyResult(winner.strategy, winner.runner, winner.image)
+
+
+def find_strategy(image, arch, endianess, **kwargs):
+    """
+    Blocking entry point for search.
+    """
+    return asyncio.run(search(image, arch, endianess, **kwargs))
+
+
+def promote(result, image):
+    """
+    Makes the image of the winning strategy the image at image, for the
+    runner to be exported with it. Strategies that didn't edit the image
+    leave it as is.
+    """
+    if result.image != image:
+        os.replace(result.image, image)
+        index_path = index_helper.get_index_path(result.image)
+        if os.path.exists(index_path):
+            os.replace(index_path, index_helper.get_index_path(image))
+
+    result.runner.image = image
+    result.runner.overlay = False
@@ -0,0 +1,198 @@
+import asyncio
+import os
+import sys
+import textwrap
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import instance_helper
+from lib import orchestrator
+from lib import qemu_runner
+from lib import serial_helper
+from lib import storage_helper
+
+# Prints a boot with one interface to the serial log, serves QMP (saving the
+# state on migrate) and records its command line and QMP commands
+fake_qemu = textwrap.dedent(
+    """\
+    #!{python}
+    import asyncio, json, os, re, sys
+
+    args = " ".join(sys.argv)
+    log = re.search(r"-serial file:(\\S+)", args).group(1)
+    qmp = re.search(r"-qmp unix:([^,]+),", args).group(1)
+    with open(os.path.join(os.path.dirname(__file__), "argv"), "a") as f:
+        f.write(args + "\\n")
+
+    async def handle(reader, writer):
+        writer.write(b'{{"QMP": {{"version": {{"qemu": {{"major": 5}}}}}}}}\\n')
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            message = json.loads(line)
+            with open(os.path.join(os.path.dirname(__file__), "qmp"), "a") as f:
+                f.write(message["execute"] + "\\n")
+            result = {{}}
+            if message["execute"] == "query-status":
+                result = {{"status": "running", "running": True}}
+            elif message["execute"] == "migrate":
+                with open(message["arguments"]["uri"].split("> ")[1], "w") as f:
+                    f.write("state")
+            elif message["execute"] == "query-migrate":
+                result = {{"status": "completed"}}
+            writer.write(
+                json.dumps({{"return": result, "id": message.get("id")}}).encode()
+                + b"\\n"
+            )
+            await writer.drain()
+            if message["execute"] in ("quit", "system_powerdown"):
+                os._exit(0)
+
+    async def main():
+        await asyncio.start_unix_server(handle, qmp)
+        with open(log, "w") as f:
+            f.write("Linux version 2.6.39\\n")
+            f.write(
+                "[    1.0] firmadyne: __inet_insert_ifa[PID: 1 (ip)]: "
+                "device:eth0 ifa:0x0100a8c0\\n"
+            )
+        await asyncio.sleep(60)
+
+    asyncio.run(main())
+    """
+)
+
+
+def make_guest(tmp_path, monkeypatch, netns=False):
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    qemu = bin_dir / "qemu-system-mipsel"
+    qemu.write_text(fake_qemu.format(python=sys.executable))
+    qemu.chmod(0o755)
+
+    monkeypatch.setattr(
+        qemu_runner, "arm_env", {"PATH": "{}:{}".format(bin_dir, os.defpath)}
+    )
+    monkeypatch.setattr(
+        instance_helper,
+        "manager",
+        instance_helper.InstanceManager(str(tmp_path / "instances"), max_count=64),
+    )
+    # Settles as soon as the interface is up
+    for watch_boot in (serial_helper.watch_boot, serial_helper.watch_boot_async):
+        monkeypatch.setattr(watch_boot, "__defaults__", (None, 0.5, None, None, None))
+
+    image = qemu_runner.QemuImage(
+        "mipsel",
+        "little",
+        str(tmp_path / "image.raw"),
+        None,
+        instance=instance_helper.allocate(),
+        netns=netns,
+    )
+
+    # Setting up the host network takes root, the commands are checked instead
+    calls = []
+    monkeypatch.setattr(image, "start_network", lambda: calls.append("start"))
+    monkeypatch.setattr(image, "stop_network", lambda: calls.append("stop"))
+
+    return image, calls, bin_dir
+
+
+def test_start_guest_with_network(tmp_path, monkeypatch):
+
+    image, calls, bin_dir = make_guest(tmp_path, monkeypatch)
+    statuses = []
+
+    async def on_running(image):
+        statuses.append(await image.qmp.status())
+
+    result = asyncio.run(
+        orchestrator.Orchestrator(timeouts={"stop": 5}).emulate(
+            image, run_time=0.5, on_running=on_running
+        )
+    )
+
+    assert result.ok, result.to_dict()
+    assert result.ips == ["192.168.0.1"]
+    assert calls == ["start", "stop"]
+    assert statuses == ["running"]
+
+    # The taps are the user's, and QEMU opened them without sudo
+    tap = image.get_tap_name(0)
+    assert image.start_net[0][0] == qemu_runner.set_up_tunnel.format(tap, os.getuid())
+    assert image.start_plan[0][1]["owner"] == os.getuid()
+
+    booted = (bin_dir / "argv").read_text().splitlines()
+    assert len(booted) == 2
+    assert "ifname={}".format(tap) in booted[1]
+
+
+def test_orchestrator_runs_again(tmp_path, monkeypatch):
+
+    image, calls, bin_dir = make_guest(tmp_path, monkeypatch)
+    runner = orchestrator.Orchestrator(timeouts={"stop": 5})
+
+    for _ in range(2):
+        (result,) = runner.run([image], run_time=0.5)
+        assert result.ok, result.to_dict()
+
+    assert calls == ["start", "stop"] * 2
+
+    # Stopped at once, without waiting on a powerdown
+    commands = (bin_dir / "qmp").read_text().split()
+    assert "quit" in commands
+    assert "system_powerdown" not in commands
+
+
+def test_netns_boot_runs_as_user(tmp_path, monkeypatch):
+
+    image, _, _ = make_guest(tmp_path, monkeypatch, netns=True)
+    image.add_net_device("192.168.0.1", "192.168.0.2", "eth0")
+
+    command = image.get_boot_command()
+    prefix = (
+        qemu_runner.netns_exec.format(image.instance.netns)
+        + qemu_runner.run_as_user.format(os.getuid(), os.getgid())
+    ).split()
+
+    assert command[: len(prefix)] == prefix
+    assert command[len(prefix)] == qemu_runner.qemu_commands["mipsel"]
+
+
+def test_snapshot_reaches_later_runs(tmp_path, monkeypatch):
+
+    image, _, bin_dir = make_guest(tmp_path, monkeypatch)
+    (tmp_path / "image.raw").write_bytes(b"")
+
+    monkeypatch.setattr(qemu_runner, "snapshot_dir", str(tmp_path / "snapshots"))
+    # Without qemu-img, the layers are empty files
+    monkeypatch.setattr(
+        storage_helper,
+        "create_overlay",
+        lambda base, overlay: open(overlay, "w").close(),
+    )
+
+    image.snapshot = "network"
+    snapshot = image.get_snapshot(timeout=10)
+
+    with open(snapshot.state) as f:
+        assert f.read() == "state"
+
+    # Another instance restores it without booting
+    other = qemu_runner.QemuImage(
+        "mipsel",
+        "little",
+        str(tmp_path / "image.raw"),
+        None,
+        instance=instance_helper.allocate(),
+        snapshot="network",
+    )
+    assert other.get_snapshot() == snapshot
+    assert len((bin_dir / "argv").read_text().splitlines()) == 1
+
+    # Not once the image changed
+    os.utime(str(tmp_path / "image.raw"), ns=(0, 0))
+    assert other.find_snapshot() is None